@@ -0,0 +1,3 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
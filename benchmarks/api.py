@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import sys
+import time
+from collections import Counter, OrderedDict
+
+from terminaltables import AsciiTable
+
+import healthcheck
+from healthcheck import api, metrics, storage
+from healthcheck.backends import hostgroups
+from tests.fakezabbix import FakeZabbix, FakeZabbixServer
+
+
+SIZES = (1, 10, 100, 1000, 5000)
+CHUNK_SIZE = 500
+NAME = "bench"
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(index, 0)]
+
+
+class CallCounter(object):
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def __call__(self, kind, method, duration, error=False):
+        self.counts[kind] += 1
+
+
+class Route(object):
+
+    def __init__(self, name, method, path):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.durations = []
+        self.errors = 0
+        self.zabbix_calls = 0
+        self.zabbix_requests = 0
+        self.mongo_calls = 0
+
+    def report(self, size):
+        count = len(self.durations)
+        elapsed = sum(self.durations)
+        return OrderedDict([
+            ("size", size),
+            ("route", self.name),
+            ("method", self.method),
+            ("path", self.path),
+            ("requests", count),
+            ("errors", self.errors),
+            ("throughput", round(count / elapsed, 2) if elapsed else 0.0),
+            ("latency_ms", OrderedDict([
+                ("p50", round(percentile(self.durations, 50) * 1000, 3)),
+                ("p99", round(percentile(self.durations, 99) * 1000, 3)),
+                ("mean", round(elapsed / count * 1000, 3) if count else 0.0),
+                ("max", round(max(self.durations) * 1000, 3) if count else 0.0),
+            ])),
+            ("zabbix_calls_per_request", round(float(self.zabbix_calls) / count, 2) if count else 0.0),
+            ("zabbix_requests_per_request", round(float(self.zabbix_requests) / count, 2) if count else 0.0),
+            ("mongo_calls_per_request", round(float(self.mongo_calls) / count, 2) if count else 0.0),
+        ])
+
+
+class Benchmark(object):
+
+    def __init__(self, zabbix, counter):
+        self.zabbix = zabbix
+        self.counter = counter
+        self.client = api.app.test_client()
+        self.routes = OrderedDict()
+
+    def request(self, route_name, method, path, template=None, **kwargs):
+        zabbix_calls = sum(self.zabbix.calls.values())
+        zabbix_requests = self.zabbix.requests
+        mongo_calls = self.counter.counts["mongo"]
+        start = time.time()
+        response = self.client.open(path, method=method, **kwargs)
+        duration = time.time() - start
+        if route_name is None:
+            if response.status_code >= 400:
+                raise RuntimeError("{} {} failed with {}: {}".format(
+                    method, path, response.status_code, response.data))
+            return response
+        route = self.routes.get(route_name)
+        if route is None:
+            route = self.routes[route_name] = Route(route_name, method, template or path)
+        route.durations.append(duration)
+        if response.status_code >= 400:
+            route.errors += 1
+        route.zabbix_calls += sum(self.zabbix.calls.values()) - zabbix_calls
+        route.zabbix_requests += self.zabbix.requests - zabbix_requests
+        route.mongo_calls += self.counter.counts["mongo"] - mongo_calls
+        return response
+
+    def post_json(self, route_name, path, data, template=None):
+        return self.request(route_name, "POST", path, template,
+                            data=json.dumps(data), content_type="application/json")
+
+    def delete_json(self, route_name, path, data, template=None):
+        return self.request(route_name, "DELETE", path, template,
+                            data=json.dumps(data), content_type="application/json")
+
+    def populate(self, size):
+        self.request(None, "POST", "/resources", data={"name": NAME})
+        for start in range(0, size, CHUNK_SIZE):
+            urls = [{"url": "http://app-{}.example.com/healthcheck".format(i),
+                     "comment": "url {}".format(i)}
+                    for i in range(start, min(start + CHUNK_SIZE, size))]
+            self.post_json(None, "/resources/{}/urls".format(NAME), {"urls": urls})
+
+    def run(self, iterations, host_groups):
+        base = "/resources/{}".format(NAME)
+        for i in range(iterations):
+            url = "http://extra-{}.example.com/".format(i)
+            watcher = "watcher-{}@example.com".format(i)
+            group = "group-{}".format(i % host_groups)
+            self.request("list_urls", "GET", base + "/url", "/resources/<name>/url",
+                         headers={"Accept": "application/json"})
+            self.post_json("add_url", base + "/url", {"url": url, "comment": "extra"},
+                           "/resources/<name>/url")
+            self.delete_json("remove_url", base + "/url", {"url": url},
+                             "/resources/<name>/url")
+            self.post_json("add_watcher", base + "/watcher", {"watcher": watcher},
+                           "/resources/<name>/watcher")
+            self.request("list_watchers", "GET", base + "/watcher",
+                         "/resources/<name>/watcher")
+            self.request("remove_watcher", "DELETE", base + "/watcher/" + watcher,
+                         "/resources/<name>/watcher/<watcher>")
+            self.request("list_service_groups", "GET", base + "/servicegroups?keyword=group-1",
+                         "/resources/<name>/servicegroups")
+            self.post_json("add_group", base + "/groups", {"group": group},
+                           "/resources/<name>/groups")
+            self.request("list_groups", "GET", base + "/groups",
+                         "/resources/<name>/groups")
+            self.delete_json("remove_group", base + "/groups", {"group": group},
+                             "/resources/<name>/groups")
+            name = "{}-{}".format(NAME, i)
+            self.request("new", "POST", "/resources", data={"name": name})
+            self.request("remove", "DELETE", "/resources/" + name,
+                         "/resources/<name>")
+        # removing the populated instance can only be measured once
+        self.request("remove_populated", "DELETE", base, "/resources/<name>")
+
+
+def reset_storage(options):
+    os.environ["MONGODB_DATABASE"] = options.mongodb_database
+    if options.storage == "memory":
+        try:
+            import mongomock
+        except ImportError:
+            raise SystemExit("--storage memory requires mongomock to be installed")
+        client = mongomock.MongoClient()
+        storage.mongo_client = lambda: client
+    else:
+        storage.mongo_client().drop_database(options.mongodb_database)
+    storage.MongoStorage().ensure_indexes()
+
+
+def run_size(size, options, counter):
+    zabbix = FakeZabbix(latency={"*": options.zabbix_latency})
+    group_ids = zabbix.add_host_groups(
+        ["hcaas"] + ["group-{}".format(i) for i in range(options.host_groups)])
+    with FakeZabbixServer(zabbix) as server:
+        os.environ.update({
+            "API_MANAGER": "zabbix",
+            "ZABBIX_URL": server.url,
+            "ZABBIX_USER": zabbix.user,
+            "ZABBIX_PASSWORD": zabbix.password,
+            "ZABBIX_HOST_GROUP": group_ids[0],
+        })
+        api.pools.clear()
+        hostgroups._index = None
+        reset_storage(options)
+        bench = Benchmark(zabbix, counter)
+        bench.populate(size)
+        bench.run(options.iterations, options.host_groups)
+        api.pools.clear()
+    return [route.report(size) for route in bench.routes.values()]
+
+
+def render_table(results):
+    rows = [["size", "route", "req/s", "p50 ms", "p99 ms", "zabbix calls", "mongo calls", "errors"]]
+    for r in results:
+        rows.append([r["size"], r["route"], r["throughput"], r["latency_ms"]["p50"],
+                     r["latency_ms"]["p99"], r["zabbix_calls_per_request"],
+                     r["mongo_calls_per_request"], r["errors"]])
+    return AsciiTable([[str(c) for c in row] for row in rows]).table
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="benchmark every healthcheck.api route through the WSGI stack")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in SIZES),
+                        help="comma separated number of urls of the benchmarked instance")
+    parser.add_argument("--iterations", type=int, default=20,
+                        help="requests per route and size")
+    parser.add_argument("--storage", choices=("mongodb", "memory"), default="mongodb",
+                        help="a local mongodb (MONGODB_URI) or an in memory mongomock client")
+    parser.add_argument("--mongodb-database", default="hcapi_benchmark",
+                        help="database dropped and recreated for each size")
+    parser.add_argument("--zabbix-latency", type=float, default=0,
+                        help="seconds slept by the fake zabbix on every call")
+    parser.add_argument("--host-groups", type=int, default=100,
+                        help="number of host groups in the fake zabbix")
+    parser.add_argument("--output", default="benchmark-results.json",
+                        help="file the JSON results are written to, - for stdout")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_args(args)
+    for env in ("API_USERNAME", "API_PASSWORD", "METRICS_DIR"):
+        os.environ.pop(env, None)
+    counter = CallCounter()
+    metrics.listeners.append(counter)
+    results = []
+    try:
+        for size in [int(s) for s in options.sizes.split(",")]:
+            sys.stderr.write("benchmarking instance with {} urls\n".format(size))
+            results.extend(run_size(size, options, counter))
+    finally:
+        metrics.listeners.remove(counter)
+    report = OrderedDict([
+        ("version", healthcheck.__version__),
+        ("python", platform.python_version()),
+        ("created_at", datetime.datetime.utcnow().isoformat() + "Z"),
+        ("options", OrderedDict([
+            ("iterations", options.iterations),
+            ("storage", options.storage),
+            ("zabbix_latency", options.zabbix_latency),
+            ("host_groups", options.host_groups),
+        ])),
+        ("results", results),
+    ])
+    data = json.dumps(report, indent=2)
+    if options.output == "-":
+        sys.stdout.write(data + "\n")
+    else:
+        with open(options.output, "w") as f:
+            f.write(data + "\n")
+    sys.stderr.write(render_table(results) + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import requests
+from terminaltables import AsciiTable
+from werkzeug.exceptions import HTTPException
+
+from benchmarks.api import percentile
+
+
+def read_trace(lines):
+    entries = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            raise ValueError("line {}: invalid JSON".format(number))
+        for field in ("method", "path", "timestamp"):
+            if field not in entry:
+                raise ValueError("line {}: {} is required".format(number, field))
+        entries.append(entry)
+    entries.sort(key=lambda e: e["timestamp"])
+    return entries
+
+
+def route_matcher():
+    from healthcheck.api import app
+    adapter = app.url_map.bind("localhost")
+
+    def match(method, path):
+        try:
+            rule, _ = adapter.match(path.split("?")[0], method, return_rule=True)
+        except HTTPException:
+            return path.split("?")[0]
+        return rule.rule
+    return match
+
+
+class Result(object):
+
+    def __init__(self, entry, route, lag, duration, status=None, error=None):
+        self.entry = entry
+        self.route = route
+        self.lag = lag
+        self.duration = duration
+        self.status = status
+        self.error = error
+
+    @property
+    def failed(self):
+        return self.error is not None or self.status >= 500
+
+
+class Replayer(object):
+
+    def __init__(self, target, concurrency=10, speed=1.0, rate=None, timeout=30,
+                 auth=None, match=None):
+        self.target = target.rstrip("/")
+        self.concurrency = concurrency
+        self.speed = speed
+        self.rate = rate
+        self.timeout = timeout
+        self.auth = auth
+        self.match = match or route_matcher()
+        self.results = []
+        self.lock = threading.Lock()
+
+    def send(self, session, entry):
+        kwargs = {"headers": entry.get("headers"), "timeout": self.timeout, "auth": self.auth}
+        if "form" in entry:
+            kwargs["data"] = entry["form"]
+        elif "body" in entry:
+            body = entry["body"]
+            kwargs["data"] = json.dumps(body) if isinstance(body, (dict, list)) else body
+        return session.request(entry["method"], self.target + entry["path"], **kwargs)
+
+    def execute(self, session, entry, lag):
+        route = "{} {}".format(entry["method"], self.match(entry["method"], entry["path"]))
+        start = time.time()
+        try:
+            response = self.send(session, entry)
+        except requests.RequestException as e:
+            return Result(entry, route, lag, time.time() - start, error=str(e))
+        return Result(entry, route, lag, time.time() - start, status=response.status_code)
+
+    def schedule(self, entries):
+        # offsets of each request from the start of the replay
+        first = entries[0]["timestamp"] if entries else 0
+        offsets = []
+        for i, entry in enumerate(entries):
+            offset = (entry["timestamp"] - first) / float(self.speed) if self.speed else 0.0
+            if self.rate:
+                offset = max(offset, i / float(self.rate))
+            offsets.append(offset)
+        return offsets
+
+    def worker(self, jobs, start):
+        session = requests.Session()
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            offset, entry = job
+            result = self.execute(session, entry, max(time.time() - start - offset, 0))
+            with self.lock:
+                self.results.append(result)
+
+    def replay(self, entries):
+        setup = [e for e in entries if e.get("setup")]
+        entries = [e for e in entries if not e.get("setup")]
+        session = requests.Session()
+        for entry in setup:
+            result = self.execute(session, entry, 0)
+            if result.failed or result.status >= 400:
+                raise RuntimeError("setup request {} {} failed: {}".format(
+                    entry["method"], entry["path"], result.error or result.status))
+        jobs = queue.Queue(maxsize=self.concurrency)
+        start = time.time()
+        threads = []
+        for _ in range(self.concurrency):
+            thread = threading.Thread(target=self.worker, args=(jobs, start))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for offset, entry in zip(self.schedule(entries), entries):
+            delay = start + offset - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            jobs.put((offset, entry))
+        for _ in threads:
+            jobs.put(None)
+        for thread in threads:
+            thread.join()
+        return self.report(time.time() - start)
+
+    def report(self, elapsed):
+        routes = OrderedDict()
+        for result in sorted(self.results, key=lambda r: r.route):
+            routes.setdefault(result.route, []).append(result)
+        report_routes = []
+        for route, results in routes.items():
+            durations = [r.duration for r in results]
+            statuses = Counter(str(r.status or "error") for r in results)
+            report_routes.append(OrderedDict([
+                ("route", route),
+                ("requests", len(results)),
+                ("errors", sum(1 for r in results if r.failed)),
+                ("statuses", OrderedDict(sorted(statuses.items()))),
+                ("latency_ms", OrderedDict([
+                    ("p50", round(percentile(durations, 50) * 1000, 3)),
+                    ("p90", round(percentile(durations, 90) * 1000, 3)),
+                    ("p99", round(percentile(durations, 99) * 1000, 3)),
+                    ("max", round(max(durations) * 1000, 3)),
+                ])),
+            ]))
+        lags = [r.lag for r in self.results]
+        return OrderedDict([
+            ("target", self.target),
+            ("concurrency", self.concurrency),
+            ("speed", self.speed),
+            ("rate", self.rate),
+            ("elapsed", round(elapsed, 3)),
+            ("requests", len(self.results)),
+            ("errors", sum(1 for r in self.results if r.failed)),
+            ("throughput", round(len(self.results) / elapsed, 2) if elapsed else 0.0),
+            # how late requests were sent, a high lag means the concurrency
+            # was not enough to keep the trace pacing
+            ("lag_ms", OrderedDict([
+                ("p50", round(percentile(lags, 50) * 1000, 3)),
+                ("p99", round(percentile(lags, 99) * 1000, 3)),
+            ])),
+            ("routes", report_routes),
+        ])
+
+
+def render_table(report):
+    rows = [["route", "requests", "errors", "p50 ms", "p90 ms", "p99 ms", "statuses"]]
+    for r in report["routes"]:
+        statuses = " ".join("{}:{}".format(k, v) for k, v in r["statuses"].items())
+        rows.append([r["route"], r["requests"], r["errors"], r["latency_ms"]["p50"],
+                     r["latency_ms"]["p90"], r["latency_ms"]["p99"], statuses])
+    return AsciiTable([[str(c) for c in row] for row in rows]).table
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="replay a JSONL trace of api calls against a running healthcheck api")
+    parser.add_argument("trace", help="JSONL trace file, - for stdin")
+    parser.add_argument("--target", default="http://localhost:8888",
+                        help="base url of the api")
+    parser.add_argument("--concurrency", type=int, default=10,
+                        help="number of requests in flight at most")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="time compression, 2 replays twice as fast and 0 ignores the pacing")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="max requests per second")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="seconds before a request is considered failed")
+    parser.add_argument("--username", help="API_USERNAME of the api")
+    parser.add_argument("--password", help="API_PASSWORD of the api")
+    parser.add_argument("--output", default="-", help="JSON report file, - for stdout")
+    options = parser.parse_args(args)
+    if options.trace == "-":
+        entries = read_trace(sys.stdin)
+    else:
+        with open(options.trace) as f:
+            entries = read_trace(f)
+    auth = None
+    if options.username:
+        auth = (options.username, options.password or "")
+    replayer = Replayer(options.target, options.concurrency, options.speed,
+                        options.rate, options.timeout, auth)
+    report = replayer.replay(entries)
+    data = json.dumps(report, indent=2)
+    if options.output == "-":
+        sys.stdout.write(data + "\n")
+    else:
+        with open(options.output, "w") as f:
+            f.write(data + "\n")
+    sys.stderr.write(render_table(report) + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+import json
+import random
+import sys
+
+
+JSON = {"Content-Type": "application/json"}
+JSON_TEXT = {"Content-Type": "application/json", "Accept": "text/plain"}
+
+# relative frequency of each tsuru plugin command, reads dominate because
+# users list an instance far more often than they change it
+WEIGHTS = (
+    ("list_urls", 30),
+    ("list_watchers", 14),
+    ("add_url", 14),
+    ("list_groups", 8),
+    ("add_watcher", 8),
+    ("list_service_groups", 7),
+    ("remove_url", 6),
+    ("remove_watcher", 4),
+    ("add_group", 4),
+    ("remove_group", 2),
+    ("new", 2),
+    ("remove", 1),
+)
+
+
+class Instance(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.urls = []
+        self.watchers = []
+        self.groups = []
+        self.next_id = 0
+
+    def path(self, suffix=""):
+        return "/resources/{}{}".format(self.name, suffix)
+
+    def unique(self):
+        self.next_id += 1
+        return self.next_id
+
+
+class TraceGenerator(object):
+
+    def __init__(self, instances=20, groups=100, urls_per_instance=5, seed=None):
+        self.random = random.Random(seed)
+        self.groups = ["group-{}".format(i) for i in range(groups)]
+        self.urls_per_instance = urls_per_instance
+        self.instances = []
+        self.created = 0
+        self.initial_instances = instances
+
+    def entry(self, method, path, body=None, form=None, headers=None):
+        entry = {"method": method, "path": path}
+        if body is not None:
+            entry["body"] = body
+        if form is not None:
+            entry["form"] = form
+        if headers:
+            entry["headers"] = headers
+        return entry
+
+    def generate(self, duration, rate):
+        now = 0.0
+        # the instances used by the trace and their first urls, replayed
+        # one by one before the paced part of the trace
+        for _ in range(self.initial_instances):
+            entries = self.new()
+            instance = self.instances[-1]
+            entries.extend(self.add_url(instance) for _ in range(self.urls_per_instance))
+            for entry in entries:
+                entry["timestamp"] = now
+                entry["setup"] = True
+                yield entry
+        operations = [name for name, _ in WEIGHTS]
+        weights = [weight for _, weight in WEIGHTS]
+        while True:
+            now += self.random.expovariate(rate)
+            if now > duration:
+                return
+            operation = self.choose(operations, weights) if self.instances else "new"
+            for entry in getattr(self, "op_" + operation)():
+                entry["timestamp"] = round(now, 3)
+                yield entry
+
+    def choose(self, operations, weights):
+        point = self.random.uniform(0, sum(weights))
+        for operation, weight in zip(operations, weights):
+            point -= weight
+            if point <= 0:
+                return operation
+        return operations[-1]
+
+    def instance(self):
+        return self.random.choice(self.instances)
+
+    def new(self):
+        self.created += 1
+        instance = Instance("trace-{}".format(self.created))
+        self.instances.append(instance)
+        return [self.entry("POST", "/resources", form={"name": instance.name})]
+
+    def add_url(self, instance):
+        url = "http://{}-{}.example.com/healthcheck".format(instance.name, instance.unique())
+        instance.urls.append(url)
+        body = {"url": url}
+        if self.random.random() < 0.3:
+            body["expected_string"] = "WORKING"
+        if self.random.random() < 0.3:
+            body["comment"] = "restart the app"
+        return self.entry("POST", instance.path("/url"), body, headers=JSON_TEXT)
+
+    def op_new(self):
+        return self.new()
+
+    def op_remove(self):
+        if len(self.instances) <= 1:
+            return self.op_new()
+        instance = self.instance()
+        self.instances.remove(instance)
+        return [self.entry("DELETE", instance.path())]
+
+    def op_list_urls(self):
+        return [self.entry("GET", self.instance().path("/url"), headers=JSON)]
+
+    def op_add_url(self):
+        return [self.add_url(self.instance())]
+
+    def op_remove_url(self):
+        instance = self.instance()
+        if not instance.urls:
+            return [self.add_url(instance)]
+        url = instance.urls.pop(self.random.randrange(len(instance.urls)))
+        return [self.entry("DELETE", instance.path("/url"), {"url": url}, headers=JSON)]
+
+    def op_list_watchers(self):
+        return [self.entry("GET", self.instance().path("/watcher"), headers=JSON)]
+
+    def op_add_watcher(self):
+        instance = self.instance()
+        watcher = "{}+{}@example.com".format(instance.name, instance.unique())
+        instance.watchers.append(watcher)
+        return [self.entry("POST", instance.path("/watcher"), {"watcher": watcher},
+                           headers=JSON_TEXT)]
+
+    def op_remove_watcher(self):
+        instance = self.instance()
+        if not instance.watchers:
+            return self.op_list_watchers()
+        watcher = instance.watchers.pop(self.random.randrange(len(instance.watchers)))
+        return [self.entry("DELETE", instance.path("/watcher/" + watcher))]
+
+    def op_list_service_groups(self):
+        path = self.instance().path("/servicegroups")
+        if self.random.random() < 0.5:
+            path += "?keyword=" + self.random.choice(self.groups)[:7]
+        return [self.entry("GET", path, headers=JSON)]
+
+    def op_list_groups(self):
+        return [self.entry("GET", self.instance().path("/groups"), headers=JSON)]
+
+    def op_add_group(self):
+        instance = self.instance()
+        available = [g for g in self.groups if g not in instance.groups]
+        if not available:
+            return self.op_list_groups()
+        group = self.random.choice(available)
+        instance.groups.append(group)
+        return [self.entry("POST", instance.path("/groups"), {"group": group},
+                           headers=JSON_TEXT)]
+
+    def op_remove_group(self):
+        instance = self.instance()
+        if not instance.groups:
+            return self.op_list_groups()
+        group = instance.groups.pop(self.random.randrange(len(instance.groups)))
+        return [self.entry("DELETE", instance.path("/groups"), {"group": group}, headers=JSON)]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="write a synthetic JSONL trace shaped like the tsuru plugin usage")
+    parser.add_argument("--duration", type=float, default=600,
+                        help="seconds covered by the trace")
+    parser.add_argument("--rate", type=float, default=5,
+                        help="average requests per second after the setup")
+    parser.add_argument("--instances", type=int, default=20,
+                        help="instances created at the start of the trace")
+    parser.add_argument("--urls", type=int, default=5,
+                        help="urls added to each initial instance")
+    parser.add_argument("--groups", type=int, default=100,
+                        help="number of existing host groups, named group-<n>")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default="-", help="trace file, - for stdout")
+    options = parser.parse_args(args)
+    generator = TraceGenerator(options.instances, options.groups, options.urls, options.seed)
+    out = sys.stdout if options.output == "-" else open(options.output, "w")
+    try:
+        for entry in generator.generate(options.duration, options.rate):
+            out.write(json.dumps(entry, sort_keys=True) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,20 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import logging
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from healthcheck import deadlines, metrics, timing
+
+
+logger = logging.getLogger(__name__)
+
 
 class Action(object):
 
@@ -31,3 +45,117 @@ class Pipeline(object):
             action = self.actions[index]
             action.backward(**kwargs)
             index = index - 1
+
+
+class Step(Action):
+
+    def __init__(self, name, forward, backward=None, requires=()):
+        self.name = name
+        self.requires = tuple(requires)
+        self.run_forward = forward
+        self.run_backward = backward
+
+    def forward(self, context):
+        return self.run_forward(context)
+
+    def backward(self, context):
+        if self.run_backward is not None:
+            self.run_backward(context)
+
+
+class Saga(Pipeline):
+
+    def __init__(self, actions, name="saga"):
+        super(Saga, self).__init__(actions)
+        self.name = name
+        self.timings = []
+        self.validate()
+
+    def validate(self):
+        names = set()
+        for action in self.actions:
+            if action.name in names:
+                raise ValueError("duplicated step {}".format(action.name))
+            missing = [r for r in action.requires if r not in names]
+            if missing:
+                raise ValueError("step {} requires {}, which must come before it".format(
+                    action.name, ", ".join(missing)))
+            names.add(action.name)
+
+    def execute(self, **kwargs):
+        context = dict(kwargs)
+        pending = list(self.actions)
+        running = set()
+        done = []
+        results = queue.Queue()
+        error = None
+        self.start = time.time()
+        while pending or running:
+            if error is None:
+                finished = set(action.name for action in done)
+                ready = [a for a in pending if all(r in finished for r in a.requires)]
+                for action in ready:
+                    pending.remove(action)
+                    running.add(action.name)
+                    if len(ready) == 1 and len(running) == 1:
+                        results.put(self.run(action, context))
+                    else:
+                        thread = threading.Thread(target=timing.bind(deadlines.bind(
+                            lambda a=action: results.put(self.run(a, context)))))
+                        thread.daemon = True
+                        thread.start()
+            if not running:
+                break
+            action, result, exc = results.get()
+            running.remove(action.name)
+            if exc is not None:
+                error = error or exc
+            else:
+                context[action.name] = result
+                done.append(action)
+        if error is not None:
+            self.compensate(done, context)
+            raise error
+        return context
+
+    def run(self, action, context):
+        start = time.time()
+        result = exc = None
+        try:
+            result = action.forward(context)
+        except Exception as e:
+            exc = e
+        self.record(action.name, "forward", start, exc)
+        return action, result, exc
+
+    def compensate(self, done, context):
+        # undoing a saga cut by the request deadline needs time of its own
+        with deadlines.override(deadlines.Deadline(deadlines.request_timeout())):
+            self.run_backward(done, context)
+
+    def run_backward(self, done, context):
+        for action in reversed(done):
+            start = time.time()
+            exc = None
+            try:
+                action.backward(context)
+            except Exception as e:
+                exc = e
+                logger.exception("failed to compensate step %s of %s", action.name, self.name)
+            self.record(action.name, "backward", start, exc)
+
+    def record(self, step, direction, start, exc):
+        duration = time.time() - start
+        status = "error" if exc is not None else "ok"
+        self.timings.append({
+            "step": step,
+            "direction": direction,
+            "offset": start - self.start,
+            "duration": duration,
+            "status": status,
+        })
+        metrics.registry.observe(
+            "hcaas_saga_step_duration_seconds",
+            metrics.labels(saga=self.name, step=step, direction=direction, status=status),
+            duration,
+        )
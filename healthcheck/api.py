@@ -2,21 +2,36 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-from flask import Flask, request
+from flask import Flask, g, request
 from flask_admin import Admin
 from terminaltables import AsciiTable
+import requests
 
 from raven.contrib.flask import Sentry
 
 from healthcheck import admin as hadmin
 from healthcheck import auth
-from healthcheck.storage import ItemNotFoundError
-from healthcheck.backends import GroupNotInInstanceError, GroupNotExists
+from healthcheck import coalesce
+from healthcheck import deadlines
+from healthcheck import metrics
+from healthcheck import timing
+from healthcheck.deadlines import DeadlineExceededError
+from healthcheck.idempotency import idempotent
+from healthcheck.locks import LockLostError, LockTimeoutError
+from healthcheck.pool import ManagerPool, PoolTimeoutError
+from healthcheck.storage import (CachedStorage, HealthCheckNotFoundError, ItemNotFoundError, Job,
+                                 JobNotFoundError)
+from healthcheck.backends import (GroupNotInInstanceError, GroupNotExists, MongoReader,
+                                  breaker, governor, hostgroups)
+from healthcheck.backends.breaker import ZabbixUnavailableError
+from healthcheck.backends.governor import ZabbixOverloadedError
 
 import json
 import inspect
+import math
 import os
 import logging
+import time
 
 app = Flask(__name__)
 app.debug = os.environ.get("API_DEBUG", "0") in ("True", "true", "1")
@@ -45,16 +60,202 @@ def page_not_found(e):
     return "", 404
 
 
-def get_manager():
+@app.errorhandler(PoolTimeoutError)
+def pool_timeout(e):
+    return "no manager available, try again later", 503
+
+
+@app.errorhandler(LockTimeoutError)
+def lock_timeout(e):
+    return "instance is busy, try again later", 503
+
+
+@app.errorhandler(LockLostError)
+def lock_lost(e):
+    return "instance lock lost, try again later", 503
+
+
+@app.errorhandler(DeadlineExceededError)
+def deadline_exceeded(e):
+    return "request deadline exceeded", 504
+
+
+@app.errorhandler(ZabbixUnavailableError)
+def zabbix_unavailable(e):
+    retry_after = str(int(math.ceil(max(e.retry_after, 1))))
+    return "zabbix is unavailable, try again later", 503, {"Retry-After": retry_after}
+
+
+@app.errorhandler(ZabbixOverloadedError)
+def zabbix_overloaded(e):
+    retry_after = str(int(math.ceil(e.retry_after)))
+    return "zabbix is overloaded, try again later", 503, {"Retry-After": retry_after}
+
+
+pools = {}
+
+
+def get_manager_pool():
     from healthcheck.backends import Zabbix
     managers = {
-        "zabbix": Zabbix(),
+        "zabbix": Zabbix,
     }
     manager = os.environ.get("API_MANAGER", "zabbix")
     manager_class = managers.get(manager)
-    if manager_class:
-        return manager_class
-    raise ValueError("{0} is not a valid manager".format(manager))
+    if not manager_class:
+        raise ValueError("{0} is not a valid manager".format(manager))
+    pool = pools.get(manager)
+    if pool is None or pool.pid != os.getpid():
+        pool = pools[manager] = ManagerPool(
+            manager_class,
+            size=int(os.environ.get("API_MANAGER_POOL_SIZE", 10)),
+            timeout=float(os.environ.get("API_MANAGER_POOL_TIMEOUT", 30)),
+        )
+    return pool
+
+
+def get_manager():
+    pool = get_manager_pool()
+    if "manager" not in g:
+        zabbix = breaker.shared_breaker()
+        if not zabbix.available():
+            raise ZabbixUnavailableError(zabbix.retry_after())
+        g.manager = pool.acquire()
+        g.manager_pool = pool
+        storage = getattr(g.manager, "storage", None)
+        if isinstance(storage, CachedStorage):
+            storage.begin()
+    return g.manager
+
+
+def read(method, *args):
+    # reads kept in mongodb are still answered while zabbix is unavailable,
+    # including while the breaker has not opened yet
+    if breaker.shared_breaker().available():
+        try:
+            return getattr(get_manager(), method)(*args)
+        except (ZabbixUnavailableError, ZabbixOverloadedError, requests.RequestException):
+            pass
+    g.degraded = True
+    metrics.registry.inc("hcaas_degraded_reads_total", metrics.labels(method=method))
+    reader = MongoReader(get_storage(), hostgroups.shared_index())
+    return getattr(reader, method)(*args)
+
+
+def get_storage():
+    if "storage" not in g:
+        from healthcheck.storage import MongoStorage
+        g.storage = CachedStorage(MongoStorage())
+    return g.storage
+
+
+def respond_async(operation):
+    routes = os.environ.get("API_ASYNC_ROUTES", "")
+    if operation in [route.strip() for route in routes.split(",")]:
+        return True
+    return "respond-async" in request.headers.get("Prefer", "")
+
+
+def enqueue(operation, **args):
+    # a job for an instance that does not exist would only fail later
+    try:
+        get_storage().find_healthcheck_by_name(args["name"])
+    except HealthCheckNotFoundError:
+        return "healthcheck not found", 404
+    job = get_storage().add_job(Job(operation, args))
+    location = "/jobs/{}".format(job.id)
+    return json.dumps({"id": job.id, "status": job.status}), 202, {"Location": location}
+
+
+def pool_gauges():
+    values = []
+    for name, pool in pools.items():
+        if pool.pid != os.getpid():
+            continue
+        stats = pool.stats()
+        for key in ("size", "created", "in_use", "idle", "waiting"):
+            values.append(("hcaas_manager_pool_{}".format(key), (("manager", name),), stats[key]))
+        for key in ("acquired", "waits", "wait_time"):
+            values.append(("hcaas_manager_pool_{}_total".format(key), (("manager", name),), stats[key]))
+    return values
+
+
+def mongo_gauges():
+    from healthcheck.storage import connection_stats
+    stats = connection_stats()
+    return [("hcaas_mongo_clients_created", (), stats["clients_created"])]
+
+
+metrics.registry.register_gauges(pool_gauges)
+metrics.registry.register_gauges(mongo_gauges)
+metrics.registry.register_gauges(governor.gauges)
+metrics.registry.register_gauges(breaker.gauges)
+
+
+if timing.record not in metrics.listeners:
+    metrics.listeners.append(timing.record)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.time()
+    if request.path == "/resources" or request.path.startswith("/resources/"):
+        g.timings = timing.RequestTimings()
+        g.deadline = deadlines.from_headers(request.headers)
+
+
+@app.after_request
+def server_timing_header(response):
+    timings = g.get("timings")
+    if timings is not None:
+        response.headers["Server-Timing"] = timings.header()
+        if request.headers.get("X-Debug-Timing") in ("True", "true", "1"):
+            response.headers["X-Timing-Debug"] = timings.debug()
+    return response
+
+
+@app.after_request
+def observe_request(response):
+    start = g.get("request_start")
+    if start is not None and request.url_rule is not None:
+        metrics.observe_request(request.url_rule.rule, request.method,
+                                response.status_code, time.time() - start)
+        metrics.flush()
+    return response
+
+
+@app.after_request
+def storage_reads_header(response):
+    storage = getattr(g.get("manager"), "storage", None)
+    if isinstance(storage, CachedStorage):
+        response.headers["X-Storage-Reads"] = \
+            "reads={reads}; hits={hits}".format(**storage.stats())
+    return response
+
+
+@app.after_request
+def degraded_warning(response):
+    if g.get("degraded"):
+        response.headers["Warning"] = '199 hcaas "zabbix is unavailable, answered from mongodb"'
+    return response
+
+
+@app.after_request
+def invalidate_reads(response):
+    # a 202 changed nothing yet, the cache is dropped when its job is seen
+    # finished
+    name = (request.view_args or {}).get("name")
+    if request.method in ("POST", "DELETE") and name and response.status_code < 400 \
+            and response.status_code != 202:
+        coalesce.invalidate(name)
+    return response
+
+
+@app.teardown_appcontext
+def release_manager(exc):
+    manager = g.pop("manager", None)
+    if manager is not None:
+        g.pop("manager_pool").release(manager)
 
 
 @app.route("/", methods=["GET"])
@@ -64,6 +265,7 @@ def index():
 
 @app.route("/resources/<name>/url", methods=["POST"])
 @auth.required
+@idempotent
 def add_url(name):
     if not request.data:
         return "url is required", 400
@@ -71,12 +273,33 @@ def add_url(name):
     if "url" not in data:
         return "url is required", 400
     data["name"] = name
+    if respond_async("add_url"):
+        args = dict((key, data[key]) for key in ("url", "expected_string", "comment") if key in data)
+        return enqueue("add_url", name=name, **args)
     get_manager().add_url(**data)
     return "", 201
 
 
+@app.route("/resources/<name>/urls", methods=["POST"])
+@auth.required
+@idempotent
+def add_urls(name):
+    if not request.data:
+        return "urls are required", 400
+    data = json.loads(request.data)
+    urls = data.get("urls")
+    if not urls or not isinstance(urls, list):
+        return "urls are required", 400
+    for url in urls:
+        if not isinstance(url, dict) or "url" not in url:
+            return "url is required", 400
+    result = get_manager().add_urls(name, urls)
+    return json.dumps(result), 201
+
+
 @app.route("/resources/<name>/url", methods=["DELETE"])
 @auth.required
+@idempotent
 def remove_url(name):
     if not request.data:
         return "url is required", 400
@@ -93,26 +316,29 @@ def remove_url(name):
 
 @app.route("/resources/<name>/url", methods=["GET"])
 @auth.required
+@coalesce.coalesced
 def list_urls(name):
-    urls = get_manager().list_urls(name)
+    urls = read("list_urls", name)
 
-    if request.headers.get("accept") == "application/json":
-        return json.dumps([
-            {
-                "url": r[0],
-                "comment": r[1],
-            }
-            for r in urls
-        ]), 200
+    with timing.timed("render"):
+        if request.headers.get("accept") == "application/json":
+            return json.dumps([
+                {
+                    "url": r[0],
+                    "comment": r[1],
+                }
+                for r in urls
+            ]), 200
 
-    table_urls = [["Url", "Comment"]]
-    table_urls.extend(urls)
-    table = AsciiTable(table_urls)
-    return table.table, 200
+        table_urls = [["Url", "Comment"]]
+        table_urls.extend(urls)
+        table = AsciiTable(table_urls)
+        return table.table, 200
 
 
 @app.route("/resources/<name>/watcher", methods=["POST"])
 @auth.required
+@idempotent
 def add_watcher(name):
     if not request.data:
         return "watcher is required", 400
@@ -141,6 +367,7 @@ def remove_watcher_compat(name, ignored, watcher):
 
 @app.route("/resources/<name>/watcher/<watcher>", methods=["DELETE"])
 @auth.required
+@idempotent
 def remove_watcher(name, watcher):
     get_manager().remove_watcher(name, watcher)
     return "", 204
@@ -149,31 +376,37 @@ def remove_watcher(name, watcher):
 @app.route("/resources/<name>/watcher", methods=["GET"])
 @auth.required
 def list_watchers(name):
-    watchers = get_manager().list_watchers(name)
-    return json.dumps(watchers), 200
+    watchers = read("list_watchers", name)
+    with timing.timed("render"):
+        return json.dumps(watchers), 200
 
 
 @app.route("/resources/<name>/servicegroups", methods=["GET"])
 @auth.required
+@coalesce.coalesced
 def list_service_groups(name):
     keyword = request.args.get('keyword')
     if keyword:
-        groups = get_manager().list_service_groups(keyword)
+        groups = read("list_service_groups", keyword)
     else:
-        groups = get_manager().list_service_groups()
+        groups = read("list_service_groups")
 
-    return json.dumps(groups), 200
+    with timing.timed("render"):
+        return json.dumps(groups), 200
 
 
 @app.route("/resources/<name>/groups", methods=["GET"])
 @auth.required
+@coalesce.coalesced
 def list_groups(name):
-    groups = get_manager().list_groups(name)
-    return json.dumps(groups), 200
+    groups = read("list_groups", name)
+    with timing.timed("render"):
+        return json.dumps(groups), 200
 
 
 @app.route("/resources/<name>/groups", methods=["POST"])
 @auth.required
+@idempotent
 def add_group(name):
     if not request.data:
         return "group is required", 400
@@ -184,6 +417,8 @@ def add_group(name):
         return "group is required", 400
 
     group = data["group"]
+    if respond_async("add_group"):
+        return enqueue("add_group", name=name, group=group)
     get_manager().add_group(name, group)
 
     return "", 201
@@ -191,6 +426,7 @@ def add_group(name):
 
 @app.route("/resources/<name>/groups", methods=["DELETE"])
 @auth.required
+@idempotent
 def remove_group(name):
     if not request.data:
         return "group is required", 400
@@ -211,6 +447,7 @@ def remove_group(name):
 
 @app.route("/resources", methods=["POST"])
 @auth.required
+@idempotent
 def new():
     name = request.form.get("name")
     get_manager().new(name)
@@ -219,11 +456,39 @@ def new():
 
 @app.route("/resources/<name>", methods=["DELETE"])
 @auth.required
+@idempotent
 def remove(name):
+    if respond_async("remove"):
+        return enqueue("remove", name=name)
     get_manager().remove(name)
     return "", 204
 
 
+@app.route("/jobs/<job_id>", methods=["GET"])
+@auth.required
+def get_job(job_id):
+    try:
+        job = get_storage().find_job(job_id)
+    except JobNotFoundError:
+        return "job not found", 404
+    if job.status in ("done", "failed"):
+        coalesce.invalidate(job.args.get("name"))
+    return json.dumps(job.to_api()), 200
+
+
+# The tsuru service proxy only reaches routes under /resources/<name>, so the
+# plugin polls jobs through this alias
+@app.route("/resources/<name>/jobs/<job_id>", methods=["GET"])
+@auth.required
+def get_instance_job(name, job_id):
+    return get_job(job_id)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
 @app.route("/plugin", methods=["GET"])
 def plugin():
     from healthcheck import plugin
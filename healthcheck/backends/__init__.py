@@ -3,11 +3,31 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import logging
 import os
 
+from pyzabbix import ZabbixAPIException
+
+from healthcheck import deadlines
+from healthcheck.actions import Saga, Step
+from healthcheck.backends import hostgroups
+from healthcheck.backends.breaker import ZabbixUnavailableError, shared_breaker
+from healthcheck.locks import lock_options, locked
 from healthcheck.storage import HealthCheck, Item, User, UserNotFoundError
 
 
+logger = logging.getLogger(__name__)
+
+# id field of the zabbix objects deleted by a teardown
+ID_FIELDS = {
+    "action": "actionid",
+    "host": "hostid",
+    "httptest": "httptestid",
+    "user": "userid",
+    "usergroup": "usrgrpid",
+}
+
+
 def get_value(key):
     try:
         value = os.environ[key]
@@ -30,42 +50,129 @@ class Zabbix(object):
         self.host_group_id = get_value("ZABBIX_HOST_GROUP")
         self.watcher_default_password = get_value_or_default("WATCHER_PASSWORD", "watcher")
 
-        from pyzabbix import ZabbixAPI
-        self.zapi = ZabbixAPI(url)
-        self.zapi.login(user, password)
+        self.url = url
+        self.user = user
+        self.password = password
+        self.zapi = self._connect()
+        self.host_groups = hostgroups.shared_index()
+        self.lock = None
+        self.lock_options = lock_options()
 
-        from healthcheck.storage import MongoStorage
-        self.storage = MongoStorage()
-        self.storage.conn()
+        from healthcheck.storage import CachedStorage, MongoStorage
+        self.storage = CachedStorage(MongoStorage())
 
+    def _connect(self):
+        from healthcheck.backends.client import ZabbixClient
+        zapi = ZabbixClient(self.url, timeout=float(get_value_or_default("ZABBIX_TIMEOUT", 30)))
+        zapi.login(self.user, self.password)
+        return zapi
+
+    @locked
     def add_url(self, name, url, expected_string=None, comment=None):
         hc = self.storage.find_healthcheck_by_name(name)
-        item_id = self._add_item(name, url, expected_string)
-        trigger_id = self._add_trigger(name, url, comment)
-        action_id = self._add_action(url, trigger_id, hc.group_id)
-        item = Item(
-            url,
-            item_id=item_id,
-            trigger_id=trigger_id,
-            action_id=action_id,
-            group_id=hc.group_id,
-        )
-        self.storage.add_item(item)
+
+        def add_item(context):
+            item = Item(
+                url,
+                item_id=context["item"],
+                trigger_id=context["trigger"],
+                action_id=context["action"],
+                group_id=hc.group_id,
+                expected_string=expected_string,
+                comment=comment or "",
+            )
+            self.storage.add_item(item)
+
+        saga = Saga([
+            Step("item", self._fenced(lambda c: self._add_item(name, url, expected_string)),
+                 lambda c: self.zapi.httptest.delete(c["item"])),
+            Step("trigger", self._fenced(lambda c: self._add_trigger(name, url, comment)),
+                 lambda c: self.zapi.trigger.delete(c["trigger"]), requires=["item"]),
+            Step("action", self._fenced(lambda c: self._add_action(url, c["trigger"], hc.group_id)),
+                 lambda c: self._remove_action(c["action"]), requires=["trigger"]),
+            Step("storage", self._fenced(add_item), requires=["action"]),
+        ], name="add_url")
+        saga.execute()
+
+    @locked
+    def add_urls(self, name, urls):
+        hc = self.storage.find_healthcheck_by_name(name)
+        self._fence()
+        result = self.zapi.httptest.create(*[
+            self._httptest_params(hc, url["url"], url.get("expected_string"))
+            for url in urls
+        ])
+        item_ids = result["httptestids"]
+        action_ids = []
+        try:
+            self._fence()
+            result = self.zapi.trigger.create(*[
+                self._trigger_params(name, url["url"], url.get("comment"))
+                for url in urls
+            ])
+            trigger_ids = result["triggerids"]
+            self._fence()
+            result = self.zapi.action.create(*[
+                self._action_params(url["url"], trigger_id, hc.group_id)
+                for url, trigger_id in zip(urls, trigger_ids)
+            ])
+            action_ids = result["actionids"]
+            items = [
+                Item(
+                    url["url"],
+                    item_id=item_id,
+                    trigger_id=trigger_id,
+                    action_id=action_id,
+                    group_id=hc.group_id,
+                    expected_string=url.get("expected_string"),
+                    comment=url.get("comment") or "",
+                )
+                for url, item_id, trigger_id, action_id
+                in zip(urls, item_ids, trigger_ids, action_ids)
+            ]
+            self._fence()
+            self.storage.add_items(items)
+        except Exception:
+            self._undo_add_urls(item_ids, action_ids)
+            raise
+        return [
+            {
+                "url": item.url,
+                "item_id": item.item_id,
+                "trigger_id": item.trigger_id,
+                "action_id": item.action_id,
+            }
+            for item in items
+        ]
+
+    def _undo_add_urls(self, item_ids, action_ids):
+        # like a saga compensation, the undo gets time of its own when the
+        # request deadline cut add_urls. Triggers go away with their httptests
+        with deadlines.override(deadlines.Deadline(deadlines.request_timeout())):
+            try:
+                self._delete([("action", action_ids), ("httptest", item_ids)])
+            except Exception:
+                logger.exception("failed to undo add_urls of httptests %s", item_ids)
 
     def _add_item(self, healthcheck_name, url, expected_string=None):
         hc = self.storage.find_healthcheck_by_name(healthcheck_name)
+        item_result = self.zapi.httptest.create(
+            **self._httptest_params(hc, url, expected_string)
+        )
+        return item_result['httptestids'][0]
+
+    def _httptest_params(self, hc, url, expected_string=None):
         item_name = self._create_item_name(url)
         step = {"name": item_name, "url": url,
                 "status_codes": "200", "no": 1}
         if expected_string:
             step["required"] = expected_string
-        item_result = self.zapi.httptest.create(
-            name=item_name,
-            steps=[step],
-            hostid=hc.host_id,
-            retries=int(os.environ.get("ZABBIX_RETRIES", 3)),
-        )
-        return item_result['httptestids'][0]
+        return {
+            "name": item_name,
+            "steps": [step],
+            "hostid": hc.host_id,
+            "retries": int(os.environ.get("ZABBIX_RETRIES", 3)),
+        }
 
     def _create_item_name(self, url):
         name = "hc for {}".format(url)
@@ -74,6 +181,12 @@ class Zabbix(object):
         return name
 
     def _add_trigger(self, host_name, url, comment=None):
+        trigger_result = self.zapi.trigger.create(
+            **self._trigger_params(host_name, url, comment)
+        )
+        return trigger_result['triggerids'][0]
+
+    def _trigger_params(self, host_name, url, comment=None):
         item_name = self._create_item_name(url)
         status_expression = ("{{%s:web.test.rspcode[{item_name},"
                              "{item_name}].last()}}<>200") % host_name
@@ -83,44 +196,75 @@ class Zabbix(object):
                              "str(required pattern not found)}}=1") % host_name
         expression = ("%s or %s and %s") % \
             (status_expression, failed_expression, string_expression)
-
-        trigger_result = self.zapi.trigger.create(
-            description="trigger for url {}".format(url),
-            expression=expression.format(item_name=item_name),
-            priority=5,
-            comments=comment,
-        )
-        return trigger_result['triggerids'][0]
-
+        return {
+            "description": "trigger for url {}".format(url),
+            "expression": expression.format(item_name=item_name),
+            "priority": 5,
+            "comments": comment,
+        }
+
+    @locked
     def remove_url(self, name, url):
         item = self.storage.find_item_by_url(url)
-        self._remove_action(item.action_id)
-        self.zapi.httptest.delete(item.item_id)
+        self._fence()
+        self._delete([("action", [item.action_id]), ("httptest", [item.item_id])])
         self.storage.remove_item(item)
 
     def list_urls(self, name):
-        urls_comments = []
-        urls = self.storage.find_urls_by_healthcheck_name(name)
-        for url in urls:
-            url_comment = [url]
-            item = self.storage.find_item_by_url(url)
-            trigger = self.zapi.trigger.get(triggerids=item.trigger_id)
-            url_comment.append(trigger[0].get('comments', ""))
-            urls_comments.append(url_comment)
-        return urls_comments
-
-    def new(self, name):
-        host = self._add_host(name, self.host_group_id)
-        group = self._create_user_group(name, self.host_group_id)
-        hc = HealthCheck(
-            name=name,
-            host_group_id=self.host_group_id,
-            host_groups=[self.host_group_id],
-            host_id=host,
-            group_id=group
+        items = self.storage.find_items_by_healthcheck_name(name)
+        missing = [item for item in items if not hasattr(item, "comment")]
+        if missing:
+            self._fill_comments(missing)
+        return [[item.url, item.comment] for item in items]
+
+    def backfill_comments(self, chunk_size=200):
+        count = 0
+        chunk = []
+        for item in self.storage.find_items_without_comment():
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                count += self._fill_comments(chunk)
+                chunk = []
+        if chunk:
+            count += self._fill_comments(chunk)
+        return count
+
+    def _fill_comments(self, items):
+        triggers = self.zapi.trigger.get(
+            triggerids=[item.trigger_id for item in items],
+            output=["triggerid", "comments"],
         )
-        self.storage.add_healthcheck(hc)
-
+        comments = dict((str(trigger["triggerid"]), trigger.get("comments", ""))
+                        for trigger in triggers)
+        for item in items:
+            item.comment = comments.get(str(item.trigger_id), "")
+        self.storage.update_items_comment(items)
+        return len(items)
+
+    @locked
+    def new(self, name):
+        def add_healthcheck(context):
+            hc = HealthCheck(
+                name=name,
+                host_group_id=self.host_group_id,
+                host_groups=[self.host_group_id],
+                host_id=context["host"],
+                group_id=context["group"]
+            )
+            self.storage.add_healthcheck(hc)
+
+        # the host and the user group do not depend on each other, so they
+        # are created concurrently and each one is removed if the other fails
+        saga = Saga([
+            Step("host", self._fenced(lambda c: self._add_host(name, self.host_group_id)),
+                 lambda c: self._remove_host(c["host"])),
+            Step("group", self._fenced(lambda c: self._create_user_group(name, self.host_group_id)),
+                 lambda c: self._remove_user_group(c["group"])),
+            Step("healthcheck", self._fenced(add_healthcheck), requires=["host", "group"]),
+        ], name="new")
+        saga.execute()
+
+    @locked
     def add_watcher(self, name, email, password=None):
         hc = self.storage.find_healthcheck_by_name(name)
         try:
@@ -138,6 +282,7 @@ class Zabbix(object):
         if user.id in ids:
             raise WatcherAlreadyRegisteredError()
         ids.append(user.id)
+        self._fence()
         self.zapi.usergroup.update(
             usrgrpid=hc.group_id,
             userids=ids,
@@ -145,6 +290,7 @@ class Zabbix(object):
         self.storage.add_user_to_group(user, hc.group_id)
 
     def _add_new_user(self, hc, email, password):
+        self._fence()
         result = self.zapi.user.create(
             alias=email,
             passwd=password,
@@ -166,6 +312,7 @@ class Zabbix(object):
     def list_watchers(self, name):
         return self.storage.find_watchers_by_healthcheck_name(name)
 
+    @locked
     def remove_watcher(self, name, email):
         hc = self.storage.find_healthcheck_by_name(name)
         user = self.storage.find_user_by_email(email)
@@ -179,6 +326,7 @@ class Zabbix(object):
     def _remove_user_from_group(self, hc, user):
         users = self.storage.find_users_by_group(hc.group_id)
         ids = [u.id for u in users if u.id != user.id]
+        self._fence()
         self.zapi.usergroup.update(
             usrgrpid=hc.group_id,
             userids=ids,
@@ -186,30 +334,47 @@ class Zabbix(object):
         self.storage.remove_user_from_group(user, hc.group_id)
 
     def _remove_user(self, user):
+        self._fence()
         self.zapi.user.delete(user.id)
         self.storage.remove_user(user)
 
+    @locked
     def remove(self, name):
-        urls = self.storage.find_urls_by_healthcheck_name(name)
-        for url in urls:
-            self.remove_url(name, url)
-
-        watchers = self.list_watchers(name)
-        for watcher in watchers:
-            self.remove_watcher(name, watcher)
-
         healthcheck = self.storage.find_healthcheck_by_name(name)
-        self._remove_user_group(healthcheck.group_id)
-        self._remove_host(healthcheck.host_id)
+        items = self.storage.find_items_by_group(healthcheck.group_id)
+        watchers = self.storage.find_users_by_group(healthcheck.group_id)
+        exclusive = [w for w in watchers if len(w.groups_id) < 2]
+        self._fence()
+        self._delete([
+            ("action", [item.action_id for item in items]),
+            ("httptest", [item.item_id for item in items]),
+            ("user", [w.id for w in exclusive]),
+        ])
+        self.storage.remove_items_by_group(healthcheck.group_id)
+        self.storage.remove_users(exclusive)
+
+        # the user group can only go away after its exclusive users
+        self._fence()
+        self._delete([
+            ("usergroup", [healthcheck.group_id]),
+            ("host", [healthcheck.host_id]),
+        ])
+        self.storage.remove_group_from_users(healthcheck.group_id)
         self.storage.remove_healthcheck(healthcheck)
 
     def list_service_groups(self, keyword=None):
-        if keyword:
-            groups = self.zapi.hostgroup.get(search={"name": [keyword]}, startSearch=True)
-        else:
-            groups = self.zapi.hostgroup.get()
-        group_names = [group.get('name') for group in groups]
-        return group_names
+        return self._host_group_index().search(keyword)
+
+    def _host_group_index(self):
+        index = self.host_groups
+        if not index.loaded:
+            index.load(self._fetch_host_groups(self.zapi))
+        elif index.stale:
+            index.refresh_async(lambda: self._fetch_host_groups(self._connect()))
+        return index
+
+    def _fetch_host_groups(self, zapi):
+        return zapi.hostgroup.get(output=["groupid", "name"])
 
     def list_groups(self, name):
         hc = self.storage.find_healthcheck_by_name(name)
@@ -217,6 +382,7 @@ class Zabbix(object):
         group_names = [group.get('name') for group in groups]
         return group_names
 
+    @locked
     def add_group(self, name, group):
         hc = self.storage.find_healthcheck_by_name(name)
         host_group_id = self._get_host_group_id(group)
@@ -225,18 +391,21 @@ class Zabbix(object):
     def _add_group_to_instance(self, hc, host_group_id):
         groups = [{"permission": 2, "id": gid} for gid in hc.host_groups]
         groups.append({"permission": 2, "id": host_group_id})
+        self._fence()
         self.zapi.usergroup.update(
             usrgrpid=hc.group_id,
             rights=groups,
         )
         groups = [{"groupid": gid} for gid in hc.host_groups]
         groups.append({"groupid": host_group_id})
+        self._fence()
         self.zapi.host.update(
             hostid=hc.host_id,
             groups=groups,
         )
         return self.storage.add_group_to_instance(hc, host_group_id)
 
+    @locked
     def remove_group(self, name, group):
         hc = self.storage.find_healthcheck_by_name(name)
         try:
@@ -251,12 +420,14 @@ class Zabbix(object):
     def _remove_group_from_instance(self, hc, host_group_id):
         groups = [{"permission": 2, "id": gid}
                   for gid in hc.host_groups if gid != host_group_id]
+        self._fence()
         self.zapi.usergroup.update(
             usrgrpid=hc.group_id,
             rights=groups,
         )
         groups = [{"groupid": gid}
                   for gid in hc.host_groups if gid != host_group_id]
+        self._fence()
         self.zapi.host.update(
             hostid=hc.host_id,
             groups=groups,
@@ -264,14 +435,26 @@ class Zabbix(object):
         self.storage.remove_group_from_instance(hc, host_group_id)
 
     def _get_host_group_id(self, group):
-        result = self.zapi.hostgroup.get(filter={"name": [group]})
+        index = self._host_group_index()
+        host_group_id = index.get_id(group)
+        if host_group_id is not None:
+            return host_group_id
+        result = self.zapi.hostgroup.get(filter={"name": [group]},
+                                         output=["groupid", "name"])
         if result:
+            index.add(result[0]["name"], result[0]["groupid"])
             return result[0]["groupid"]
         else:
             raise GroupNotExists()
 
     def _add_action(self, url, trigger_id, group_id):
         result = self.zapi.action.create(
+            **self._action_params(url, trigger_id, group_id)
+        )
+        return result["actionids"][0]
+
+    def _action_params(self, url, trigger_id, group_id):
+        return dict(
             name="action for url {}".format(url),
             eventsource=0,
             recovery_msg=1,
@@ -313,17 +496,27 @@ class Zabbix(object):
                 }
             ],
         )
-        return result["actionids"][0]
 
     def _create_user_group(self, name, host_group):
         result = self.zapi.usergroup.create(
-            name=name,
-            rights={"permission": 2, "id": host_group},
+            **self._user_group_params(name, host_group)
         )
         return result["usrgrpids"][0]
 
+    def _user_group_params(self, name, host_group):
+        return {
+            "name": name,
+            "rights": {"permission": 2, "id": host_group},
+        }
+
     def _add_host(self, name, host_group):
         result = self.zapi.host.create(
+            **self._host_params(name, host_group)
+        )
+        return result["hostids"][0]
+
+    def _host_params(self, name, host_group):
+        return dict(
             host=name,
             groups=[{"groupid": host_group}],
             interfaces=[{
@@ -335,7 +528,47 @@ class Zabbix(object):
                 "port": "10050"
             }]
         )
-        return result["hostids"][0]
+
+    def _fence(self):
+        if self.lock is not None:
+            self.lock.check()
+
+    def _fenced(self, fn):
+        def run(*args):
+            self._fence()
+            return fn(*args)
+        return run
+
+    def _delete(self, deletes):
+        # a teardown that failed halfway is run again, so objects it already
+        # deleted are skipped instead of failing every retry
+        from healthcheck.backends.client import is_missing
+        deletes = [(name, ids) for name, ids in deletes if ids]
+        try:
+            self._send_deletes(deletes)
+        except ZabbixAPIException as e:
+            if not is_missing(e):
+                raise
+            self._send_deletes(self._existing(deletes))
+
+    def _send_deletes(self, deletes):
+        with self.zapi.batch() as batch:
+            for name, ids in deletes:
+                getattr(batch, name).delete(*ids)
+
+    def _existing(self, deletes):
+        with self.zapi.batch() as batch:
+            calls = [
+                (name, getattr(batch, name).get(output=[ID_FIELDS[name]],
+                                                **{ID_FIELDS[name] + "s": ids}))
+                for name, ids in deletes
+            ]
+        existing = []
+        for name, call in calls:
+            ids = [obj[ID_FIELDS[name]] for obj in call.result]
+            if ids:
+                existing.append((name, ids))
+        return existing
 
     def _remove_host(self, id):
         self.zapi.host.delete(id)
@@ -347,6 +580,34 @@ class Zabbix(object):
         self.zapi.action.delete(id)
 
 
+class MongoReader(object):
+    # answers the reads kept in mongodb while zabbix is unavailable, host
+    # group names come from the index loaded before the outage
+
+    def __init__(self, storage, host_groups):
+        self.storage = storage
+        self.host_groups = host_groups
+
+    def list_urls(self, name):
+        items = self.storage.find_items_by_healthcheck_name(name)
+        return [[item.url, getattr(item, "comment", "")] for item in items]
+
+    def list_watchers(self, name):
+        return self.storage.find_watchers_by_healthcheck_name(name)
+
+    def list_groups(self, name):
+        hc = self.storage.find_healthcheck_by_name(name)
+        return self._index().names(hc.host_groups)
+
+    def list_service_groups(self, keyword=None):
+        return self._index().search(keyword)
+
+    def _index(self):
+        if not self.host_groups.loaded:
+            raise ZabbixUnavailableError(shared_breaker().retry_after())
+        return self.host_groups
+
+
 class WatcherAlreadyRegisteredError(Exception):
     pass
 
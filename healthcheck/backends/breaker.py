@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from healthcheck import metrics
+from healthcheck.deadlines import DeadlineExceededError
+from healthcheck.backends.governor import ZabbixOverloadedError
+
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class ZabbixUnavailableError(Exception):
+
+    def __init__(self, retry_after):
+        super(ZabbixUnavailableError, self).__init__(
+            "zabbix is unavailable, retry in {:.0f}s".format(retry_after))
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.time())
+
+    def available(self):
+        # whether a call could go through now, without taking the probe
+        with self.lock:
+            return self.state == CLOSED or \
+                (self.state == OPEN and self.retry_after() <= 0)
+
+    def before_call(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and self.retry_after() <= 0:
+                # a single call probes zabbix, the others keep failing fast
+                # until it answers
+                self.transition(HALF_OPEN)
+                return
+            metrics.registry.inc("hcaas_zabbix_breaker_rejected_total", ())
+            raise ZabbixUnavailableError(max(self.retry_after(), 1))
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self.opened_at = None
+                self.transition(CLOSED)
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or \
+                    (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.time()
+                self.transition(OPEN)
+
+    def cancelled(self):
+        # the call never got an answer that says anything about zabbix, a
+        # probe gives its turn back
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.transition(OPEN)
+
+    def transition(self, state):
+        if state != self.state:
+            logger.warning("zabbix circuit breaker %s -> %s", self.state, state)
+            self.state = state
+            metrics.registry.inc("hcaas_zabbix_breaker_transitions_total",
+                                 metrics.labels(state=state))
+
+    @contextlib.contextmanager
+    def call(self):
+        self.before_call()
+        # a call interrupted by a BaseException, like a gevent Timeout, is
+        # cancelled so a probe never leaves the breaker half open
+        outcome = self.cancelled
+        try:
+            yield
+            outcome = self.succeeded
+        except requests.RequestException:
+            outcome = self.failed
+            raise
+        except (ZabbixOverloadedError, DeadlineExceededError):
+            raise
+        except Exception:
+            # zabbix answered, even if with an error
+            outcome = self.succeeded
+            raise
+        finally:
+            outcome()
+
+    def gauges(self):
+        return [("hcaas_zabbix_breaker_open", (), 0 if self.state == CLOSED else 1)]
+
+
+_breaker = None
+
+
+def shared_breaker():
+    global _breaker
+    if _breaker is None:
+        _breaker = CircuitBreaker(
+            failure_threshold=int(os.environ.get("ZABBIX_BREAKER_FAILURES", 5)),
+            reset_timeout=float(os.environ.get("ZABBIX_BREAKER_RESET_TIMEOUT", 30)),
+        )
+    return _breaker
+
+
+def gauges():
+    if _breaker is None:
+        return []
+    return _breaker.gauges()
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import time
+
+import requests
+from pyzabbix import ZabbixAPI, ZabbixAPIException
+
+from healthcheck import deadlines, metrics
+from healthcheck.backends import breaker, governor, retry
+
+
+SESSION_EXPIRED_MESSAGES = (
+    "Session terminated",
+    "Not authorised",
+    "Not authorized",
+)
+
+
+def is_session_expired(exc):
+    message = u"{}".format(exc)
+    return any(msg in message for msg in SESSION_EXPIRED_MESSAGES)
+
+
+def is_missing(exc):
+    return "does not exist" in u"{}".format(exc)
+
+
+def error_message(error):
+    return "Error {code}: {message}, {data}".format(
+        code=error["code"],
+        message=error["message"],
+        data=error.get("data", "No data"),
+    )
+
+
+class BatchCall(object):
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.result = None
+        self.error = None
+
+
+class BatchObject(object):
+
+    def __init__(self, name, batch):
+        self.name = name
+        self.batch = batch
+
+    def __getattr__(self, attr):
+        def fn(*args, **kwargs):
+            if args and kwargs:
+                raise TypeError("Found both args and kwargs")
+            return self.batch.add("{0}.{1}".format(self.name, attr),
+                                  args or kwargs)
+        return fn
+
+
+class Batch(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def add(self, method, params):
+        call = BatchCall(method, params)
+        self.calls.append(call)
+        return call
+
+    def __getattr__(self, attr):
+        return BatchObject(attr, self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.client.send_batch(self.calls)
+
+
+class ZabbixClient(ZabbixAPI):
+
+    def __init__(self, *args, **kwargs):
+        super(ZabbixClient, self).__init__(*args, **kwargs)
+        self.credentials = None
+        self.logins = 0
+        self.governor = governor.shared_governor()
+        self.breaker = breaker.shared_breaker()
+        self.retry = retry.shared_retry()
+
+    @property
+    def timeout(self):
+        # each call waits at most what is left of the request deadline
+        timeout = deadlines.remaining(self.default_timeout)
+        if timeout is None:
+            return None
+        return max(timeout, 0.001)
+
+    @timeout.setter
+    def timeout(self, value):
+        self.default_timeout = value
+
+    def login(self, user='', password=''):
+        self.credentials = (user, password)
+        super(ZabbixClient, self).login(user, password)
+        self.logins += 1
+
+    def do_request(self, method, params=None):
+        try:
+            return self._retried_request(method, params)
+        except ZabbixAPIException as e:
+            if not self._can_relogin(method, e):
+                raise
+        self.login(*self.credentials)
+        return self._retried_request(method, params)
+
+    def _retried_request(self, method, params):
+        attempts = []
+
+        def attempt():
+            attempts.append(method)
+            try:
+                return self._timed_request(method, params)
+            except ZabbixAPIException as e:
+                # the attempt that failed on the way back had deleted it
+                if len(attempts) > 1 and method.endswith(".delete") and is_missing(e):
+                    return {"result": {}}
+                raise
+        return self.retry.call(method, retry.idempotent(method), attempt)
+
+    def _timed_request(self, method, params):
+        deadlines.check("zabbix", method)
+        with self.breaker.call(), self.governor.call(method):
+            start = time.time()
+            error = True
+            try:
+                with deadlines.translate("zabbix", method, requests.Timeout):
+                    result = super(ZabbixClient, self).do_request(method, params)
+                error = False
+                return result
+            finally:
+                metrics.observe_call("zabbix", method, time.time() - start, error)
+
+    def batch(self):
+        return Batch(self)
+
+    def send_batch(self, calls):
+        if not calls:
+            return
+        self._retried_batch(calls)
+        errors = [call.error for call in calls if call.error is not None]
+        if errors and all(self._can_relogin(call.method, call.error)
+                          for call in calls if call.error is not None):
+            self.login(*self.credentials)
+            self._retried_batch(calls)
+            errors = [call.error for call in calls if call.error is not None]
+        if errors:
+            raise errors[0]
+
+    def _retried_batch(self, calls):
+        safe = all(retry.idempotent(call.method) for call in calls)
+        self.retry.call("batch", safe, self._send_batch, calls)
+
+    def _send_batch(self, calls):
+        deadlines.check("zabbix", "batch")
+        with self.breaker.call(), self.governor.call("batch"):
+            start = time.time()
+            error = True
+            try:
+                with deadlines.translate("zabbix", "batch", requests.Timeout):
+                    self._post_batch(calls)
+                error = any(call.error is not None for call in calls)
+            finally:
+                metrics.observe_call("zabbix", "batch", time.time() - start, error)
+                for call in calls:
+                    metrics.registry.inc("hcaas_zabbix_batched_calls_total",
+                                         (("method", call.method),))
+
+    def _post_batch(self, calls):
+        payload = []
+        for i, call in enumerate(calls):
+            request_json = {
+                "jsonrpc": "2.0",
+                "method": call.method,
+                "params": call.params or {},
+                "id": self.id + i,
+            }
+            if self.auth:
+                request_json["auth"] = self.auth
+            payload.append(request_json)
+        response = self.session.post(
+            self.url,
+            data=json.dumps(payload),
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        if not len(response.text):
+            raise ZabbixAPIException("Received empty response")
+        try:
+            responses = json.loads(response.text)
+        except ValueError:
+            raise ZabbixAPIException(
+                "Unable to parse json: %s" % response.text
+            )
+        if isinstance(responses, dict):
+            responses = [responses]
+        by_id = dict((r.get("id"), r) for r in responses)
+        for request_json, call in zip(payload, calls):
+            result = by_id.get(request_json["id"])
+            call.result = call.error = None
+            if result is None:
+                call.error = ZabbixAPIException(
+                    "No response for {}".format(call.method))
+            elif "error" in result:
+                call.error = ZabbixAPIException(
+                    error_message(result["error"]), result["error"]["code"])
+            else:
+                call.result = result["result"]
+        self.id += len(calls)
+
+    def _can_relogin(self, method, exc):
+        return (self.credentials is not None and
+                method not in ("user.login", "user.authenticate") and
+                is_session_expired(exc))
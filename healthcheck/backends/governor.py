@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import contextlib
+import math
+import os
+import threading
+import time
+
+import requests
+
+from healthcheck import deadlines, metrics
+
+
+class ZabbixOverloadedError(Exception):
+
+    def __init__(self, method, reason, retry_after):
+        super(ZabbixOverloadedError, self).__init__(
+            "{} not sent to zabbix ({}), retry in {:.1f}s".format(method, reason, retry_after))
+        self.method = method
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self, max_wait):
+        # takes a token ahead of time and returns how long the caller must
+        # wait for it, tokens go negative while callers are queued
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if wait > max_wait:
+                return None, wait
+            self.tokens -= 1
+            return wait, wait
+
+
+class AdaptiveLimit(object):
+    # AIMD: the limit grows by one every limit calls answered in time and is
+    # cut when zabbix is slower than the target or fails
+
+    def __init__(self, initial, minimum, maximum, target_latency, decrease=0.7):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.decrease = decrease
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self, deadline):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self, latency, overloaded):
+        with self.cond:
+            self.in_flight -= 1
+            now = time.time()
+            if overloaded or latency > self.target_latency:
+                # the calls in flight when zabbix slowed down all come back
+                # slow, only the first one cuts the limit
+                if now - self.last_decrease > self.target_latency:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self.cond.notify()
+
+
+class Governor(object):
+
+    def __init__(self, rate=0, burst=None, max_in_flight=10, min_in_flight=1,
+                 target_latency=2.0, max_wait=5.0):
+        self.bucket = TokenBucket(rate, burst or max(rate, 1)) if rate else None
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min_in_flight
+        self.target_latency = target_latency
+        self.max_wait = max_wait
+        self.limits = {}
+        self.lock = threading.Lock()
+
+    def limit(self, method):
+        with self.lock:
+            limit = self.limits.get(method)
+            if limit is None:
+                limit = self.limits[method] = AdaptiveLimit(
+                    self.max_in_flight, self.min_in_flight, self.max_in_flight,
+                    self.target_latency)
+            return limit
+
+    def reject(self, method, reason, retry_after):
+        metrics.registry.inc("hcaas_zabbix_rejected_total",
+                             metrics.labels(method=method, reason=reason))
+        raise ZabbixOverloadedError(method, reason, retry_after)
+
+    @contextlib.contextmanager
+    def call(self, method):
+        start = time.time()
+        # no point queueing past the deadline of the request
+        max_wait = deadlines.remaining(self.max_wait)
+        deadline = start + max_wait
+        if self.bucket is not None:
+            wait, retry_after = self.bucket.reserve(max_wait)
+            if wait is None:
+                self.reject(method, "rate", retry_after)
+            if wait > 0:
+                time.sleep(wait)
+        limit = self.limit(method)
+        if not limit.acquire(deadline):
+            self.reject(method, "concurrency", self.target_latency)
+        metrics.registry.observe("hcaas_zabbix_queue_seconds", metrics.labels(method=method),
+                                 time.time() - start)
+        sent = time.time()
+        overloaded = False
+        try:
+            yield
+        except requests.RequestException:
+            overloaded = True
+            raise
+        finally:
+            limit.release(time.time() - sent, overloaded)
+
+    def gauges(self):
+        with self.lock:
+            limits = list(self.limits.items())
+        values = []
+        for method, limit in sorted(limits):
+            labels = (("method", method),)
+            values.append(("hcaas_zabbix_concurrency_limit", labels, math.floor(limit.limit)))
+            values.append(("hcaas_zabbix_in_flight", labels, limit.in_flight))
+        return values
+
+
+_governor = None
+
+
+def shared_governor():
+    global _governor
+    if _governor is None:
+        # the rate limit is shared by every process that talks to zabbix,
+        # each one keeps its own token bucket with a fair share of it
+        processes = max(int(os.environ.get("ZABBIX_PROCESSES", 1)), 1)
+        _governor = Governor(
+            rate=float(os.environ.get("ZABBIX_RATE_LIMIT", 0)) / processes,
+            burst=float(os.environ.get("ZABBIX_RATE_BURST", 0)) / processes or None,
+            max_in_flight=int(os.environ.get("ZABBIX_MAX_IN_FLIGHT", 10)),
+            target_latency=float(os.environ.get("ZABBIX_TARGET_LATENCY", 2)),
+            max_wait=float(os.environ.get("ZABBIX_QUEUE_TIMEOUT", 5)),
+        )
+    return _governor
+
+
+def gauges():
+    if _governor is None:
+        return []
+    return _governor.gauges()
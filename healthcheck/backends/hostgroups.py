@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import bisect
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class HostGroupIndex(object):
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # keys holds the sorted lowercased names and entries the matching
+        # (name, groupid) pairs. Both are replaced together, never mutated.
+        self.snapshot = ([], [])
+        self.ids = {}
+        self.loaded_at = None
+        self.refreshing = False
+        self.refreshes = 0
+
+    @property
+    def loaded(self):
+        return self.loaded_at is not None
+
+    @property
+    def stale(self):
+        return not self.loaded or time.time() - self.loaded_at > self.ttl
+
+    def load(self, groups):
+        entries = sorted((g["name"].lower(), g["name"], g["groupid"])
+                         for g in groups)
+        keys = [key for key, _, _ in entries]
+        ids = dict((name, groupid) for _, name, groupid in entries)
+        with self.lock:
+            self.snapshot = (keys, [(name, groupid) for _, name, groupid in entries])
+            self.ids = ids
+            self.loaded_at = time.time()
+            self.refreshes += 1
+
+    def refresh_async(self, fetch):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        thread = threading.Thread(target=self._refresh, args=(fetch,))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self, fetch):
+        try:
+            self.load(fetch())
+        except Exception:
+            logger.exception("failed to refresh the host group index")
+        finally:
+            self.refreshing = False
+
+    def add(self, name, groupid):
+        key = name.lower()
+        with self.lock:
+            if name in self.ids:
+                return
+            keys, entries = list(self.snapshot[0]), list(self.snapshot[1])
+            index = bisect.bisect_left(keys, key)
+            keys.insert(index, key)
+            entries.insert(index, (name, groupid))
+            ids = dict(self.ids)
+            ids[name] = groupid
+            self.snapshot = (keys, entries)
+            self.ids = ids
+
+    def get_id(self, name):
+        return self.ids.get(name)
+
+    def names(self, ids):
+        ids = set(ids)
+        return [name for name, groupid in self.snapshot[1] if groupid in ids]
+
+    def search(self, prefix=None):
+        keys, entries = self.snapshot
+        if not prefix:
+            return [name for name, _ in entries]
+        prefix = prefix.lower()
+        names = []
+        index = bisect.bisect_left(keys, prefix)
+        while index < len(keys) and keys[index].startswith(prefix):
+            names.append(entries[index][0])
+            index += 1
+        return names
+
+
+_index = None
+
+
+def shared_index():
+    global _index
+    if _index is None:
+        ttl = float(os.environ.get("ZABBIX_HOST_GROUP_CACHE_TTL", 300))
+        _index = HostGroupIndex(ttl=ttl)
+    return _index
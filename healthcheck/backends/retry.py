@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+from healthcheck import deadlines, metrics
+
+
+# actions that leave zabbix in the same state however many times they run,
+# deletes and updates only touch the ids they are given
+IDEMPOTENT_ACTIONS = ("get", "version", "login", "update", "delete")
+
+
+def idempotent(method):
+    return method.rsplit(".", 1)[-1] in IDEMPOTENT_ACTIONS
+
+
+def transient(error):
+    if isinstance(error, requests.HTTPError):
+        response = error.response
+        return response is None or response.status_code >= 500 or response.status_code == 429
+    return isinstance(error, requests.RequestException)
+
+
+def not_sent(error):
+    # zabbix never saw the request, so even a create can be sent again
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class RetryBudget(object):
+    # retries add at most ratio of the calls on top of them, the reserve lets
+    # a quiet process retry its first failures
+
+    def __init__(self, ratio=0.1, reserve=10):
+        self.ratio = ratio
+        self.reserve = float(reserve)
+        self.tokens = self.reserve
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class RetryPolicy(object):
+
+    def __init__(self, attempts=3, backoff=0.1, max_backoff=2.0, budget=None):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget or RetryBudget()
+
+    def delay(self, attempt):
+        # full jitter, callers that failed together do not retry together
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def skip(self, method, reason):
+        metrics.registry.inc("hcaas_zabbix_retries_skipped_total",
+                             metrics.labels(method=method, reason=reason))
+
+    def call(self, method, safe, fn, *args):
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                return fn(*args)
+            except requests.RequestException as e:
+                if not transient(e):
+                    raise
+                if not safe and not not_sent(e):
+                    self.skip(method, "unsafe")
+                    raise
+                if attempt + 1 >= self.attempts:
+                    self.skip(method, "attempts")
+                    raise
+                delay = self.delay(attempt)
+                if deadlines.remaining(delay) < delay:
+                    self.skip(method, "deadline")
+                    raise
+                if not self.budget.withdraw():
+                    self.skip(method, "budget")
+                    raise
+            metrics.registry.inc("hcaas_zabbix_retries_total", metrics.labels(method=method))
+            time.sleep(delay)
+            attempt += 1
+
+
+_retry = None
+
+
+def shared_retry():
+    global _retry
+    if _retry is None:
+        _retry = RetryPolicy(
+            attempts=int(os.environ.get("ZABBIX_RETRY_ATTEMPTS", 3)),
+            backoff=float(os.environ.get("ZABBIX_RETRY_BACKOFF", 0.1)),
+            max_backoff=float(os.environ.get("ZABBIX_RETRY_MAX_BACKOFF", 2)),
+            budget=RetryBudget(ratio=float(os.environ.get("ZABBIX_RETRY_BUDGET", 0.1))),
+        )
+    return _retry
@@ -0,0 +1,143 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import flask
+
+from healthcheck import metrics
+
+
+class Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Group(object):
+    # runs a function once for all the callers that ask for the same key
+    # while it is running
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class ResultCache(object):
+
+    def __init__(self, max_entries=1000):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.time():
+                del self.entries[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries.pop(key, None)
+            while len(self.entries) >= self.max_entries:
+                self.entries.popitem(last=False)
+            self.entries[key] = (time.time() + ttl, value)
+
+    def invalidate(self, name):
+        with self.lock:
+            for key in [k for k in self.entries if k[1] == name]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+group = Group()
+cache = ResultCache()
+
+
+def cache_ttl():
+    return float(os.environ.get("API_READ_CACHE_TTL", 0))
+
+
+def request_key():
+    request = flask.request
+    return (
+        request.url_rule.rule,
+        request.view_args.get("name"),
+        tuple(sorted(request.view_args.items())),
+        tuple(sorted(request.args.items(multi=True))),
+        request.headers.get("Accept"),
+    )
+
+
+def observe(outcome):
+    route = flask.request.url_rule.rule
+    metrics.registry.inc("hcaas_read_requests_total", metrics.labels(route=route, outcome=outcome))
+
+
+def invalidate(name):
+    cache.invalidate(name)
+
+
+def coalesced(fn):
+    # identical reads running at the same time share one call to the
+    # manager, and with API_READ_CACHE_TTL their response is reused for a
+    # few seconds
+    @functools.wraps(fn)
+    def decorated(*args, **kwargs):
+        key = request_key()
+        ttl = cache_ttl()
+        result = cache.get(key) if ttl > 0 else None
+        if result is not None:
+            observe("cached")
+        else:
+            def compute():
+                response = flask.make_response(fn(*args, **kwargs))
+                return (response.get_data(), response.status_code, list(response.headers.items()),
+                        flask.g.get("degraded", False))
+            result, shared = group.do(key, compute)
+            observe("coalesced" if shared else "computed")
+            # answers given without zabbix are not worth keeping
+            if not shared and ttl > 0 and result[1] == 200 and not result[3]:
+                cache.set(key, result, ttl)
+        body, status, headers, degraded = result
+        if degraded:
+            flask.g.degraded = True
+        return flask.Response(body, status, headers)
+    return decorated
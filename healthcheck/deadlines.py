@@ -0,0 +1,121 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import contextlib
+import os
+import threading
+import time
+
+import flask
+
+from healthcheck import metrics
+
+
+HEADER = "X-Request-Timeout"
+
+
+class DeadlineExceededError(Exception):
+
+    def __init__(self, kind, name):
+        super(DeadlineExceededError, self).__init__(
+            "deadline exceeded before {} {}".format(kind, name))
+        self.kind = kind
+        self.name = name
+
+
+class Deadline(object):
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires_at = time.time() + timeout
+
+    def remaining(self):
+        return self.expires_at - time.time()
+
+    def check(self, kind, name):
+        if self.remaining() <= 0:
+            metrics.registry.inc("hcaas_deadline_exceeded_total", metrics.labels(kind=kind))
+            raise DeadlineExceededError(kind, name)
+
+
+def request_timeout():
+    return float(os.environ.get("API_REQUEST_TIMEOUT", 30))
+
+
+def from_headers(headers):
+    # callers can ask for a shorter deadline, never for a longer one
+    timeout = request_timeout()
+    try:
+        asked = float(headers.get(HEADER, ""))
+    except ValueError:
+        asked = 0
+    if asked > 0:
+        timeout = min(timeout, asked)
+    return Deadline(timeout)
+
+
+_local = threading.local()
+
+
+def current():
+    deadline = getattr(_local, "deadline", None)
+    if deadline is not None:
+        return deadline
+    if flask.has_request_context():
+        return flask.g.get("deadline")
+
+
+def bind(fn):
+    deadline = current()
+
+    def run(*args, **kwargs):
+        _local.deadline = deadline
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.deadline = None
+    return run
+
+
+@contextlib.contextmanager
+def override(deadline):
+    previous = getattr(_local, "deadline", None)
+    _local.deadline = deadline
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def remaining(default=None):
+    # the time budget of a call, bounded by its own default timeout
+    deadline = current()
+    if deadline is None:
+        return default
+    left = max(deadline.remaining(), 0.0)
+    return left if default is None else min(default, left)
+
+
+def expired():
+    deadline = current()
+    return deadline is not None and deadline.remaining() <= 0
+
+
+def check(kind, name):
+    deadline = current()
+    if deadline is not None:
+        deadline.check(kind, name)
+
+
+@contextlib.contextmanager
+def translate(kind, name, errors):
+    # a dependency that timed out because the request ran out of time is
+    # reported as the deadline, not as a failure of the dependency
+    try:
+        yield
+    except errors:
+        if expired():
+            metrics.registry.inc("hcaas_deadline_exceeded_total", metrics.labels(kind=kind))
+            raise DeadlineExceededError(kind, name)
+        raise
@@ -0,0 +1,96 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import functools
+import hashlib
+import os
+
+import flask
+
+from healthcheck import metrics
+from healthcheck.storage import IdempotencyKey, IdempotencyKeyNotFoundError
+
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+# seconds a request owns its key before a retry may run it again, longer
+# than any request is allowed to take
+PROCESSING_LEASE = 300
+# response headers replayed along with the stored body
+REPLAYED_HEADERS = ("Content-Type", "Location")
+
+
+def fingerprint(request):
+    digest = hashlib.sha256()
+    digest.update(request.method.encode("utf-8") + b"\n")
+    digest.update(request.path.encode("utf-8") + b"\n")
+    digest.update(request.get_data() + b"\n")
+    for key, value in sorted(request.form.items(multi=True)):
+        digest.update(u"{}={}\n".format(key, value).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def observe(outcome):
+    metrics.registry.inc("hcaas_idempotency_requests_total", metrics.labels(outcome=outcome))
+
+
+def stored_response(response):
+    headers = [(name, response.headers[name]) for name in REPLAYED_HEADERS
+               if name in response.headers]
+    return {
+        "status": response.status_code,
+        "body": response.get_data(as_text=True),
+        "headers": headers,
+    }
+
+
+def replay(record):
+    response = flask.Response(record.response["body"], record.response["status"])
+    for name, value in record.response["headers"]:
+        response.headers[name] = value
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def idempotent(fn):
+    # a retried request with the same key gets the stored response instead
+    # of running again
+    @functools.wraps(fn)
+    def decorated(*args, **kwargs):
+        key = flask.request.headers.get(HEADER)
+        if not key:
+            return fn(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return "{} must have at most {} characters".format(HEADER, MAX_KEY_LENGTH), 400
+        from healthcheck.api import get_storage
+        storage = get_storage()
+        record = IdempotencyKey(key, fingerprint(flask.request), lease=PROCESSING_LEASE,
+                                ttl=float(os.environ.get("IDEMPOTENCY_TTL", 24 * 60 * 60)))
+        if not storage.add_idempotency_key(record):
+            try:
+                existing = storage.find_idempotency_key(key)
+            except IdempotencyKeyNotFoundError:
+                existing = None
+            if existing is not None and existing.fingerprint != record.fingerprint:
+                observe("mismatch")
+                return "{} was already used by a different request".format(HEADER), 422
+            if existing is not None and existing.status == "done":
+                observe("replayed")
+                return replay(existing)
+            if existing is None or not storage.claim_idempotency_key(record):
+                observe("conflict")
+                return "a request with this {} is in progress".format(HEADER), 409
+        try:
+            response = flask.make_response(fn(*args, **kwargs))
+        except Exception:
+            storage.remove_idempotency_key(record)
+            raise
+        # failures are not stored so the retry runs the request again
+        if response.status_code >= 500:
+            storage.remove_idempotency_key(record)
+        else:
+            storage.finish_idempotency_key(record, stored_response(response))
+            observe("stored")
+        return response
+    return decorated
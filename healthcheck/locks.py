@@ -0,0 +1,118 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import functools
+import logging
+import os
+import random
+import threading
+import time
+
+from healthcheck import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class LockTimeoutError(Exception):
+    pass
+
+
+class LockLostError(Exception):
+    pass
+
+
+class InstanceLock(object):
+
+    def __init__(self, storage, name, ttl=120, timeout=30, poll_interval=0.01,
+                 max_poll_interval=0.25):
+        self.storage = storage
+        self.name = name
+        self.ttl = ttl
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.token = None
+        self.stopped = None
+
+    def acquire(self):
+        start = time.time()
+        interval = self.poll_interval
+        outcome = "timeout"
+        try:
+            while True:
+                self.token = self.storage.acquire_lock(self.name, self.ttl)
+                if self.token is not None:
+                    outcome = "acquired"
+                    self.start_heartbeat()
+                    return self.token
+                if time.time() - start >= self.timeout:
+                    raise LockTimeoutError(self.name)
+                time.sleep(interval * random.uniform(0.5, 1.5))
+                interval = min(interval * 2, self.max_poll_interval)
+        finally:
+            metrics.registry.observe("hcaas_lock_wait_seconds", metrics.labels(outcome=outcome),
+                                     time.time() - start)
+
+    def start_heartbeat(self):
+        self.stopped = threading.Event()
+        thread = threading.Thread(target=self.heartbeat, args=(self.token, self.stopped))
+        thread.daemon = True
+        thread.start()
+
+    def heartbeat(self, token, stopped):
+        # renews the lease while the holder works, a change that runs longer
+        # than the ttl is not overtaken by the next one
+        interval = max(self.ttl / 3.0, 0.01)
+        while not stopped.wait(interval):
+            try:
+                if not self.storage.renew_lock(self.name, token, self.ttl):
+                    return
+            except Exception:
+                logger.exception("failed to renew the lock of %s", self.name)
+
+    def check(self):
+        # called before writes that replace whole lists in zabbix, a holder
+        # whose lease expired must not overwrite what the next one did
+        if not self.storage.renew_lock(self.name, self.token, self.ttl):
+            metrics.registry.inc("hcaas_lock_lost_total", ())
+            raise LockLostError(self.name)
+
+    def release(self):
+        if self.stopped is not None:
+            self.stopped.set()
+            self.stopped = None
+        if self.token is not None:
+            self.storage.release_lock(self.name, self.token)
+            self.token = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def lock_options():
+    return {
+        "ttl": float(os.environ.get("INSTANCE_LOCK_TTL", 120)),
+        "timeout": float(os.environ.get("INSTANCE_LOCK_TIMEOUT", 30)),
+    }
+
+
+def locked(method):
+    # serializes the mutations of an instance, the instance name is the
+    # first argument of every manager method
+    @functools.wraps(method)
+    def wrapper(self, name, *args, **kwargs):
+        if self.lock is not None:
+            return method(self, name, *args, **kwargs)
+        with InstanceLock(self.storage, name, **self.lock_options) as lock:
+            self.lock = lock
+            try:
+                return method(self, name, *args, **kwargs)
+            finally:
+                self.lock = None
+    return wrapper
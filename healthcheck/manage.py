@@ -0,0 +1,101 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import sys
+
+
+def get_manager():
+    from healthcheck.backends import Zabbix
+    return Zabbix()
+
+
+def backfill_comments(chunk_size="200"):
+    """
+    backfill-comments copies the trigger comment of every url added before
+    comments were stored in mongodb. Usage:
+
+        python -m healthcheck.manage backfill-comments [chunk-size]
+
+    chunk-size is the number of triggers fetched by each trigger.get call.
+    """
+    count = get_manager().backfill_comments(int(chunk_size))
+    sys.stdout.write("{} items updated\n".format(count))
+
+
+def ensure_indexes():
+    """
+    ensure-indexes creates the indexes used by the storage queries. Creating
+    an index that already exists is a no-op. Usage:
+
+        python -m healthcheck.manage ensure-indexes
+    """
+    from healthcheck.storage import MongoStorage
+    for name in MongoStorage().ensure_indexes():
+        sys.stdout.write("{}\n".format(name))
+
+
+def check_indexes():
+    """
+    check-indexes lists the missing indexes and the storage queries that no
+    index covers. It exits with 1 when an index is missing. Usage:
+
+        python -m healthcheck.manage check-indexes
+    """
+    from healthcheck.storage import MongoStorage
+    report = MongoStorage().check_indexes()
+    for collection, keys in report["missing"]:
+        fields = ", ".join(field for field, _ in keys)
+        sys.stdout.write("missing index {} ({})\n".format(collection, fields))
+    for collection, fields, query in report["uncovered"]:
+        sys.stdout.write("query {} on {} ({}) is not covered by an index\n".format(
+            query, collection, ", ".join(fields)))
+    if report["missing"]:
+        sys.exit(1)
+
+
+def show_help(command_name=None, exit=0):
+    """
+    help displays the help of the specified command. Usage:
+
+        python -m healthcheck.manage help [command-name]
+    """
+    commands = _get_commands()
+    if command_name and command_name in commands:
+        command = commands[command_name]
+        sys.stderr.write(command.__doc__.lstrip("\n").rstrip() + "\n")
+        sys.exit(exit)
+    sys.stderr.write("Usage: python -m healthcheck.manage command [args]\n\n")
+    sys.stderr.write("Available commands:\n")
+    for name in sorted(commands.keys()):
+        sys.stderr.write("  {}\n".format(name))
+    sys.exit(exit)
+
+
+def _get_commands():
+    return {
+        "backfill-comments": backfill_comments,
+        "check-indexes": check_indexes,
+        "ensure-indexes": ensure_indexes,
+        "help": show_help,
+    }
+
+
+def command(command_name):
+    commands = _get_commands()
+    if command_name in commands:
+        return commands[command_name]
+    show_help(exit=2)
+
+
+def main(cmd, *args):
+    try:
+        command(cmd)(*args)
+    except TypeError:
+        show_help(cmd, exit=2)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        show_help(exit=2)
+    main(sys.argv[1], *sys.argv[2:])
@@ -0,0 +1,305 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import atexit
+import bisect
+import contextlib
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+# file keeping the counters and histograms of the workers that exited
+ARCHIVE = "archive.json"
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CALL_METRICS = {
+    "zabbix": ("hcaas_zabbix_call_duration_seconds",
+               "hcaas_zabbix_call_errors_total"),
+    "mongo": ("hcaas_storage_call_duration_seconds",
+              "hcaas_storage_call_errors_total"),
+}
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauge_callbacks = []
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        index = bisect.bisect_left(BUCKETS, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+            histogram[0][index] += 1
+            histogram[1] += value
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def register_gauges(self, callback):
+        self.gauge_callbacks.append(callback)
+
+    def gauges(self):
+        values = []
+        for callback in self.gauge_callbacks:
+            values.extend(callback())
+        return values
+
+    def snapshot(self):
+        with self.lock:
+            histograms = [[name, list(labels), list(h[0]), h[1]]
+                          for (name, labels), h in self.histograms.items()]
+            counters = [[name, list(labels), value]
+                        for (name, labels), value in self.counters.items()]
+        gauges = [[name, list(labels), value] for name, labels, value in self.gauges()]
+        return {
+            "pid": os.getpid(),
+            "token": token(),
+            "histograms": histograms,
+            "counters": counters,
+            "gauges": gauges,
+        }
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+
+registry = Registry()
+listeners = []
+_last_flush = 0.0
+_tokens = {}
+_flusher = None
+
+
+def labels(**kwargs):
+    return tuple(sorted(kwargs.items()))
+
+
+def observe_call(kind, method, duration, error=False):
+    duration_metric, errors_metric = CALL_METRICS[kind]
+    method_labels = (("method", method),)
+    registry.observe(duration_metric, method_labels, duration)
+    if error:
+        registry.inc(errors_metric, method_labels)
+    for listener in listeners:
+        listener(kind, method, duration, error)
+
+
+def observe_request(route, method, status, duration):
+    request_labels = labels(route=route, method=method)
+    registry.observe("hcaas_http_request_duration_seconds", request_labels, duration)
+    if status >= 500:
+        registry.inc("hcaas_http_request_errors_total", request_labels)
+
+
+def metrics_dir():
+    return os.environ.get("METRICS_DIR")
+
+
+def flush_interval():
+    return float(os.environ.get("METRICS_FLUSH_INTERVAL", 1))
+
+
+def token():
+    # pids are reused, the token tells apart the files of two processes
+    # that had the same pid
+    return _tokens.setdefault(os.getpid(), uuid.uuid4().hex[:8])
+
+
+def flush(force=False):
+    global _last_flush
+    directory = metrics_dir()
+    if not directory:
+        return
+    start_flusher()
+    now = time.time()
+    if not force and now - _last_flush < flush_interval():
+        return
+    _last_flush = now
+    path = os.path.join(directory, "{}-{}.json".format(os.getpid(), token()))
+    write(path, registry.snapshot())
+
+
+def start_flusher():
+    # samples recorded after the last request of an idle worker are
+    # written by a background thread and when the worker exits
+    global _flusher
+    if _flusher == os.getpid():
+        return
+    _flusher = pid = os.getpid()
+    thread = threading.Thread(target=flush_forever, args=(pid,))
+    thread.daemon = True
+    thread.start()
+    atexit.register(flush_at_exit, pid)
+
+
+def stop_flusher():
+    global _flusher
+    _flusher = None
+
+
+def flush_forever(pid):
+    while True:
+        time.sleep(flush_interval())
+        if _flusher != pid or os.getpid() != pid:
+            return
+        try:
+            flush(force=True)
+        except Exception:
+            logger.exception("failed to flush metrics")
+
+
+def flush_at_exit(pid):
+    if os.getpid() == pid:
+        flush(force=True)
+
+
+def load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write(path, snapshot):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshot, f)
+    os.rename(tmp, path)
+
+
+@contextlib.contextmanager
+def directory_lock(directory):
+    with open(os.path.join(directory, ".lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def archive(directory, path):
+    # the file of a worker that exited is merged into the archive, so
+    # counters do not go down when it is removed
+    with directory_lock(directory):
+        snapshot = load(path)
+        if snapshot is None:
+            return
+        archive_path = os.path.join(directory, ARCHIVE)
+        previous = load(archive_path) or {"histograms": [], "counters": [], "gauges": []}
+        histograms, counters, _ = merge([previous, dict(snapshot, gauges=[])])
+        write(archive_path, {
+            "pid": 0,
+            "histograms": [[name, [list(pair) for pair in label_pairs], buckets, total]
+                           for (name, label_pairs), (buckets, total) in histograms.items()],
+            "counters": [[name, [list(pair) for pair in label_pairs], value]
+                         for (name, label_pairs), value in counters.items()],
+            "gauges": [],
+        })
+        os.remove(path)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def collect():
+    snapshots = []
+    directory = metrics_dir()
+    if directory:
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            if os.path.basename(path) == ARCHIVE:
+                continue
+            snapshot = load(path)
+            if snapshot is None:
+                continue
+            pid = snapshot["pid"]
+            if pid == os.getpid() and snapshot.get("token") == token():
+                continue
+            # a file left by a worker that exited, or by an older process
+            # with this pid
+            if pid == os.getpid() or not pid_alive(pid):
+                archive(directory, path)
+                continue
+            snapshots.append(snapshot)
+        archived = load(os.path.join(directory, ARCHIVE))
+        if archived is not None:
+            snapshots.append(archived)
+    snapshots.append(registry.snapshot())
+    return merge(snapshots)
+
+
+def merge(snapshots):
+    histograms = {}
+    counters = {}
+    gauges = {}
+    for snapshot in snapshots:
+        for name, label_pairs, buckets, total in snapshot["histograms"]:
+            key = (name, tuple(tuple(pair) for pair in label_pairs))
+            merged = histograms.setdefault(key, [[0] * len(buckets), 0.0])
+            merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+            merged[1] += total
+        for name, label_pairs, value in snapshot["counters"]:
+            key = (name, tuple(tuple(pair) for pair in label_pairs))
+            counters[key] = counters.get(key, 0) + value
+        for name, label_pairs, value in snapshot["gauges"]:
+            key = (name, tuple(tuple(pair) for pair in label_pairs))
+            gauges[key] = gauges.get(key, 0) + value
+    return histograms, counters, gauges
+
+
+def escape(value):
+    return u"{}".format(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(label_pairs, extra=()):
+    pairs = list(label_pairs) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, escape(v)) for k, v in pairs) + "}"
+
+
+def render():
+    histograms, counters, gauges = collect()
+    lines = []
+    for metric_type, values in (("counter", counters), ("gauge", gauges)):
+        for name in sorted(set(name for name, _ in values)):
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for key in sorted(k for k in values if k[0] == name):
+                lines.append("{}{} {}".format(name, format_labels(key[1]), values[key]))
+    for name in sorted(set(name for name, _ in histograms)):
+        lines.append("# TYPE {} histogram".format(name))
+        for key in sorted(k for k in histograms if k[0] == name):
+            buckets, total = histograms[key]
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), buckets):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    name, format_labels(key[1], [("le", bound)]), cumulative))
+            lines.append("{}_sum{} {}".format(name, format_labels(key[1]), total))
+            lines.append("{}_count{} {}".format(name, format_labels(key[1]), cumulative))
+    return "\n".join(lines) + "\n"
@@ -7,6 +7,7 @@
 import json
 import os
 import sys
+import time
 
 try:
     from urllib2 import urlopen, Request, HTTPError
@@ -62,6 +63,30 @@ def proxy_request(service_name, instance_name, method, path, body=None, headers=
         raise
 
 
+JOB_POLL_INTERVAL = 1
+JOB_TIMEOUT = 300
+
+
+def wait_job(service_name, name, result):
+    job = json.loads(result.read().decode('utf-8'))
+    deadline = time.time() + JOB_TIMEOUT
+    while job["status"] in ("queued", "running"):
+        if time.time() > deadline:
+            msg = "ERROR: job {} is still {}, check it later\n"
+            sys.stderr.write(msg.format(job["id"], job["status"]))
+            sys.exit(1)
+        time.sleep(JOB_POLL_INTERVAL)
+        result = proxy_request(service_name, name, "GET", "/jobs/{}".format(job["id"]))
+        if result.getcode() != 200:
+            msg = result.read().decode('utf-8').rstrip("\n")
+            sys.stderr.write("ERROR: " + msg + "\n")
+            sys.exit(1)
+        job = json.loads(result.read().decode('utf-8'))
+    if job["status"] == "failed":
+        sys.stderr.write("ERROR: " + job["error"] + "\n")
+        sys.exit(1)
+
+
 def add_url(service_name, name, url, expected_string=None, comment=None):
     """
     add-url add a new url checker to the given instance. Usage:
@@ -97,7 +122,9 @@ def add_url(service_name, name, url, expected_string=None, comment=None):
     }
 
     result = proxy_request(service_name, name, "POST", "/url", data, headers)
-    if result.getcode() == 201:
+    if result.getcode() in (201, 202):
+        if result.getcode() == 202:
+            wait_job(service_name, name, result)
         msg = "url {} successfully added!\n".format(url)
         sys.stdout.write(msg)
     else:
@@ -283,7 +310,9 @@ def add_group(service_name, name, group):
         "Accept": "text/plain"
     }
     result = proxy_request(service_name, name, "POST", "/groups", data, headers)
-    if result.getcode() == 201:
+    if result.getcode() in (201, 202):
+        if result.getcode() == 202:
+            wait_job(service_name, name, result)
         msg = "group {} successfully added!\n".format(group)
         sys.stdout.write(msg)
     else:
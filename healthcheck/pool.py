@@ -0,0 +1,100 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import contextlib
+import os
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class ManagerPool(object):
+
+    def __init__(self, factory, size=10, timeout=30):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        # the queue holds idle managers plus one None for every slot that
+        # has not been filled yet, so waiters wake up on both cases.
+        self.idle = queue.LifoQueue()
+        for _ in range(size):
+            self.idle.put(None)
+        self.created = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def acquire(self):
+        try:
+            manager = self.idle.get_nowait()
+        except queue.Empty:
+            manager = self._wait()
+        if manager is None:
+            try:
+                manager = self.factory()
+            except Exception:
+                self.idle.put(None)
+                raise
+            with self.lock:
+                self.created += 1
+        with self.lock:
+            self.in_use += 1
+            self.acquired += 1
+        return manager
+
+    def _wait(self):
+        with self.lock:
+            self.waiting += 1
+        start = time.time()
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeoutError()
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.waiting -= 1
+                self.waits += 1
+                self.wait_time += elapsed
+                self.max_wait_time = max(self.max_wait_time, elapsed)
+
+    def release(self, manager):
+        with self.lock:
+            self.in_use -= 1
+        self.idle.put(manager)
+
+    @contextlib.contextmanager
+    def manager(self):
+        manager = self.acquire()
+        try:
+            yield manager
+        finally:
+            self.release(manager)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": self.size,
+                "created": self.created,
+                "in_use": self.in_use,
+                "idle": self.created - self.in_use,
+                "waiting": self.waiting,
+                "acquired": self.acquired,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "max_wait_time": self.max_wait_time,
+            }
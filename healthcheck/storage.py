@@ -2,7 +2,15 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
+import functools
+import logging
 import os
+import threading
+import time
+import uuid
+
+from healthcheck import deadlines, metrics
 
 
 class Jsonable(object):
@@ -44,56 +52,338 @@ class Item(Jsonable):
         return self.__dict__
 
 
+class Job(Jsonable):
+
+    def __init__(self, operation, args, **kwargs):
+        self.id = uuid.uuid4().hex
+        self.operation = operation
+        self.args = args
+        self.status = "queued"
+        self.attempts = 0
+        self.error = None
+        self.created_at = datetime.datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+        self.lease_until = None
+        self.run_at = None
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def to_api(self):
+        data = dict((key, getattr(self, key))
+                    for key in ("id", "operation", "status", "attempts", "error"))
+        for key in ("created_at", "started_at", "finished_at"):
+            value = getattr(self, key)
+            data[key] = value.isoformat() + "Z" if value else None
+        return data
+
+
+class IdempotencyKey(Jsonable):
+
+    def __init__(self, key, fingerprint, lease=300, ttl=24 * 60 * 60, **kwargs):
+        now = datetime.datetime.utcnow()
+        self.key = key
+        self.fingerprint = fingerprint
+        self.status = "processing"
+        self.response = None
+        self.created_at = now
+        self.lease_until = now + datetime.timedelta(seconds=lease)
+        self.expires_at = now + datetime.timedelta(seconds=ttl)
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+MONGODB_CLIENT_OPTIONS = (
+    ("MONGODB_MAX_POOL_SIZE", "maxPoolSize"),
+    ("MONGODB_MIN_POOL_SIZE", "minPoolSize"),
+    ("MONGODB_WAIT_QUEUE_TIMEOUT_MS", "waitQueueTimeoutMS"),
+    ("MONGODB_CONNECT_TIMEOUT_MS", "connectTimeoutMS"),
+    ("MONGODB_SOCKET_TIMEOUT_MS", "socketTimeoutMS"),
+    ("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "serverSelectionTimeoutMS"),
+)
+
+INDEXES = {
+    "healthchecks": [
+        ([("name", 1)], {"unique": True}),
+    ],
+    "items": [
+        ([("group_id", 1), ("url", 1)], {}),
+        ([("url", 1)], {}),
+    ],
+    "users": [
+        ([("email", 1)], {}),
+        ([("groups_id", 1)], {}),
+        ([("id", 1)], {}),
+    ],
+    "jobs": [
+        ([("id", 1)], {"unique": True}),
+        ([("status", 1), ("created_at", 1)], {}),
+        # finished jobs are kept for a week
+        ([("finished_at", 1)], {"expireAfterSeconds": 7 * 24 * 60 * 60}),
+    ],
+    "locks": [
+        ([("name", 1)], {"unique": True}),
+        # a lock is forgotten a day after its lease ends, long after any
+        # holder could still be using its fencing token
+        ([("expires_at", 1)], {"expireAfterSeconds": 24 * 60 * 60}),
+    ],
+    "idempotency_keys": [
+        ([("key", 1)], {"unique": True}),
+        ([("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ],
+}
+
+QUERIES = [
+    ("healthchecks", ("name",), "find_healthcheck_by_name"),
+    ("items", ("url",), "find_item_by_url"),
+    ("items", ("group_id",), "find_items_by_group"),
+    ("items", ("comment",), "find_items_without_comment"),
+    ("users", ("email",), "find_user_by_email"),
+    ("users", ("groups_id",), "find_users_by_group"),
+    ("users", ("id",), "add_user_to_group"),
+    ("jobs", ("id",), "find_job"),
+    ("jobs", ("status",), "claim_job"),
+    ("locks", ("name",), "acquire_lock"),
+    ("idempotency_keys", ("key",), "find_idempotency_key"),
+]
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_clients_created = 0
+_indexes_ensured = False
+# collections whose indexes this process made sure of before relying on them
+_required_indexes = set()
+_required_indexes_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def mongo_client_options():
+    options = {}
+    for env, option in MONGODB_CLIENT_OPTIONS:
+        value = os.environ.get(env)
+        if value:
+            options[option] = int(value)
+    return options
+
+
+def mongo_client():
+    global _client, _client_pid, _clients_created
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                mongodb_uri = os.environ.get(
+                    "MONGODB_URI", "mongodb://localhost:27017/"
+                )
+                from pymongo import MongoClient
+                _client = MongoClient(mongodb_uri, **mongo_client_options())
+                _client_pid = pid
+                _clients_created += 1
+    return _client
+
+
+def disconnect():
+    global _client, _client_pid
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = _client_pid = None
+
+
+def connection_stats():
+    return {
+        "pid": os.getpid(),
+        "clients_created": _clients_created,
+        "connected": _client is not None and _client_pid == os.getpid(),
+        "options": mongo_client_options(),
+    }
+
+
 class MongoStorage(object):
 
     def __init__(self):
+        global _indexes_ensured
         self.database_name = os.environ.get("MONGODB_DATABASE", "hcapi")
         self.db = self.conn()[self.database_name]
+        ensure = os.environ.get("MONGODB_ENSURE_INDEXES", "0")
+        if ensure in ("True", "true", "1") and not _indexes_ensured:
+            _indexes_ensured = True
+            self.ensure_indexes(strict=False)
 
     def conn(self):
-        mongodb_uri = os.environ.get(
-            "MONGODB_URI", "mongodb://localhost:27017/"
-        )
-        from pymongo import MongoClient
-        return MongoClient(mongodb_uri)
+        return mongo_client()
+
+    def ensure_indexes(self, collections=None, strict=True):
+        # background builds do not block the database on big collections
+        created = []
+        for collection, indexes in sorted(INDEXES.items()):
+            if collections is not None and collection not in collections:
+                continue
+            for keys, options in indexes:
+                try:
+                    name = self.db[collection].create_index(keys, background=True, **options)
+                except Exception:
+                    if strict:
+                        raise
+                    logger.exception("failed to create index %s on %s", keys, collection)
+                    continue
+                created.append("{}.{}".format(collection, name))
+        return created
+
+    def require_indexes(self, collection):
+        # locks and idempotency keys are only correct with their unique
+        # index, so it is created on first use instead of being opt-in
+        if collection in _required_indexes:
+            return
+        with _required_indexes_lock:
+            if collection not in _required_indexes:
+                self.ensure_indexes([collection])
+                _required_indexes.add(collection)
+
+    def check_indexes(self):
+        existing = {}
+        for collection in INDEXES:
+            info = self.db[collection].index_information()
+            existing[collection] = [
+                ([(field, direction) for field, direction in index["key"]],
+                 index.get("unique", False))
+                for index in info.values()
+            ]
+        missing = []
+        for collection, indexes in sorted(INDEXES.items()):
+            for keys, options in indexes:
+                unique = options.get("unique", False)
+                if not any(key == keys and (is_unique or not unique)
+                           for key, is_unique in existing[collection]):
+                    missing.append((collection, keys))
+        uncovered = []
+        for collection, fields, query in QUERIES:
+            covered = any(
+                set(field for field, _ in key[:len(fields)]) == set(fields)
+                for key, _ in existing.get(collection, [])
+            )
+            if not covered:
+                uncovered.append((collection, fields, query))
+        return {"missing": missing, "uncovered": uncovered}
+
+    def max_time(self, option="max_time_ms"):
+        # reads are stopped by the server once the request deadline passes
+        remaining = deadlines.remaining()
+        if remaining is None:
+            return {}
+        return {option: max(int(remaining * 1000), 1)}
+
+    def bounded(self, cursor):
+        # find takes no max_time_ms in pymongo 3.4, only its cursor does
+        max_time = self.max_time()
+        if not max_time:
+            return cursor
+        return cursor.max_time_ms(max_time["max_time_ms"])
 
     def add_item(self, item):
         self.db.items.insert(item.to_json())
 
+    def add_items(self, items):
+        if items:
+            self.db.items.insert_many([item.to_json() for item in items])
+
     def find_item_by_url(self, url):
         result = self.db.items.find_one(
-            {"url": url}
+            {"url": url}, **self.max_time()
         )
         if not result:
             raise ItemNotFoundError()
         return Item(**result)
 
     def find_urls_by_healthcheck_name(self, name):
-        items = []
-        healthcheck = self.find_healthcheck_by_name(name)
-        mgo_urls = self.db.items.find(
-            {
-                "group_id": healthcheck.group_id
-            }, {"url": 1}
-        )
-        for url in mgo_urls:
-            items.append(url['url'])
+        _, items = self.find_healthcheck_with_items(name)
+        return [item.url for item in items]
+
+    def find_items_by_healthcheck_name(self, name):
+        _, items = self.find_healthcheck_with_items(name)
         return items
 
+    def find_healthcheck_with_items(self, name):
+        healthcheck, items = self._find_healthcheck_with(
+            name, "items", "group_id",
+            {"items.url": 1, "items.comment": 1, "items.trigger_id": 1, "items.group_id": 1},
+        )
+        return healthcheck, [Item(**item) for item in items]
+
+    def find_healthcheck_with_watchers(self, name):
+        healthcheck, users = self._find_healthcheck_with(
+            name, "users", "groups_id", {"users.email": 1},
+        )
+        return healthcheck, [user["email"] for user in users]
+
+    def _find_healthcheck_with(self, name, collection, foreign_field, projection):
+        fields = {"_id": 0, "name": 1, "group_id": 1}
+        fields.update(projection)
+        result = list(self.db.healthchecks.aggregate([
+            {"$match": {"name": name}},
+            {"$limit": 1},
+            {"$lookup": {
+                "from": collection,
+                "localField": "group_id",
+                "foreignField": foreign_field,
+                "as": collection,
+            }},
+            {"$project": fields},
+        ], **self.max_time("maxTimeMS")))
+        if not result:
+            raise HealthCheckNotFoundError()
+        document = result[0]
+        related = document.pop(collection, [])
+        return HealthCheck(**document), related
+
+    def find_items_by_group(self, group_id):
+        items = self.bounded(self.db.items.find({"group_id": group_id}))
+        return [Item(**item) for item in items]
+
+    def find_items_without_comment(self):
+        items = self.db.items.find(
+            {"comment": {"$exists": False}}
+        )
+        for item in items:
+            yield Item(**item)
+
+    def update_items_comment(self, items):
+        if not items:
+            return
+        from pymongo import UpdateOne
+        # the same url can be monitored by more than one instance
+        self.db.items.bulk_write([
+            UpdateOne({"group_id": getattr(item, "group_id", None), "url": item.url},
+                      {"$set": {"comment": item.comment}})
+            for item in items
+        ], ordered=False)
+
     def find_watchers_by_healthcheck_name(self, name):
-        healthcheck = self.find_healthcheck_by_name(name)
-        watchers = self.find_users_by_group(healthcheck.group_id)
-        return [watcher.email for watcher in watchers]
+        _, watchers = self.find_healthcheck_with_watchers(name)
+        return watchers
 
     def remove_item(self, item):
         self.db.items.remove({"url": item.url})
 
+    def remove_items_by_group(self, group_id):
+        self.db.items.delete_many({"group_id": group_id})
+
     def add_user(self, user):
         self.db.users.insert(user.to_json())
 
     def remove_user(self, user):
         self.db.users.remove({"email": user.email})
 
+    def remove_users(self, users):
+        if users:
+            self.db.users.delete_many({"id": {"$in": [u.id for u in users]}})
+
+    def remove_group_from_users(self, group_id):
+        self.db.users.update_many({"groups_id": group_id},
+                                  {"$pull": {"groups_id": group_id}})
+
     def add_healthcheck(self, healthcheck):
         self.db.healthchecks.insert(
             healthcheck.to_json()
@@ -114,7 +404,7 @@ class MongoStorage(object):
 
     def find_healthcheck_by_name(self, name):
         result = self.db.healthchecks.find_one(
-            {"name": name}
+            {"name": name}, **self.max_time()
         )
         if not result:
             raise HealthCheckNotFoundError()
@@ -122,16 +412,14 @@ class MongoStorage(object):
 
     def find_user_by_email(self, email):
         result = self.db.users.find_one(
-            {"email": email}
+            {"email": email}, **self.max_time()
         )
         if not result:
             raise UserNotFoundError()
         return User(result["id"], result["email"], *result["groups_id"])
 
     def find_users_by_group(self, group_id):
-        items = self.db.users.find(
-            {"groups_id": group_id},
-        )
+        items = self.bounded(self.db.users.find({"groups_id": group_id}))
         return [User(r["id"], r["email"], *r["groups_id"]) for r in items]
 
     def add_user_to_group(self, user, group):
@@ -140,6 +428,276 @@ class MongoStorage(object):
     def remove_user_from_group(self, user, group):
         self.db.users.update({"id": user.id}, {"$pull": {"groups_id": group}})
 
+    def add_job(self, job):
+        self.db.jobs.insert_one(dict(job.to_json()))
+        return job
+
+    def find_job(self, job_id):
+        result = self.db.jobs.find_one({"id": job_id}, {"_id": 0}, **self.max_time())
+        if not result:
+            raise JobNotFoundError()
+        return Job(**result)
+
+    def claim_job(self, lease):
+        # jobs left running by a dead worker are claimed again once their
+        # lease expires
+        from pymongo import ReturnDocument
+        now = datetime.datetime.utcnow()
+        result = self.db.jobs.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "run_at": {"$not": {"$gt": now}}},
+                {"status": "running", "lease_until": {"$lt": now}},
+            ]},
+            {
+                "$set": {
+                    "status": "running",
+                    "started_at": now,
+                    "lease_until": now + datetime.timedelta(seconds=lease),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("created_at", 1), ("_id", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if result:
+            result.pop("_id")
+            return Job(**result)
+
+    def finish_job(self, job, error=None):
+        job.status = "failed" if error else "done"
+        job.error = error
+        job.finished_at = datetime.datetime.utcnow()
+        # a worker whose lease expired must not overwrite a newer attempt
+        result = self.db.jobs.update_one(
+            {"id": job.id, "attempts": job.attempts},
+            {"$set": {"status": job.status, "error": job.error,
+                      "finished_at": job.finished_at, "lease_until": None}},
+        )
+        return result.modified_count == 1
+
+    def retry_job(self, job, error, delay):
+        # the job goes back to the queue and is not claimed before run_at
+        job.status = "queued"
+        job.error = error
+        job.run_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+        result = self.db.jobs.update_one(
+            {"id": job.id, "attempts": job.attempts},
+            {"$set": {"status": job.status, "error": job.error,
+                      "run_at": job.run_at, "lease_until": None}},
+        )
+        return result.modified_count == 1
+
+    def acquire_lock(self, name, ttl):
+        # the upsert only matches a free lock, when it is held the insert
+        # hits the unique index. The token grows on every acquisition and
+        # fences holders whose lease expired.
+        from pymongo import ReturnDocument
+        from pymongo.errors import DuplicateKeyError
+        self.require_indexes("locks")
+        now = datetime.datetime.utcnow()
+        try:
+            result = self.db.locks.find_one_and_update(
+                {"name": name, "expires_at": {"$lte": now}},
+                {
+                    "$set": {"expires_at": now + datetime.timedelta(seconds=ttl)},
+                    "$inc": {"token": 1},
+                },
+                upsert=True,
+                return_document=ReturnDocument.BEFORE,
+            )
+        except DuplicateKeyError:
+            return None
+        # there is no previous document the first time a lock is taken
+        return (result or {}).get("token", 0) + 1
+
+    def renew_lock(self, name, token, ttl):
+        now = datetime.datetime.utcnow()
+        result = self.db.locks.update_one(
+            {"name": name, "token": token, "expires_at": {"$gt": now}},
+            {"$set": {"expires_at": now + datetime.timedelta(seconds=ttl)}},
+        )
+        return result.matched_count == 1
+
+    def release_lock(self, name, token):
+        self.db.locks.update_one(
+            {"name": name, "token": token},
+            {"$set": {"expires_at": datetime.datetime.utcnow()}},
+        )
+
+    def add_idempotency_key(self, record):
+        from pymongo.errors import DuplicateKeyError
+        self.require_indexes("idempotency_keys")
+        try:
+            self.db.idempotency_keys.insert_one(dict(record.to_json()))
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def find_idempotency_key(self, key):
+        result = self.db.idempotency_keys.find_one({"key": key}, {"_id": 0}, **self.max_time())
+        if not result:
+            raise IdempotencyKeyNotFoundError()
+        return IdempotencyKey(**result)
+
+    def claim_idempotency_key(self, record):
+        # the key of a request that died before answering is taken over
+        # once its lease expires
+        result = self.db.idempotency_keys.update_one(
+            {
+                "key": record.key,
+                "fingerprint": record.fingerprint,
+                "status": "processing",
+                "lease_until": {"$lte": datetime.datetime.utcnow()},
+            },
+            {"$set": {"lease_until": record.lease_until, "expires_at": record.expires_at}},
+        )
+        return result.modified_count == 1
+
+    def finish_idempotency_key(self, record, response):
+        record.status = "done"
+        record.response = response
+        self.db.idempotency_keys.update_one(
+            {"key": record.key, "fingerprint": record.fingerprint},
+            {"$set": {"status": record.status, "response": response}},
+        )
+
+    def remove_idempotency_key(self, record):
+        self.db.idempotency_keys.delete_one(
+            {"key": record.key, "fingerprint": record.fingerprint, "status": "processing"})
+
+
+class CachedStorage(object):
+
+    # read methods that are memoized and the entity they return
+    cached = {
+        "find_healthcheck_by_name": "healthchecks",
+        "find_item_by_url": "items",
+        "find_user_by_email": "users",
+        "find_users_by_group": "users",
+    }
+
+    # write methods and the entity whose cached reads they invalidate
+    invalidates = {
+        "add_item": "items",
+        "add_items": "items",
+        "remove_item": "items",
+        "remove_items_by_group": "items",
+        "update_items_comment": "items",
+        "add_user": "users",
+        "remove_user": "users",
+        "remove_users": "users",
+        "add_user_to_group": "users",
+        "remove_user_from_group": "users",
+        "remove_group_from_users": "users",
+        "add_healthcheck": "healthchecks",
+        "remove_healthcheck": "healthchecks",
+        "add_group_to_instance": "healthchecks",
+        "remove_group_from_instance": "healthchecks",
+        "add_job": "jobs",
+        "claim_job": "jobs",
+        "finish_job": "jobs",
+        "retry_job": "jobs",
+        "acquire_lock": "locks",
+        "renew_lock": "locks",
+        "release_lock": "locks",
+        "add_idempotency_key": "idempotency_keys",
+        "claim_idempotency_key": "idempotency_keys",
+        "finish_idempotency_key": "idempotency_keys",
+        "remove_idempotency_key": "idempotency_keys",
+    }
+
+    # writes that release or finish what a request started, they still run
+    # after its deadline
+    cleanup = (
+        "finish_job",
+        "retry_job",
+        "release_lock",
+        "finish_idempotency_key",
+        "remove_idempotency_key",
+    )
+
+    # writes that record a zabbix change already made, skipping them at the
+    # deadline would leave the zabbix object without its record
+    recorded = (
+        "add_user",
+        "add_user_to_group",
+        "remove_user",
+        "remove_users",
+        "remove_user_from_group",
+        "remove_group_from_users",
+        "remove_item",
+        "remove_items_by_group",
+        "remove_healthcheck",
+        "add_group_to_instance",
+        "remove_group_from_instance",
+    )
+
+    def __init__(self, storage):
+        self.storage = storage
+        # saga steps and the lock heartbeat share the storage of a request
+        self.lock = threading.Lock()
+        self.begin()
+
+    def begin(self):
+        self.cache = {}
+        self.reads = 0
+        self.hits = 0
+
+    def stats(self):
+        return {"reads": self.reads, "hits": self.hits}
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if name in self.cached:
+            return functools.partial(self._cached_read, name, attr)
+        if name in self.invalidates:
+            return functools.partial(self._write, name, attr)
+        if name.startswith("find_"):
+            return functools.partial(self._read, name, attr)
+        return attr
+
+    def _cached_read(self, name, method, *args):
+        key = (self.cached[name], name) + args
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                return self.cache[key]
+        result = self._read(name, method, *args)
+        with self.lock:
+            self.cache[key] = result
+        return result
+
+    def _read(self, name, method, *args, **kwargs):
+        with self.lock:
+            self.reads += 1
+        return self._call(name, method, *args, **kwargs)
+
+    def _write(self, name, method, *args, **kwargs):
+        entity = self.invalidates[name]
+        with self.lock:
+            for key in list(self.cache):
+                if key[0] == entity:
+                    del self.cache[key]
+        return self._call(name, method, *args, **kwargs)
+
+    def _call(self, name, method, *args, **kwargs):
+        from pymongo.errors import ExecutionTimeout
+        if name not in self.cleanup and name not in self.recorded:
+            deadlines.check("mongo", name)
+        start = time.time()
+        error = True
+        try:
+            with deadlines.translate("mongo", name, ExecutionTimeout):
+                result = method(*args, **kwargs)
+            error = False
+            return result
+        except (ItemNotFoundError, HealthCheckNotFoundError, UserNotFoundError,
+                JobNotFoundError, IdempotencyKeyNotFoundError):
+            error = False
+            raise
+        finally:
+            metrics.observe_call("mongo", name, time.time() - start, error)
+
 
 class ItemNotFoundError(Exception):
     pass
@@ -151,3 +709,11 @@ class HealthCheckNotFoundError(Exception):
 
 class UserNotFoundError(Exception):
     pass
+
+
+class JobNotFoundError(Exception):
+    pass
+
+
+class IdempotencyKeyNotFoundError(Exception):
+    pass
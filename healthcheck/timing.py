@@ -0,0 +1,104 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import contextlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import flask
+
+
+CATEGORIES = ("zabbix-login", "zabbix", "mongo", "render")
+
+
+class RequestTimings(object):
+
+    def __init__(self):
+        self.start = time.time()
+        self.categories = OrderedDict((name, [0, 0.0]) for name in CATEGORIES)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def add(self, category, method, duration, error=False):
+        with self.lock:
+            totals = self.categories[category]
+            totals[0] += 1
+            totals[1] += duration
+            self.calls.append((category, method, duration, error))
+
+    def total(self):
+        return time.time() - self.start
+
+    def header(self):
+        parts = []
+        for name, (count, duration) in self.categories.items():
+            if count:
+                parts.append('{};dur={:.1f};desc="{} call{}"'.format(
+                    name, duration * 1000, count, "" if count == 1 else "s"))
+        parts.append("total;dur={:.1f}".format(self.total() * 1000))
+        return ", ".join(parts)
+
+    def debug(self):
+        return json.dumps({
+            "total_ms": round(self.total() * 1000, 1),
+            "categories": OrderedDict(
+                (name, {"calls": count, "ms": round(duration * 1000, 1)})
+                for name, (count, duration) in self.categories.items()
+            ),
+            "calls": [
+                {"category": category, "method": method,
+                 "ms": round(duration * 1000, 1), "error": error}
+                for category, method, duration, error in self.calls
+            ],
+        })
+
+
+def category(kind, method):
+    if kind == "zabbix" and method in ("user.login", "user.authenticate"):
+        return "zabbix-login"
+    return kind
+
+
+_local = threading.local()
+
+
+def current():
+    timings = getattr(_local, "timings", None)
+    if timings is not None:
+        return timings
+    if flask.has_request_context():
+        return flask.g.get("timings")
+
+
+def bind(fn):
+    # threads started by a request have no request context, so they get the
+    # request timings explicitly
+    timings = current()
+
+    def run(*args, **kwargs):
+        _local.timings = timings
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.timings = None
+    return run
+
+
+def record(kind, method, duration, error=False):
+    timings = current()
+    if timings is not None:
+        timings.add(category(kind, method), method, duration, error)
+
+
+@contextlib.contextmanager
+def timed(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings = current()
+        if timings is not None:
+            timings.add(name, name, time.time() - start)
@@ -0,0 +1,164 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import logging
+import os
+import random
+import signal
+import threading
+
+from healthcheck import deadlines
+from healthcheck.backends import GroupNotExists, GroupNotInInstanceError
+from healthcheck.backends import breaker
+from healthcheck.backends.breaker import ZabbixUnavailableError
+from healthcheck.backends.governor import ZabbixOverloadedError
+from healthcheck.deadlines import DeadlineExceededError
+from healthcheck.locks import LockLostError, LockTimeoutError
+from healthcheck.pool import ManagerPool
+from healthcheck.storage import CachedStorage, HealthCheckNotFoundError, ItemNotFoundError
+
+
+logger = logging.getLogger(__name__)
+
+# manager methods a job can run
+OPERATIONS = ("add_url", "remove", "add_group")
+
+# messages the synchronous routes answer for these errors
+ERRORS = {
+    DeadlineExceededError: "request deadline exceeded",
+    GroupNotExists: "group not exists",
+    GroupNotInInstanceError: "group not found in instance",
+    HealthCheckNotFoundError: "healthcheck not found",
+    ItemNotFoundError: "URL not found.",
+    LockLostError: "instance lock lost, try again later",
+    LockTimeoutError: "instance is busy, try again later",
+    ZabbixOverloadedError: "zabbix is overloaded, try again later",
+    ZabbixUnavailableError: "zabbix is unavailable, try again later",
+}
+
+
+# errors that pass on their own, the job is queued again instead of failing
+TRANSIENT_ERRORS = (LockLostError, LockTimeoutError, ZabbixOverloadedError,
+                    ZabbixUnavailableError)
+
+
+def error_message(exc):
+    for error_class, message in ERRORS.items():
+        if isinstance(exc, error_class):
+            return message
+    return u"{}: {}".format(type(exc).__name__, exc)
+
+
+class Worker(object):
+
+    def __init__(self, storage, pool, concurrency=4, lease=300, max_attempts=3,
+                 poll_interval=1, retry_backoff=5):
+        self.storage = storage
+        self.pool = pool
+        self.concurrency = concurrency
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.retry_backoff = retry_backoff
+        self.stopped = threading.Event()
+
+    def run_once(self):
+        job = self.storage.claim_job(self.lease)
+        if job is None:
+            return False
+        self.execute(job)
+        return True
+
+    def execute(self, job):
+        if job.operation not in OPERATIONS:
+            self.storage.finish_job(job, "unknown operation {}".format(job.operation))
+            return
+        if job.attempts > self.max_attempts:
+            self.storage.finish_job(job, "gave up after {} attempts".format(self.max_attempts))
+            return
+        error = None
+        try:
+            # the breaker is checked before the pool builds a manager, which
+            # would log in to zabbix
+            zabbix = breaker.shared_breaker()
+            if not zabbix.available():
+                raise ZabbixUnavailableError(zabbix.retry_after())
+            # a job has until its lease expires, like a request has until
+            # its deadline
+            with deadlines.override(deadlines.Deadline(self.lease)), \
+                    self.pool.manager() as manager:
+                storage = getattr(manager, "storage", None)
+                if isinstance(storage, CachedStorage):
+                    storage.begin()
+                getattr(manager, job.operation)(**job.args)
+        except TRANSIENT_ERRORS as e:
+            if job.attempts < self.max_attempts:
+                self.retry(job, e)
+                return
+            logger.warning("job %s (%s) gave up: %s", job.id, job.operation, e)
+            error = error_message(e)
+        except Exception as e:
+            logger.exception("job %s (%s) failed", job.id, job.operation)
+            error = error_message(e)
+        if not self.storage.finish_job(job, error):
+            logger.warning("job %s lease expired before it finished", job.id)
+
+    def retry(self, job, exc):
+        backoff = self.retry_backoff * 2 ** (job.attempts - 1)
+        delay = max(getattr(exc, "retry_after", 0), random.uniform(backoff / 2.0, backoff))
+        logger.warning("job %s (%s) retried in %.1fs: %s", job.id, job.operation, delay, exc)
+        if not self.storage.retry_job(job, error_message(exc), delay):
+            logger.warning("job %s lease expired before it finished", job.id)
+
+    def loop(self):
+        while not self.stopped.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception:
+                logger.exception("failed to claim a job")
+            self.stopped.wait(self.poll_interval)
+
+    def run(self):
+        threads = []
+        for _ in range(self.concurrency):
+            thread = threading.Thread(target=self.loop)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        # waiting with a timeout keeps the main thread able to get signals
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1)
+
+    def stop(self, *args):
+        self.stopped.set()
+
+
+def get_worker():
+    from healthcheck.backends import Zabbix
+    from healthcheck.storage import MongoStorage
+    concurrency = int(os.environ.get("JOBS_CONCURRENCY", 4))
+    return Worker(
+        CachedStorage(MongoStorage()),
+        ManagerPool(Zabbix, size=concurrency),
+        concurrency=concurrency,
+        lease=float(os.environ.get("JOBS_LEASE", 300)),
+        max_attempts=int(os.environ.get("JOBS_MAX_ATTEMPTS", 3)),
+        poll_interval=float(os.environ.get("JOBS_POLL_INTERVAL", 1)),
+        retry_backoff=float(os.environ.get("JOBS_RETRY_BACKOFF", 5)),
+    )
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    worker = get_worker()
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    logger.info("running jobs with concurrency %d", worker.concurrency)
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -18,7 +18,7 @@ setup(
     classifiers=[
         "Programming Language :: Python :: 2.7",
     ],
-    packages=find_packages(exclude=["tests"]),
+    packages=find_packages(exclude=["tests", "benchmarks"]),
     include_package_data=True,
     install_requires=["Flask==1.0.2", "pyzabbix==0.7.4", "pymongo==3.4.0"],
 )
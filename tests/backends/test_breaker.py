@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import requests
+
+from healthcheck import metrics
+from healthcheck.backends.breaker import (CircuitBreaker, ZabbixUnavailableError,
+                                          CLOSED, HALF_OPEN, OPEN)
+from healthcheck.backends.governor import ZabbixOverloadedError
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+    def fail(self):
+        with self.assertRaises(requests.ConnectionError):
+            with self.breaker.call():
+                raise requests.ConnectionError()
+
+    def expire(self):
+        self.breaker.opened_at -= 31
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail()
+        self.assertEqual(CLOSED, self.breaker.state)
+        self.fail()
+        self.assertEqual(OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.available())
+        with self.assertRaises(ZabbixUnavailableError) as cm:
+            with self.breaker.call():
+                pass
+        self.assertGreater(cm.exception.retry_after, 29)
+        self.assertEqual([("hcaas_zabbix_breaker_open", (), 1)], self.breaker.gauges())
+
+    def test_success_resets_the_failures(self):
+        self.fail()
+        with self.breaker.call():
+            pass
+        self.fail()
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_zabbix_errors_are_not_failures(self):
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                with self.breaker.call():
+                    raise ValueError()
+        self.assertEqual(CLOSED, self.breaker.state)
+
+    def test_half_open_lets_a_single_probe_through(self):
+        self.fail()
+        self.fail()
+        self.expire()
+        self.assertTrue(self.breaker.available())
+        with self.breaker.call():
+            self.assertEqual(HALF_OPEN, self.breaker.state)
+            self.assertFalse(self.breaker.available())
+            with self.assertRaises(ZabbixUnavailableError):
+                with self.breaker.call():
+                    pass
+        self.assertEqual(CLOSED, self.breaker.state)
+        self.assertEqual(0.0, self.breaker.retry_after())
+
+    def test_failed_probe_opens_again(self):
+        self.fail()
+        self.fail()
+        self.expire()
+        self.fail()
+        self.assertEqual(OPEN, self.breaker.state)
+        self.assertGreater(self.breaker.retry_after(), 29)
+
+    def test_cancelled_probe_gives_its_turn_back(self):
+        self.fail()
+        self.fail()
+        self.expire()
+        with self.assertRaises(ZabbixOverloadedError):
+            with self.breaker.call():
+                raise ZabbixOverloadedError("host.get", "rate", 1)
+        self.assertEqual(OPEN, self.breaker.state)
+        self.assertTrue(self.breaker.available())
+
+    def test_interrupted_probe_gives_its_turn_back(self):
+        self.fail()
+        self.fail()
+        self.expire()
+        with self.assertRaises(KeyboardInterrupt):
+            with self.breaker.call():
+                self.assertEqual(HALF_OPEN, self.breaker.state)
+                raise KeyboardInterrupt()
+        self.assertEqual(OPEN, self.breaker.state)
+        self.assertTrue(self.breaker.available())
+
+    def test_transitions_are_counted(self):
+        self.fail()
+        self.fail()
+        self.expire()
+        with self.breaker.call():
+            pass
+        transitions = dict((dict(labels)["state"], value)
+                           for name, labels, value in metrics.registry.snapshot()["counters"]
+                           if name == "hcaas_zabbix_breaker_transitions_total")
+        self.assertEqual({OPEN: 1, HALF_OPEN: 1, CLOSED: 1}, transitions)
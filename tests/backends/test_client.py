@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import unittest
+
+import mock
+import requests
+from pyzabbix import ZabbixAPI, ZabbixAPIException
+
+from healthcheck import deadlines
+from healthcheck.backends.breaker import CircuitBreaker, ZabbixUnavailableError
+from healthcheck.backends.client import ZabbixClient, is_session_expired
+from healthcheck.backends.governor import Governor, ZabbixOverloadedError
+from healthcheck.backends.retry import RetryPolicy
+
+
+class ZabbixClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = ZabbixClient("http://zbx.com")
+
+    def test_is_session_expired(self):
+        exc = ZabbixAPIException(
+            "Error -32602: Invalid params., Session terminated, re-login, please.", -32602)
+        self.assertTrue(is_session_expired(exc))
+        exc = ZabbixAPIException("Error -32602: Invalid params., Not authorised.", -32602)
+        self.assertTrue(is_session_expired(exc))
+        exc = ZabbixAPIException("Error -32602: Invalid params., already exists.", -32602)
+        self.assertFalse(is_session_expired(exc))
+
+    @mock.patch.object(ZabbixAPI, "do_request")
+    def test_login_keeps_credentials(self, do_request):
+        do_request.return_value = {"result": "token"}
+        self.client.login("user", "pass")
+        self.assertEqual(("user", "pass"), self.client.credentials)
+        self.assertEqual("token", self.client.auth)
+        self.assertEqual(1, self.client.logins)
+
+    @mock.patch.object(ZabbixAPI, "do_request")
+    def test_relogin_when_session_expired(self, do_request):
+        expired = ZabbixAPIException("Session terminated, re-login, please.", -32602)
+        do_request.side_effect = [
+            {"result": "token"},
+            expired,
+            {"result": "new-token"},
+            {"result": [{"hostid": "1"}]},
+        ]
+        self.client.login("user", "pass")
+        result = self.client.host.get(hostids=["1"])
+        self.assertEqual([{"hostid": "1"}], result)
+        self.assertEqual("new-token", self.client.auth)
+        self.assertEqual(2, self.client.logins)
+        do_request.assert_called_with("host.get", {"hostids": ["1"]})
+
+    @mock.patch("time.sleep")
+    @mock.patch.object(ZabbixAPI, "do_request")
+    def test_retries_reads(self, do_request, sleep):
+        do_request.side_effect = [requests.ConnectionError(), {"result": [{"hostid": "1"}]}]
+        self.assertEqual([{"hostid": "1"}], self.client.host.get(hostids=["1"]))
+        self.assertEqual(2, do_request.call_count)
+        self.assertEqual(1, sleep.call_count)
+
+    @mock.patch("time.sleep")
+    @mock.patch.object(ZabbixAPI, "do_request")
+    def test_does_not_retry_creates(self, do_request, sleep):
+        do_request.side_effect = requests.ReadTimeout()
+        with self.assertRaises(requests.ReadTimeout):
+            self.client.host.create(host="h")
+        self.assertEqual(1, do_request.call_count)
+
+    @mock.patch("time.sleep")
+    @mock.patch.object(ZabbixAPI, "do_request")
+    def test_retried_delete_of_a_deleted_object(self, do_request, sleep):
+        missing = ZabbixAPIException(
+            "Error -32500: Application error., No permissions to referred object or it does not exist!",
+            -32500)
+        do_request.side_effect = [requests.ReadTimeout(), missing, missing]
+        self.assertEqual({}, self.client.host.delete("1"))
+        with self.assertRaises(ZabbixAPIException):
+            self.client.host.delete("1")
+
+    @mock.patch("time.sleep")
+    @mock.patch.object(ZabbixClient, "_post_batch")
+    def test_retries_batches_of_idempotent_calls(self, post_batch, sleep):
+        post_batch.side_effect = [requests.ConnectionError(), None, requests.ConnectionError()]
+        with self.client.batch() as batch:
+            batch.httptest.delete("1")
+            batch.host.delete("2")
+        self.assertEqual(2, post_batch.call_count)
+        with self.assertRaises(requests.ConnectionError):
+            with self.client.batch() as batch:
+                batch.host.delete("2")
+                batch.host.create(host="h")
+        self.assertEqual(3, post_batch.call_count)
+
+    def test_timeout_follows_the_deadline(self):
+        self.assertIsNone(self.client.timeout)
+        client = ZabbixClient("http://zbx.com", timeout=10)
+        self.assertEqual(10, client.timeout)
+        with deadlines.override(deadlines.Deadline(2)):
+            self.assertAlmostEqual(2, client.timeout, places=1)
+            self.assertAlmostEqual(2, self.client.timeout, places=1)
+
+    @mock.patch.object(ZabbixAPI, "do_request")
+    def test_calls_past_the_deadline_are_not_sent(self, do_request):
+        with deadlines.override(deadlines.Deadline(-1)):
+            with self.assertRaises(deadlines.DeadlineExceededError):
+                self.client.host.create(host="h")
+            with self.assertRaises(deadlines.DeadlineExceededError):
+                with self.client.batch() as batch:
+                    batch.host.create(host="h")
+        self.assertFalse(do_request.called)
+
+    @mock.patch.object(ZabbixAPI, "do_request")
+    def test_timeout_at_the_deadline_does_not_open_the_breaker(self, do_request):
+        self.client.breaker = CircuitBreaker(failure_threshold=1)
+        deadline = deadlines.Deadline(5)
+
+        def timeout(method, params):
+            deadline.expires_at = 0
+            raise requests.Timeout()
+        do_request.side_effect = timeout
+        with deadlines.override(deadline):
+            with self.assertRaises(deadlines.DeadlineExceededError):
+                self.client.host.get()
+        self.assertTrue(self.client.breaker.available())
+
+    @mock.patch.object(ZabbixAPI, "do_request")
+    def test_calls_go_through_the_governor(self, do_request):
+        self.client.governor = Governor(max_in_flight=1, max_wait=0.01)
+        do_request.return_value = {"result": []}
+        with self.client.governor.call("host.create"):
+            with self.assertRaises(ZabbixOverloadedError):
+                self.client.host.create(host="h")
+        self.assertFalse(do_request.called)
+        self.client.host.create(host="h")
+        self.assertTrue(do_request.called)
+
+    @mock.patch.object(ZabbixAPI, "do_request")
+    def test_fails_fast_while_the_breaker_is_open(self, do_request):
+        self.client.breaker = CircuitBreaker(failure_threshold=1)
+        self.client.retry = RetryPolicy(attempts=1)
+        do_request.side_effect = requests.ConnectionError()
+        with self.assertRaises(requests.ConnectionError):
+            self.client.host.get()
+        with self.assertRaises(ZabbixUnavailableError):
+            self.client.host.get()
+        self.assertEqual(1, do_request.call_count)
+
+    @mock.patch("healthcheck.metrics.observe_call")
+    @mock.patch.object(ZabbixAPI, "do_request")
+    def test_calls_are_observed(self, do_request, observe_call):
+        do_request.side_effect = [{"result": []}, ZabbixAPIException("already exists", -32602)]
+        self.client.host.get()
+        with self.assertRaises(ZabbixAPIException):
+            self.client.host.create(host="h")
+        self.assertEqual(2, observe_call.call_count)
+        kind, method, _, error = observe_call.call_args_list[0][0]
+        self.assertEqual(("zabbix", "host.get", False), (kind, method, error))
+        kind, method, _, error = observe_call.call_args_list[1][0]
+        self.assertEqual(("zabbix", "host.create", True), (kind, method, error))
+
+    @mock.patch.object(ZabbixAPI, "do_request")
+    def test_other_errors_are_raised(self, do_request):
+        do_request.side_effect = [
+            {"result": "token"},
+            ZabbixAPIException("already exists", -32602),
+        ]
+        self.client.login("user", "pass")
+        with self.assertRaises(ZabbixAPIException):
+            self.client.host.create(host="h")
+        self.assertEqual(1, self.client.logins)
+
+    @mock.patch.object(ZabbixAPI, "do_request")
+    def test_no_relogin_without_credentials(self, do_request):
+        do_request.side_effect = ZabbixAPIException("Not authorised.", -32602)
+        with self.assertRaises(ZabbixAPIException):
+            self.client.host.get()
+        self.assertEqual(1, do_request.call_count)
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = ZabbixClient("http://zbx.com")
+        self.client.auth = "token"
+        self.client.session = mock.Mock()
+
+    def respond(self, *responses):
+        self.client.session.post.side_effect = [
+            mock.Mock(text=json.dumps(r)) for r in responses
+        ]
+
+    def sent(self, index=0):
+        return json.loads(self.client.session.post.call_args_list[index][1]["data"])
+
+    def test_batch_sends_one_request(self):
+        self.respond([
+            {"jsonrpc": "2.0", "id": 1, "result": {"usrgrpids": ["2"]}},
+            {"jsonrpc": "2.0", "id": 0, "result": {"hostids": ["1"]}},
+        ])
+        with self.client.batch() as batch:
+            host = batch.host.create(host="h")
+            group = batch.usergroup.create(name="g")
+
+        self.assertEqual(1, self.client.session.post.call_count)
+        self.assertEqual([
+            {"jsonrpc": "2.0", "method": "host.create", "params": {"host": "h"},
+             "id": 0, "auth": "token"},
+            {"jsonrpc": "2.0", "method": "usergroup.create", "params": {"name": "g"},
+             "id": 1, "auth": "token"},
+        ], self.sent())
+        self.assertEqual({"hostids": ["1"]}, host.result)
+        self.assertEqual({"usrgrpids": ["2"]}, group.result)
+        self.assertEqual(2, self.client.id)
+
+    @mock.patch("healthcheck.metrics.observe_call")
+    def test_batch_is_observed_once(self, observe_call):
+        self.respond([
+            {"jsonrpc": "2.0", "id": 0, "result": {}},
+            {"jsonrpc": "2.0", "id": 1, "result": {}},
+        ])
+        with self.client.batch() as batch:
+            batch.host.delete("1")
+            batch.usergroup.delete("2")
+        self.assertEqual(1, observe_call.call_count)
+        self.assertEqual(("zabbix", "batch"), observe_call.call_args[0][:2])
+
+    def test_batch_array_params(self):
+        self.respond([{"jsonrpc": "2.0", "id": 0, "result": {"actionids": ["1", "2"]}}])
+        with self.client.batch() as batch:
+            batch.action.delete("1", "2")
+        self.assertEqual(["1", "2"], self.sent()[0]["params"])
+
+    def test_empty_batch(self):
+        with self.client.batch():
+            pass
+        self.assertFalse(self.client.session.post.called)
+
+    def test_batch_not_sent_on_exception(self):
+        with self.assertRaises(ValueError):
+            with self.client.batch() as batch:
+                batch.host.delete("1")
+                raise ValueError()
+        self.assertFalse(self.client.session.post.called)
+
+    def test_batch_error(self):
+        self.respond([
+            {"jsonrpc": "2.0", "id": 0, "result": {"hostids": ["1"]}},
+            {"jsonrpc": "2.0", "id": 1,
+             "error": {"code": -32602, "message": "Invalid params.", "data": "already exists"}},
+        ])
+        with self.assertRaises(ZabbixAPIException) as cm:
+            with self.client.batch() as batch:
+                host = batch.host.create(host="h")
+                group = batch.usergroup.create(name="g")
+        self.assertEqual(-32602, cm.exception.args[1])
+        self.assertEqual({"hostids": ["1"]}, host.result)
+        self.assertIs(cm.exception, group.error)
+
+    def test_batch_relogin_when_session_expired(self):
+        expired = {"code": -32602, "message": "Invalid params.",
+                   "data": "Session terminated, re-login, please."}
+        self.respond(
+            [{"jsonrpc": "2.0", "id": 0, "error": expired}],
+            {"jsonrpc": "2.0", "id": 1, "result": "new-token"},
+            [{"jsonrpc": "2.0", "id": 2, "result": [{"hostid": "1"}]}],
+        )
+        self.client.credentials = ("user", "pass")
+        with self.client.batch() as batch:
+            hosts = batch.host.get(hostids=["1"])
+        self.assertEqual([{"hostid": "1"}], hosts.result)
+        self.assertEqual("new-token", self.client.auth)
+        self.assertEqual("new-token", self.sent(2)[0]["auth"])
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import threading
+import time
+import unittest
+
+import mock
+import requests
+
+from healthcheck import metrics
+from healthcheck.backends.governor import (AdaptiveLimit, Governor, TokenBucket,
+                                           ZabbixOverloadedError, shared_governor)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst(self):
+        bucket = TokenBucket(rate=10, burst=3)
+        self.assertEqual([0.0, 0.0, 0.0], [bucket.reserve(1)[0] for _ in range(3)])
+        wait, _ = bucket.reserve(1)
+        self.assertAlmostEqual(0.1, wait, places=2)
+
+    def test_queued_callers_wait_longer(self):
+        bucket = TokenBucket(rate=10, burst=1)
+        bucket.reserve(1)
+        first, _ = bucket.reserve(1)
+        second, _ = bucket.reserve(1)
+        self.assertAlmostEqual(0.1, first, places=2)
+        self.assertAlmostEqual(0.2, second, places=2)
+
+    def test_wait_longer_than_max_wait(self):
+        bucket = TokenBucket(rate=1, burst=1)
+        bucket.reserve(0)
+        wait, retry_after = bucket.reserve(0.5)
+        self.assertIsNone(wait)
+        self.assertAlmostEqual(1, retry_after, places=2)
+        # a rejected caller does not take a token
+        self.assertAlmostEqual(1, bucket.reserve(2)[0], places=2)
+
+
+class AdaptiveLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limit = AdaptiveLimit(initial=4, minimum=1, maximum=5, target_latency=1)
+
+    def test_additive_increase(self):
+        for _ in range(4):
+            self.limit.acquire(time.time() + 1)
+            self.limit.release(0.1, False)
+        self.assertEqual(4, int(self.limit.limit))
+        self.assertGreater(self.limit.limit, 4.9)
+        for _ in range(10):
+            self.limit.acquire(time.time() + 1)
+            self.limit.release(0.1, False)
+        self.assertEqual(5, self.limit.limit)
+
+    def test_multiplicative_decrease_once_per_window(self):
+        for _ in range(3):
+            self.limit.acquire(time.time() + 1)
+        self.limit.release(1.5, False)
+        self.limit.release(1.5, False)
+        self.limit.release(0.1, True)
+        self.assertAlmostEqual(2.8, self.limit.limit, places=1)
+        self.limit.last_decrease = 0
+        self.limit.acquire(time.time() + 1)
+        self.limit.release(0.1, True)
+        self.assertAlmostEqual(1.96, self.limit.limit, places=2)
+
+    def test_minimum(self):
+        for _ in range(10):
+            self.limit.last_decrease = 0
+            self.limit.acquire(time.time() + 1)
+            self.limit.release(0.1, True)
+        self.assertEqual(1, self.limit.limit)
+
+    def test_acquire_waits_for_a_slot(self):
+        limit = AdaptiveLimit(initial=1, minimum=1, maximum=1, target_latency=1)
+        self.assertTrue(limit.acquire(time.time() + 1))
+        self.assertFalse(limit.acquire(time.time() + 0.01))
+        timer = threading.Timer(0.05, limit.release, (0.1, False))
+        timer.start()
+        self.assertTrue(limit.acquire(time.time() + 1))
+        timer.join()
+        self.assertEqual(1, limit.in_flight)
+
+
+class GovernorTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+
+    def rejected(self):
+        return dict((dict(labels)["reason"], value)
+                    for name, labels, value in metrics.registry.snapshot()["counters"]
+                    if name == "hcaas_zabbix_rejected_total")
+
+    def test_call(self):
+        governor = Governor(rate=100, max_in_flight=2)
+        with governor.call("host.get"):
+            self.assertEqual(1, governor.limit("host.get").in_flight)
+        self.assertEqual(0, governor.limit("host.get").in_flight)
+        self.assertEqual([
+            ("hcaas_zabbix_concurrency_limit", (("method", "host.get"),), 2),
+            ("hcaas_zabbix_in_flight", (("method", "host.get"),), 0),
+        ], governor.gauges())
+
+    def test_rate_limit(self):
+        governor = Governor(rate=1, burst=1, max_wait=0.1)
+        with governor.call("host.create"):
+            pass
+        with self.assertRaises(ZabbixOverloadedError) as cm:
+            with governor.call("host.create"):
+                pass
+        self.assertEqual("rate", cm.exception.reason)
+        self.assertGreater(cm.exception.retry_after, 0.5)
+        self.assertEqual({"rate": 1}, self.rejected())
+
+    def test_concurrency_limit_per_method(self):
+        governor = Governor(max_in_flight=1, max_wait=0.01)
+        with governor.call("host.create"):
+            with governor.call("host.get"):
+                pass
+            with self.assertRaises(ZabbixOverloadedError) as cm:
+                with governor.call("host.create"):
+                    pass
+        self.assertEqual("concurrency", cm.exception.reason)
+        self.assertEqual({"concurrency": 1}, self.rejected())
+
+    def test_request_errors_cut_the_limit(self):
+        governor = Governor(max_in_flight=10)
+        with self.assertRaises(requests.ConnectionError):
+            with governor.call("host.create"):
+                raise requests.ConnectionError()
+        self.assertEqual(7, governor.limit("host.create").limit)
+
+    def test_zabbix_errors_do_not_cut_the_limit(self):
+        governor = Governor(max_in_flight=10)
+        with self.assertRaises(ValueError):
+            with governor.call("host.create"):
+                raise ValueError()
+        self.assertEqual(10, governor.limit("host.create").limit)
+
+    @mock.patch("time.sleep")
+    def test_queued_calls_sleep(self, sleep):
+        governor = Governor(rate=10, burst=1)
+        with governor.call("host.get"):
+            pass
+        with governor.call("host.get"):
+            pass
+        self.assertEqual(1, sleep.call_count)
+
+    @mock.patch("healthcheck.backends.governor._governor", None)
+    @mock.patch.dict(os.environ, {"ZABBIX_RATE_LIMIT": "20", "ZABBIX_RATE_BURST": "8",
+                                  "ZABBIX_PROCESSES": "4"})
+    def test_shared_governor_splits_the_rate_limit(self):
+        governor = shared_governor()
+        self.assertEqual(5, governor.bucket.rate)
+        self.assertEqual(2, governor.bucket.burst)
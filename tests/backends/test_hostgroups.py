@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+import unittest
+
+from healthcheck.backends.hostgroups import HostGroupIndex
+
+
+class HostGroupIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = HostGroupIndex(ttl=60)
+        self.index.load([
+            {"groupid": "3", "name": "tsuru-web"},
+            {"groupid": "1", "name": "Databases"},
+            {"groupid": "2", "name": "tsuru-api"},
+            {"groupid": "4", "name": "tsurudb"},
+        ])
+
+    def test_not_loaded(self):
+        index = HostGroupIndex()
+        self.assertFalse(index.loaded)
+        self.assertTrue(index.stale)
+        self.assertEqual([], index.search())
+
+    def test_loaded(self):
+        self.assertTrue(self.index.loaded)
+        self.assertFalse(self.index.stale)
+        self.index.loaded_at -= 61
+        self.assertTrue(self.index.stale)
+
+    def test_search_all(self):
+        self.assertEqual(["Databases", "tsuru-api", "tsuru-web", "tsurudb"],
+                         self.index.search())
+
+    def test_search_prefix(self):
+        self.assertEqual(["tsuru-api", "tsuru-web"], self.index.search("tsuru-"))
+        self.assertEqual(["tsuru-api", "tsuru-web", "tsurudb"], self.index.search("TSURU"))
+        self.assertEqual(["Databases"], self.index.search("data"))
+        self.assertEqual([], self.index.search("zz"))
+
+    def test_get_id(self):
+        self.assertEqual("2", self.index.get_id("tsuru-api"))
+        self.assertEqual(None, self.index.get_id("tsuru"))
+
+    def test_names(self):
+        self.assertEqual(["Databases", "tsuru-api"], self.index.names(["2", "1", "9"]))
+
+    def test_add(self):
+        self.index.add("tsuru-cache", "5")
+        self.assertEqual("5", self.index.get_id("tsuru-cache"))
+        self.assertEqual(["tsuru-api", "tsuru-cache", "tsuru-web"],
+                         self.index.search("tsuru-"))
+
+    def test_refresh_async(self):
+        done = threading.Event()
+
+        def fetch():
+            done.set()
+            return [{"groupid": "9", "name": "fresh"}]
+        self.index.refresh_async(fetch)
+        done.wait(1)
+        for _ in range(100):
+            if not self.index.refreshing:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(["fresh"], self.index.search())
+        self.assertEqual(2, self.index.refreshes)
+
+    def test_refresh_async_failure_keeps_data(self):
+        def fetch():
+            raise ValueError()
+        self.index._refresh(fetch)
+        self.assertFalse(self.index.refreshing)
+        self.assertEqual("2", self.index.get_id("tsuru-api"))
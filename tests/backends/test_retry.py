@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+import requests
+from requests.packages.urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from healthcheck import deadlines, metrics
+from healthcheck.backends import retry
+from healthcheck.backends.retry import RetryBudget, RetryPolicy
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+def connection_refused():
+    reason = NewConnectionError(None, "Connection refused")
+    return requests.ConnectionError(MaxRetryError(None, "/api_jsonrpc.php", reason))
+
+
+class ClassificationTest(unittest.TestCase):
+
+    def test_idempotent(self):
+        for method in ("host.get", "apiinfo.version", "user.login", "usergroup.update",
+                       "httptest.delete"):
+            self.assertTrue(retry.idempotent(method), method)
+        for method in ("host.create", "httptest.create", "usergroup.massadd"):
+            self.assertFalse(retry.idempotent(method), method)
+
+    def test_transient(self):
+        self.assertTrue(retry.transient(requests.ConnectionError()))
+        self.assertTrue(retry.transient(requests.ReadTimeout()))
+        self.assertTrue(retry.transient(http_error(502)))
+        self.assertTrue(retry.transient(http_error(429)))
+        self.assertFalse(retry.transient(http_error(412)))
+
+    def test_not_sent(self):
+        self.assertTrue(retry.not_sent(requests.ConnectTimeout()))
+        self.assertTrue(retry.not_sent(connection_refused()))
+        self.assertFalse(retry.not_sent(requests.ReadTimeout()))
+        self.assertFalse(retry.not_sent(requests.ConnectionError("Connection aborted.")))
+
+
+class RetryBudgetTest(unittest.TestCase):
+
+    def test_reserve(self):
+        budget = RetryBudget(ratio=0.5, reserve=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+    def test_calls_refill_the_budget(self):
+        budget = RetryBudget(ratio=0.5, reserve=2)
+        budget.tokens = 0
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+        for _ in range(10):
+            budget.deposit()
+        self.assertEqual(2, budget.tokens)
+
+
+@mock.patch("time.sleep")
+class RetryPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+        self.policy = RetryPolicy(attempts=3, backoff=0.1, max_backoff=1)
+
+    def counters(self, name):
+        return dict((tuple(value for _, value in labels), count)
+                    for metric, labels, count in metrics.registry.snapshot()["counters"]
+                    if metric == name)
+
+    def test_delay(self, sleep):
+        for attempt in range(6):
+            delay = self.policy.delay(attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(1, 0.1 * 2 ** attempt))
+
+    def test_retries_until_success(self, sleep):
+        fn = mock.Mock(side_effect=[requests.ConnectionError(), http_error(503), "ok"])
+        self.assertEqual("ok", self.policy.call("host.get", True, fn, 1))
+        fn.assert_called_with(1)
+        self.assertEqual(2, sleep.call_count)
+        self.assertEqual({("host.get",): 2}, self.counters("hcaas_zabbix_retries_total"))
+
+    def test_gives_up_after_the_attempts(self, sleep):
+        fn = mock.Mock(side_effect=requests.ConnectionError())
+        with self.assertRaises(requests.ConnectionError):
+            self.policy.call("host.get", True, fn)
+        self.assertEqual(3, fn.call_count)
+        self.assertEqual({("host.get", "attempts"): 1},
+                         self.counters("hcaas_zabbix_retries_skipped_total"))
+
+    def test_unsafe_calls_are_retried_only_when_not_sent(self, sleep):
+        fn = mock.Mock(side_effect=[connection_refused(), requests.ReadTimeout()])
+        with self.assertRaises(requests.ReadTimeout):
+            self.policy.call("host.create", False, fn)
+        self.assertEqual(2, fn.call_count)
+        self.assertEqual({("host.create", "unsafe"): 1},
+                         self.counters("hcaas_zabbix_retries_skipped_total"))
+
+    def test_other_errors_are_not_retried(self, sleep):
+        fn = mock.Mock(side_effect=ValueError())
+        with self.assertRaises(ValueError):
+            self.policy.call("host.get", True, fn)
+        fn = mock.Mock(side_effect=http_error(404))
+        with self.assertRaises(requests.HTTPError):
+            self.policy.call("host.get", True, fn)
+        self.assertFalse(sleep.called)
+
+    def test_budget(self, sleep):
+        self.policy.budget = RetryBudget(ratio=0, reserve=1)
+        fn = mock.Mock(side_effect=requests.ConnectionError())
+        with self.assertRaises(requests.ConnectionError):
+            self.policy.call("host.get", True, fn)
+        self.assertEqual(2, fn.call_count)
+        self.assertEqual({("host.get", "budget"): 1},
+                         self.counters("hcaas_zabbix_retries_skipped_total"))
+
+    def test_deadline(self, sleep):
+        fn = mock.Mock(side_effect=requests.ConnectionError())
+        with mock.patch.object(self.policy, "delay", return_value=0.5):
+            with deadlines.override(deadlines.Deadline(0.2)):
+                with self.assertRaises(requests.ConnectionError):
+                    self.policy.call("host.get", True, fn)
+        self.assertEqual(1, fn.call_count)
+        self.assertEqual({("host.get", "deadline"): 1},
+                         self.counters("hcaas_zabbix_retries_skipped_total"))
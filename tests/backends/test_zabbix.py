@@ -8,15 +8,49 @@ import unittest
 
 import mock
 
-from healthcheck.backends import (WatcherAlreadyRegisteredError,
+from healthcheck import deadlines
+from healthcheck.backends import (GroupNotExists, MongoReader, WatcherAlreadyRegisteredError,
                                   WatcherNotInInstanceError, get_value)
-from healthcheck.storage import Item, User, HealthCheck, UserNotFoundError
+from healthcheck.backends.breaker import ZabbixUnavailableError
+from healthcheck.backends.hostgroups import HostGroupIndex
+from healthcheck.deadlines import DeadlineExceededError
+from healthcheck.locks import LockLostError
+from healthcheck.storage import (CachedStorage, Item, User, HealthCheck,
+                                 UserNotFoundError)
+
+
+class ImmediateBatch(object):
+
+    def __init__(self, zapi):
+        self.zapi = zapi
+
+    def __getattr__(self, name):
+        return ImmediateBatchObject(getattr(self.zapi, name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class ImmediateBatchObject(object):
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __getattr__(self, name):
+        method = getattr(self.obj, name)
+
+        def fn(*args, **kwargs):
+            return mock.Mock(result=method(*args, **kwargs), error=None)
+        return fn
 
 
 class ZabbixTest(unittest.TestCase):
 
     @mock.patch("healthcheck.storage.MongoStorage")
-    @mock.patch("pyzabbix.ZabbixAPI")
+    @mock.patch("healthcheck.backends.client.ZabbixClient")
     def setUp(self, zabbix_mock, mongo_mock):
         os.environ["ZABBIX_URL"] = self.url = "http://zbx.com"
         os.environ["ZABBIX_USER"] = self.user = "user"
@@ -25,6 +59,7 @@ class ZabbixTest(unittest.TestCase):
         os.environ["ZABBIX_HOST_GROUP"] = "2"
         zapi_mock = mock.Mock()
         zapi_mock.trigger.get.return_value = {"result": [{"comments": "teste"}]}
+        zapi_mock.batch.side_effect = lambda: ImmediateBatch(zapi_mock)
         zabbix_mock.return_value = zapi_mock
 
         instance_mock = mock.Mock()
@@ -32,12 +67,13 @@ class ZabbixTest(unittest.TestCase):
 
         from healthcheck.backends import Zabbix
         self.backend = Zabbix()
-        zabbix_mock.assert_called_with(self.url)
+        zabbix_mock.assert_called_with(self.url, timeout=30)
         zapi_mock.login.assert_called_with(self.user, self.password)
 
         mongo_mock.assert_called_with()
-        instance_mock.conn.assert_called_with()
+        self.assertFalse(instance_mock.conn.called)
         self.backend.storage = mock.Mock()
+        self.backend.host_groups = HostGroupIndex()
 
     def test_get_value(self):
         url = get_value("ZABBIX_URL")
@@ -109,6 +145,9 @@ class ZabbixTest(unittest.TestCase):
         self.backend.storage.find_healthcheck_by_name.return_value = hmock
 
         self.backend.add_url(hc_name, url, expected_string="WORKING")
+        item = self.backend.storage.add_item.call_args[0][0]
+        self.assertEqual("WORKING", item.expected_string)
+        self.assertEqual("", item.comment)
 
         self.backend.storage.find_healthcheck_by_name.assert_called_with(
             hc_name)
@@ -141,6 +180,9 @@ class ZabbixTest(unittest.TestCase):
         self.backend.storage.find_healthcheck_by_name.return_value = hmock
 
         self.backend.add_url(hc_name, url, comment="http://test.com")
+        item = self.backend.storage.add_item.call_args[0][0]
+        self.assertEqual("http://test.com", item.comment)
+        self.assertEqual(None, item.expected_string)
         self.backend.zapi.trigger.create.assert_called_with(
             description="trigger for url {}".format(url),
             expression='{hc_name:web.test.rspcode[hc for http://mysite.com,hc for http://mysite.com].last()}<>200 \
@@ -193,6 +235,124 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
         self.backend._add_action.assert_called_with(url, 1, 13)
         self.backend._add_action = old_add_action
 
+    def test_add_url_compensates_when_action_fails(self):
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["1"]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": ["2"]}
+        self.backend.zapi.action.create.side_effect = Exception("invalid action")
+        hmock = mock.Mock(host_id="1", group_id=13)
+        self.backend.storage.find_healthcheck_by_name.return_value = hmock
+
+        with self.assertRaises(Exception):
+            self.backend.add_url("hc_name", "http://mysite.com")
+
+        self.backend.zapi.trigger.delete.assert_called_once_with("2")
+        self.backend.zapi.httptest.delete.assert_called_once_with("1")
+        self.assertFalse(self.backend.zapi.action.delete.called)
+        self.assertFalse(self.backend.storage.add_item.called)
+
+    def test_add_url_reads_healthcheck_once(self):
+        mongo = mock.Mock()
+        mongo.find_healthcheck_by_name.return_value = mock.Mock(host_id="1", group_id=13)
+        self.backend.storage = CachedStorage(mongo)
+        self.backend.zapi.httptest.create.return_value = {"httptestids": [1]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": [1]}
+        self.backend.zapi.action.create.return_value = {"actionids": [1]}
+
+        self.backend.add_url("hc_name", "http://mysite.com")
+
+        mongo.find_healthcheck_by_name.assert_called_once_with("hc_name")
+        self.assertEqual({"reads": 1, "hits": 1}, self.backend.storage.stats())
+
+    def test_add_urls(self):
+        hc_name = "hc_name"
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["1", "2"]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": ["3", "4"]}
+        self.backend.zapi.action.create.return_value = {"actionids": ["5", "6"]}
+        hmock = mock.Mock(host_id="1", group_id=13)
+        self.backend.storage.find_healthcheck_by_name.return_value = hmock
+        urls = [
+            {"url": "http://a.com"},
+            {"url": "http://b.com", "expected_string": "OK", "comment": "restart b"},
+        ]
+
+        result = self.backend.add_urls(hc_name, urls)
+
+        self.assertEqual([
+            {"url": "http://a.com", "item_id": "1", "trigger_id": "3", "action_id": "5"},
+            {"url": "http://b.com", "item_id": "2", "trigger_id": "4", "action_id": "6"},
+        ], result)
+        self.backend.storage.find_healthcheck_by_name.assert_called_once_with(hc_name)
+        self.backend.zapi.httptest.create.assert_called_once_with(
+            self.backend._httptest_params(hmock, "http://a.com"),
+            self.backend._httptest_params(hmock, "http://b.com", "OK"),
+        )
+        self.backend.zapi.trigger.create.assert_called_once_with(
+            self.backend._trigger_params(hc_name, "http://a.com"),
+            self.backend._trigger_params(hc_name, "http://b.com", "restart b"),
+        )
+        self.backend.zapi.action.create.assert_called_once_with(
+            self.backend._action_params("http://a.com", "3", 13),
+            self.backend._action_params("http://b.com", "4", 13),
+        )
+        items = self.backend.storage.add_items.call_args[0][0]
+        self.assertEqual(1, self.backend.storage.add_items.call_count)
+        self.assertEqual(["http://a.com", "http://b.com"], [i.url for i in items])
+        self.assertEqual(["", "restart b"], [i.comment for i in items])
+        self.assertEqual([None, "OK"], [i.expected_string for i in items])
+        self.assertEqual([13, 13], [i.group_id for i in items])
+
+    def test_add_urls_removes_httptests_on_failure(self):
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["1", "2"]}
+        self.backend.zapi.trigger.create.side_effect = ValueError()
+        hmock = mock.Mock(host_id="1", group_id=13)
+        self.backend.storage.find_healthcheck_by_name.return_value = hmock
+
+        with self.assertRaises(ValueError):
+            self.backend.add_urls("hc", [{"url": "http://a.com"}, {"url": "http://b.com"}])
+
+        self.backend.zapi.httptest.delete.assert_called_once_with("1", "2")
+        self.assertFalse(self.backend.storage.add_items.called)
+
+    def test_add_urls_removes_zabbix_objects_when_storage_fails(self):
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["1"]}
+        self.backend.zapi.trigger.create.return_value = {"triggerids": ["2"]}
+        self.backend.zapi.action.create.return_value = {"actionids": ["3"]}
+        self.backend.storage.find_healthcheck_by_name.return_value = mock.Mock(host_id="1",
+                                                                               group_id=13)
+        self.backend.storage.add_items.side_effect = ValueError()
+
+        with self.assertRaises(ValueError):
+            self.backend.add_urls("hc", [{"url": "http://a.com"}])
+
+        self.backend.zapi.action.delete.assert_called_once_with("3")
+        self.backend.zapi.httptest.delete.assert_called_once_with("1")
+
+    def test_add_urls_undo_past_the_deadline(self):
+        remaining = []
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["1"]}
+        self.backend.zapi.httptest.delete.side_effect = \
+            lambda *ids: remaining.append(deadlines.remaining())
+        self.backend.storage.find_healthcheck_by_name.return_value = mock.Mock(host_id="1",
+                                                                               group_id=13)
+        self.backend.zapi.trigger.create.side_effect = DeadlineExceededError("zabbix",
+                                                                             "trigger.create")
+
+        with deadlines.override(deadlines.Deadline(-1)):
+            with self.assertRaises(DeadlineExceededError):
+                self.backend.add_urls("hc", [{"url": "http://a.com"}])
+
+        self.assertGreater(remaining[0], 0)
+
+    def test_add_urls_keeps_the_error_when_the_undo_fails(self):
+        self.backend.zapi.httptest.create.return_value = {"httptestids": ["1"]}
+        self.backend.zapi.httptest.delete.side_effect = KeyError()
+        self.backend.zapi.trigger.create.side_effect = ValueError()
+        self.backend.storage.find_healthcheck_by_name.return_value = mock.Mock(host_id="1",
+                                                                               group_id=13)
+
+        with self.assertRaises(ValueError):
+            self.backend.add_urls("hc", [{"url": "http://a.com"}])
+
     def test_remove_url(self):
         url = "http://mysite.com"
         item_id = 1
@@ -205,16 +365,73 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
             action_id=action_id
         )
         self.backend.storage.find_item_by_url.return_value = item
-        old_action = self.backend._remove_action
-        self.backend._remove_action = mock.Mock()
 
         self.backend.remove_url("hc_name", url)
 
-        self.backend._remove_action.assert_called_with(8)
+        self.backend.zapi.action.delete.assert_called_with(8)
         self.backend.zapi.httptest.delete.assert_called_with(item_id)
-        self.backend._remove_action = old_action
         self.backend.storage.remove_item.assert_called_with(item)
 
+    def test_list_urls(self):
+        self.backend.storage.find_items_by_healthcheck_name.return_value = [
+            Item("http://a.com", trigger_id="1", comment=""),
+            Item("http://b.com", trigger_id="2", comment="restart b"),
+        ]
+
+        urls = self.backend.list_urls("hc")
+
+        self.assertEqual([["http://a.com", ""],
+                          ["http://b.com", "restart b"]], urls)
+        self.backend.storage.find_items_by_healthcheck_name.assert_called_once_with("hc")
+        self.assertFalse(self.backend.zapi.trigger.get.called)
+
+    def test_list_urls_fills_missing_comments(self):
+        self.backend.storage.find_items_by_healthcheck_name.return_value = [
+            Item("http://a.com", trigger_id="1"),
+            Item("http://b.com", trigger_id="2", comment="restart b"),
+            Item("http://c.com", trigger_id="3"),
+        ]
+        self.backend.zapi.trigger.get.return_value = [
+            {"triggerid": "1", "comments": "restart a"},
+        ]
+
+        urls = self.backend.list_urls("hc")
+
+        self.assertEqual([["http://a.com", "restart a"],
+                          ["http://b.com", "restart b"],
+                          ["http://c.com", ""]], urls)
+        self.backend.zapi.trigger.get.assert_called_once_with(
+            triggerids=["1", "3"],
+            output=["triggerid", "comments"],
+        )
+        items = self.backend.storage.update_items_comment.call_args[0][0]
+        self.assertEqual(["http://a.com", "http://c.com"], [i.url for i in items])
+
+    def test_list_urls_empty(self):
+        self.backend.storage.find_items_by_healthcheck_name.return_value = []
+        self.assertEqual([], self.backend.list_urls("hc"))
+        self.assertFalse(self.backend.zapi.trigger.get.called)
+
+    def test_backfill_comments(self):
+        items = [Item("http://{}.com".format(i), trigger_id=str(i)) for i in range(5)]
+        self.backend.storage.find_items_without_comment.return_value = iter(items)
+        self.backend.zapi.trigger.get.side_effect = [
+            [{"triggerid": "0", "comments": "c0"}, {"triggerid": "1", "comments": "c1"}],
+            [{"triggerid": "3", "comments": "c3"}],
+            [],
+        ]
+
+        count = self.backend.backfill_comments(chunk_size=2)
+
+        self.assertEqual(5, count)
+        self.assertEqual([
+            mock.call(triggerids=["0", "1"], output=["triggerid", "comments"]),
+            mock.call(triggerids=["2", "3"], output=["triggerid", "comments"]),
+            mock.call(triggerids=["4"], output=["triggerid", "comments"]),
+        ], self.backend.zapi.trigger.get.call_args_list)
+        self.assertEqual(3, self.backend.storage.update_items_comment.call_count)
+        self.assertEqual(["c0", "c1", "", "c3", ""], [i.comment for i in items])
+
     def test_add_watcher(self):
         email = "andrews@corp.globo.com"
         name = "hc_name"
@@ -364,13 +581,13 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
         group = "mygroup"
         hmock = mock.Mock(group_id="someid", host_id="somehostid", host_groups=[])
         self.backend.storage.find_healthcheck_by_name.return_value = hmock
-        self.backend.zapi.hostgroup.get.return_value = [{"groupid": 1}]
+        self.backend.zapi.hostgroup.get.return_value = [{"groupid": 1, "name": group}]
 
         self.backend.add_group(name, group)
 
         self.backend.storage.find_healthcheck_by_name.assert_called_with(name)
-        self.backend.zapi.hostgroup.get.assert_called_with(
-            filter={"name": [group]},
+        self.backend.zapi.hostgroup.get.assert_called_once_with(
+            output=["groupid", "name"],
         )
         self.backend.zapi.usergroup.update.assert_called_with(
                 usrgrpid="someid",
@@ -382,13 +599,105 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
         )
         self.assertTrue(self.backend.storage.add_group_to_instance.called)
 
+    def test_add_group_locks_the_instance(self):
+        hmock = mock.Mock(group_id="someid", host_id="somehostid", host_groups=[])
+        self.backend.storage.find_healthcheck_by_name.return_value = hmock
+        self.backend.storage.acquire_lock.return_value = 7
+        self.backend.zapi.hostgroup.get.return_value = [{"groupid": 1, "name": "mygroup"}]
+
+        self.backend.add_group("hc_name", "mygroup")
+
+        self.backend.storage.acquire_lock.assert_called_once_with("hc_name", 120)
+        self.assertEqual([mock.call("hc_name", 7, 120)] * 2,
+                         self.backend.storage.renew_lock.call_args_list)
+        self.backend.storage.release_lock.assert_called_once_with("hc_name", 7)
+        self.assertIsNone(self.backend.lock)
+
+    def test_add_group_lost_lock(self):
+        hmock = mock.Mock(group_id="someid", host_id="somehostid", host_groups=[])
+        self.backend.storage.find_healthcheck_by_name.return_value = hmock
+        self.backend.storage.renew_lock.return_value = False
+        self.backend.zapi.hostgroup.get.return_value = [{"groupid": 1, "name": "mygroup"}]
+
+        with self.assertRaises(LockLostError):
+            self.backend.add_group("hc_name", "mygroup")
+
+        self.assertFalse(self.backend.zapi.usergroup.update.called)
+        self.assertFalse(self.backend.storage.add_group_to_instance.called)
+
+    def test_add_group_lost_lock_before_host_update(self):
+        hmock = mock.Mock(group_id="someid", host_id="somehostid", host_groups=[])
+        self.backend.storage.find_healthcheck_by_name.return_value = hmock
+        self.backend.storage.renew_lock.side_effect = [True, False]
+        self.backend.zapi.hostgroup.get.return_value = [{"groupid": 1, "name": "mygroup"}]
+
+        with self.assertRaises(LockLostError):
+            self.backend.add_group("hc_name", "mygroup")
+
+        self.assertTrue(self.backend.zapi.usergroup.update.called)
+        self.assertFalse(self.backend.zapi.host.update.called)
+
+    def test_new_lost_lock(self):
+        self.backend.storage.renew_lock.return_value = False
+
+        with self.assertRaises(LockLostError):
+            self.backend.new("blah")
+
+        self.assertFalse(self.backend.zapi.host.create.called)
+        self.assertFalse(self.backend.zapi.usergroup.create.called)
+        self.assertFalse(self.backend.storage.add_healthcheck.called)
+
+    def test_add_watcher_lost_lock(self):
+        self.backend.storage.find_healthcheck_by_name.return_value = mock.Mock(group_id="g")
+        self.backend.storage.find_user_by_email.side_effect = UserNotFoundError()
+        self.backend.storage.renew_lock.return_value = False
+
+        with self.assertRaises(LockLostError):
+            self.backend.add_watcher("hc_name", "w@w.com")
+
+        self.assertFalse(self.backend.zapi.user.create.called)
+
+    def test_remove_url_records_the_deletes_after_losing_the_lock(self):
+        item = Item("http://a.com", item_id="1", action_id="2")
+        self.backend.storage.find_item_by_url.return_value = item
+        self.backend.storage.renew_lock.side_effect = [True, False]
+
+        self.backend.remove_url("hc_name", "http://a.com")
+
+        self.backend.storage.remove_item.assert_called_once_with(item)
+
+    def test_add_url_lost_lock(self):
+        self.backend.storage.find_healthcheck_by_name.return_value = mock.Mock(host_id="1", group_id=13)
+        self.backend.storage.renew_lock.return_value = False
+
+        with self.assertRaises(LockLostError):
+            self.backend.add_url("hc_name", "http://mysite.com")
+
+        self.assertFalse(self.backend.zapi.httptest.create.called)
+        self.assertFalse(self.backend.storage.add_item.called)
+
+    def test_remove_lost_lock(self):
+        hmock = mock.Mock(group_id="someid", host_id="somehostid")
+        self.backend.storage.find_healthcheck_by_name.return_value = hmock
+        self.backend.storage.find_items_by_group.return_value = []
+        self.backend.storage.find_users_by_group.return_value = []
+        self.backend.storage.renew_lock.side_effect = [True, False]
+
+        with self.assertRaises(LockLostError):
+            self.backend.remove("hc_name")
+
+        self.assertEqual(1, self.backend.zapi.batch.call_count)
+        self.assertFalse(self.backend.zapi.usergroup.delete.called)
+        self.assertFalse(self.backend.storage.remove_healthcheck.called)
+
     def test_remove_group(self):
         hmock = mock.Mock(group_id="someid", host_id="somehostid", host_groups=[1, 2])
         group = "mygroup"
         self.backend.storage.find_healthcheck_by_name.return_value = hmock
-        self.backend.zapi.hostgroup.get.return_value = [{"groupid": 2}]
+        self.backend.host_groups.load([{"groupid": 2, "name": group}])
 
         self.backend.remove_group("healthcheck", group)
+        self.assertFalse(self.backend.zapi.hostgroup.get.called)
         self.backend.zapi.usergroup.update.assert_called_with(
                 usrgrpid="someid",
                 rights=[{"permission": 2, "id": 1}]
@@ -411,37 +720,92 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
         self.assertEqual(groups, ["mygroup1", "mygroup2"])
 
     def test_list_service_groups(self):
-        self.backend.zapi.hostgroup.get.return_value = [{"name": "mygroup1"}, {"name": "mygroup2"}]
+        self.backend.zapi.hostgroup.get.return_value = [
+            {"groupid": "2", "name": "mygroup2"},
+            {"groupid": "1", "name": "mygroup1"},
+        ]
 
         groups = self.backend.list_service_groups()
-        self.backend.zapi.hostgroup.get.assert_called_with()
+        self.backend.zapi.hostgroup.get.assert_called_with(output=["groupid", "name"])
         self.assertEqual(groups, ["mygroup1", "mygroup2"])
 
+        self.backend.list_service_groups()
+        self.assertEqual(1, self.backend.zapi.hostgroup.get.call_count)
+
     def test_list_service_groups_keyword(self):
-        self.backend.zapi.hostgroup.get.return_value = [{"name": "mygroup1"}, {"name": "mygroup2"}]
+        self.backend.zapi.hostgroup.get.return_value = [
+            {"groupid": "1", "name": "mygroup1"},
+            {"groupid": "2", "name": "othergroup"},
+            {"groupid": "3", "name": "MyGroup2"},
+        ]
+
+        groups = self.backend.list_service_groups("mygroup")
+        self.assertEqual(groups, ["mygroup1", "MyGroup2"])
+        self.assertEqual([], self.backend.list_service_groups("zzz"))
+        self.assertEqual(1, self.backend.zapi.hostgroup.get.call_count)
+
+    def test_list_service_groups_stale_index(self):
+        self.backend.host_groups.load([{"groupid": "1", "name": "old"}])
+        self.backend.host_groups.loaded_at -= 1000
+        self.backend.host_groups.refresh_async = mock.Mock()
+
+        self.assertEqual(["old"], self.backend.list_service_groups())
+        self.assertTrue(self.backend.host_groups.refresh_async.called)
+        self.assertFalse(self.backend.zapi.hostgroup.get.called)
+
+    def test_get_host_group_id_not_in_index(self):
+        self.backend.host_groups.load([])
+        self.backend.zapi.hostgroup.get.return_value = [{"groupid": "7", "name": "new"}]
+
+        self.assertEqual("7", self.backend._get_host_group_id("new"))
+        self.backend.zapi.hostgroup.get.assert_called_with(
+            filter={"name": ["new"]}, output=["groupid", "name"])
+        self.assertEqual("7", self.backend.host_groups.get_id("new"))
 
-        groups = self.backend.list_service_groups("my")
-        self.backend.zapi.hostgroup.get.assert_called_with(search={'name': ['my']}, startSearch=True)
-        self.assertEqual(groups, ["mygroup1", "mygroup2"])
+    def test_get_host_group_id_not_exists(self):
+        self.backend.host_groups.load([])
+        self.backend.zapi.hostgroup.get.return_value = []
+
+        with self.assertRaises(GroupNotExists):
+            self.backend._get_host_group_id("nope")
 
     def test_new(self):
         name = "blah"
+        self.backend.zapi.host.create.return_value = {"hostids": ["10"]}
+        self.backend.zapi.usergroup.create.return_value = {"usrgrpids": ["20"]}
 
-        old_create_user_group = self.backend._create_user_group
-        self.backend._create_user_group = mock.Mock()
+        self.backend.new(name)
 
-        old_add_host = self.backend._add_host
-        self.backend._add_host = mock.Mock()
+        self.backend.zapi.host.create.assert_called_once_with(
+            **self.backend._host_params(name, "2"))
+        self.backend.zapi.usergroup.create.assert_called_once_with(
+            **self.backend._user_group_params(name, "2"))
+        hc = self.backend.storage.add_healthcheck.call_args[0][0]
+        self.assertEqual("10", hc.host_id)
+        self.assertEqual("20", hc.group_id)
+        self.assertEqual(["2"], hc.host_groups)
 
-        self.backend.new(name)
+    def test_new_removes_host_when_user_group_fails(self):
+        self.backend.zapi.host.create.return_value = {"hostids": ["10"]}
+        self.backend.zapi.usergroup.create.side_effect = Exception("already exists")
 
-        self.backend._create_user_group.assert_called_with(name, "2")
-        self.backend._create_user_group = old_create_user_group
+        with self.assertRaises(Exception):
+            self.backend.new("blah")
 
-        self.backend._add_host.assert_called_with(name, "2")
-        self.backend._add_host = old_add_host
+        self.backend.zapi.host.delete.assert_called_once_with("10")
+        self.assertFalse(self.backend.zapi.usergroup.delete.called)
+        self.assertFalse(self.backend.storage.add_healthcheck.called)
 
-        self.assertTrue(self.backend.storage.add_healthcheck.called)
+    def test_new_removes_zabbix_objects_when_storage_fails(self):
+        self.backend.zapi.host.create.return_value = {"hostids": ["10"]}
+        self.backend.zapi.usergroup.create.return_value = {"usrgrpids": ["20"]}
+        self.backend.storage.add_healthcheck.side_effect = Exception("duplicated key")
+
+        with self.assertRaises(Exception):
+            self.backend.new("blah")
+
+        self.backend.zapi.host.delete.assert_called_once_with("10")
+        self.backend.zapi.usergroup.delete.assert_called_once_with("20")
 
     def test_remove_user_group(self):
         self.backend._remove_user_group("id")
@@ -487,110 +851,85 @@ or {hc_name:web.test.fail[hc for http://mysite.com].last()}<>0 and {hc_name:web.
     def test_remove(self):
         name = "blah"
         id = "someid"
-        url = 'http://test.com/healthcheck'
-
-        old_remove_url = self.backend.remove_url
-        self.backend.remove_url = mock.Mock()
-        old_remove_watcher = self.backend.remove_watcher
-        self.backend.remove_watcher = mock.Mock()
-        self.backend.storage.find_urls_by_healthcheck_name.return_value = [url]
 
         hmock = mock.Mock(group_id=id, host_id=id)
         self.backend.storage.find_healthcheck_by_name.return_value = hmock
-        watchers = ['test@example.com']
-        self.backend.storage.find_watchers_by_healthcheck_name.return_value = watchers
-        user = User("123", "email@email.com", id)
-        self.backend.storage.find_user_by_email.return_value = user
+        self.backend.storage.find_items_by_group.return_value = []
+        self.backend.storage.find_users_by_group.return_value = []
 
         self.backend.remove(name)
 
-        self.backend.storage.find_urls_by_healthcheck_name.assert_called_with(name)
+        self.backend.storage.find_healthcheck_by_name.assert_called_once_with(name)
+        self.assertFalse(self.backend.zapi.action.delete.called)
+        self.assertFalse(self.backend.zapi.httptest.delete.called)
+        self.assertFalse(self.backend.zapi.user.delete.called)
         self.backend.zapi.usergroup.delete.assert_called_with(id)
         self.backend.zapi.host.delete.assert_called_with(id)
+        self.backend.storage.remove_items_by_group.assert_called_with(id)
+        self.backend.storage.remove_users.assert_called_with([])
+        self.backend.storage.remove_group_from_users.assert_called_with(id)
         self.backend.storage.remove_healthcheck.assert_called_with(hmock)
-        assert self.backend.remove_url.called
-        assert self.backend.remove_watcher.called
-
-        self.backend.remove_url = old_remove_url
-        self.backend.remove_watcher = old_remove_watcher
 
     def test_remove_with_urls(self):
         name = "blah"
-        url = "http://mysite.com"
-        item_id = 1
-        trigger_id = 2
-        action_id = 3
         group_id = "4"
         host_id = "5"
-        user_id = "6"
-        item = Item(
-            url,
-            item_id=item_id,
-            trigger_id=trigger_id,
-            action_id=action_id
-        )
-
-        self.backend.storage.find_item_by_url.return_value = item
-        self.backend.storage.find_urls_by_healthcheck_name.return_value = [url]
+        items = [
+            Item("http://a.com", item_id="1", trigger_id="2", action_id="3"),
+            Item("http://b.com", item_id="11", trigger_id="12", action_id="13"),
+        ]
         hc = HealthCheck(name, group_id=group_id, host_id=host_id)
         self.backend.storage.find_healthcheck_by_name.return_value = hc
-        watchers = ['test@example.com']
-        self.backend.storage.find_watchers_by_healthcheck_name.return_value = watchers
-        user = User(user_id, "email@email.com", group_id)
-        self.backend.storage.find_user_by_email.return_value = user
-        self.backend.zapi.trigger.get.return_value = [{"comments": "xxx"}]
+        self.backend.storage.find_items_by_group.return_value = items
+        only_here = User("6", "email@email.com", group_id)
+        elsewhere = User("7", "other@email.com", group_id, "4-2")
+        self.backend.storage.find_users_by_group.return_value = [only_here, elsewhere]
 
         self.backend.remove(name)
 
-        self.backend.zapi.usergroup.delete.assert_called_with(group_id)
-        self.backend.zapi.host.delete.assert_called_with(host_id)
-        self.backend.zapi.action.delete.assert_called_with(action_id)
-        self.backend.zapi.httptest.delete.assert_called_with(item_id)
-        self.backend.zapi.user.delete.assert_called_with(user_id)
-        self.backend.storage.remove_healthcheck.assert_called_with(hc)
-        self.backend.storage.remove_item.assert_called_with(item)
-        self.backend.storage.find_healthcheck_by_name.assert_called_with(name)
-        self.backend.storage.find_urls_by_healthcheck_name.assert_called_with(name)
-        self.backend.storage.find_item_by_url.assert_called_with(url)
+        self.assertEqual(2, self.backend.zapi.batch.call_count)
+        self.backend.storage.find_items_by_group.assert_called_once_with(group_id)
+        self.backend.storage.find_users_by_group.assert_called_once_with(group_id)
+        self.backend.zapi.action.delete.assert_called_once_with("3", "13")
+        self.backend.zapi.httptest.delete.assert_called_once_with("1", "11")
+        self.backend.zapi.user.delete.assert_called_once_with("6")
+        self.assertFalse(self.backend.zapi.usergroup.update.called)
+        self.backend.zapi.usergroup.delete.assert_called_once_with(group_id)
+        self.backend.zapi.host.delete.assert_called_once_with(host_id)
+        self.backend.storage.remove_items_by_group.assert_called_once_with(group_id)
+        self.backend.storage.remove_users.assert_called_once_with([only_here])
+        self.backend.storage.remove_group_from_users.assert_called_once_with(group_id)
+        self.backend.storage.remove_healthcheck.assert_called_once_with(hc)
+        self.assertFalse(self.backend.storage.remove_item.called)
+
+
+class MongoReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = mock.Mock()
+        self.host_groups = HostGroupIndex()
+        self.host_groups.load([{"groupid": "1", "name": "g1"}, {"groupid": "2", "name": "g2"}])
+        self.reader = MongoReader(self.storage, self.host_groups)
+
+    def test_list_urls(self):
+        item = Item("http://a.com", comment="a comment")
+        self.storage.find_items_by_healthcheck_name.return_value = [item, Item("http://b.com")]
+        self.assertEqual([["http://a.com", "a comment"], ["http://b.com", ""]],
+                         self.reader.list_urls("hc"))
+
+    def test_list_watchers(self):
+        self.storage.find_watchers_by_healthcheck_name.return_value = ["w@a.com"]
+        self.assertEqual(["w@a.com"], self.reader.list_watchers("hc"))
 
-    def test_remove_with_urls_more_than_one_group(self):
-        name = "blah"
-        url = "http://mysite.com"
-        item_id = 1
-        trigger_id = 2
-        action_id = 3
-        group_id = "4"
-        another_group_id = "4-2"
-        host_id = "5"
-        user_id = "6"
-        item = Item(
-            url,
-            item_id=item_id,
-            trigger_id=trigger_id,
-            action_id=action_id
-        )
-
-        self.backend.storage.find_item_by_url.return_value = item
-        self.backend.storage.find_urls_by_healthcheck_name.return_value = [url]
-        hc = HealthCheck(name, group_id=group_id, host_id=host_id)
-        self.backend.storage.find_healthcheck_by_name.return_value = hc
-        watchers = ['test@example.com']
-        self.backend.storage.find_watchers_by_healthcheck_name.return_value = watchers
-        user = User(user_id, "email@email.com", group_id, another_group_id)
-        self.backend.storage.find_user_by_email.return_value = user
-        self.backend.storage.find_users_by_group.return_value = [user]
-        self.backend.zapi.trigger.get.return_value = [{"comments": "xxx"}]
-
-        self.backend.remove(name)
-
-        self.backend.zapi.usergroup.delete.assert_called_with(group_id)
-        self.backend.zapi.host.delete.assert_called_with(host_id)
-        self.backend.zapi.action.delete.assert_called_with(action_id)
-        self.backend.zapi.httptest.delete.assert_called_with(item_id)
-        self.backend.zapi.usergroup.update.assert_called_with(usrgrpid=group_id, userids=[])
-        self.backend.storage.remove_healthcheck.assert_called_with(hc)
-        self.backend.storage.remove_item.assert_called_with(item)
-        self.backend.storage.find_healthcheck_by_name.assert_called_with(name)
-        self.backend.storage.find_urls_by_healthcheck_name.assert_called_with(name)
-        self.backend.storage.find_item_by_url.assert_called_with(url)
-        self.backend.storage.find_users_by_group.assert_called_with(group_id)
+    def test_list_groups(self):
+        self.storage.find_healthcheck_by_name.return_value = HealthCheck("hc", host_groups=["2"])
+        self.assertEqual(["g2"], self.reader.list_groups("hc"))
+        self.assertEqual(["g1", "g2"], self.reader.list_service_groups())
+
+    def test_groups_without_the_index(self):
+        self.reader.host_groups = HostGroupIndex()
+        self.storage.find_healthcheck_by_name.return_value = HealthCheck("hc", host_groups=["2"])
+        with self.assertRaises(ZabbixUnavailableError):
+            self.reader.list_groups("hc")
+        with self.assertRaises(ZabbixUnavailableError):
+            self.reader.list_service_groups("g")
@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+# object name -> (id field, result key of create/update/delete)
+OBJECTS = {
+    "host": ("hostid", "hostids"),
+    "hostgroup": ("groupid", "groupids"),
+    "usergroup": ("usrgrpid", "usrgrpids"),
+    "user": ("userid", "userids"),
+    "httptest": ("httptestid", "httptestids"),
+    "trigger": ("triggerid", "triggerids"),
+    "action": ("actionid", "actionids"),
+}
+
+SESSION_TERMINATED = "Session terminated, re-login, please."
+
+
+class ZabbixError(Exception):
+
+    def __init__(self, code, message, data):
+        super(ZabbixError, self).__init__(message)
+        self.code = code
+        self.message = message
+        self.data = data
+
+    def to_json(self):
+        return {"code": self.code, "message": self.message, "data": self.data}
+
+
+def invalid_params(data):
+    return ZabbixError(-32602, "Invalid params.", data)
+
+
+class FakeZabbix(object):
+
+    def __init__(self, user="admin", password="zabbix", latency=None,
+                 error_rate=None, http_error_rate=None, drop_rate=None,
+                 timeout_rate=None, http_status=503, hang=60, batch=True, seed=None):
+        self.user = user
+        self.password = password
+        # latency and error_rate map a method name (or "*" for every
+        # method) to seconds slept and fraction of calls that fail
+        self.latency = dict(latency or {})
+        self.error_rate = dict(error_rate or {})
+        # fractions of http requests answered with http_status, closed
+        # without an answer or answered only after hang seconds. A batch
+        # uses the highest rate of its methods
+        self.http_error_rate = dict(http_error_rate or {})
+        self.drop_rate = dict(drop_rate or {})
+        self.timeout_rate = dict(timeout_rate or {})
+        self.http_status = http_status
+        self.hang = hang
+        self.batch = batch
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.objects = dict((name, {}) for name in OBJECTS)
+        self.sessions = set()
+        self.last_id = 0
+        self.calls = Counter()
+        self.requests = 0
+        self.batches = 0
+        self.faults = Counter()
+
+    def add_host_groups(self, names):
+        with self.lock:
+            return [self._create("hostgroup", {"name": name})
+                    for name in names]
+
+    def expire_sessions(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def fault(self, payload):
+        # returns "http_error", "drop", "timeout" or None for a request
+        calls = payload if isinstance(payload, list) else [payload]
+        methods = [call.get("method") for call in calls if isinstance(call, dict)] or ["*"]
+        for kind, settings in (("http_error", self.http_error_rate),
+                               ("drop", self.drop_rate),
+                               ("timeout", self.timeout_rate)):
+            rate = max(self._setting(settings, method) for method in methods)
+            if rate and self.random.random() < rate:
+                with self.lock:
+                    self.faults[kind] += 1
+                return kind
+
+    def handle(self, payload):
+        with self.lock:
+            self.requests += 1
+        if isinstance(payload, list):
+            if not self.batch or not payload:
+                return self._error(None, ZabbixError(
+                    -32600, "Invalid request.", "Batch requests are not supported."))
+            with self.lock:
+                self.batches += 1
+            return [self._handle_call(call) for call in payload]
+        return self._handle_call(payload)
+
+    def _handle_call(self, call):
+        if not isinstance(call, dict) or "method" not in call:
+            return self._error(None, ZabbixError(
+                -32600, "Invalid request.", "Invalid JSON-RPC request."))
+        request_id = call.get("id")
+        method = call["method"]
+        with self.lock:
+            self.calls[method] += 1
+        time.sleep(self._setting(self.latency, method))
+        try:
+            result = self.call(method, call.get("params"), call.get("auth"))
+        except ZabbixError as e:
+            return self._error(request_id, e)
+        return {"jsonrpc": "2.0", "result": result, "id": request_id}
+
+    def _error(self, request_id, error):
+        return {"jsonrpc": "2.0", "error": error.to_json(), "id": request_id}
+
+    def _setting(self, settings, method):
+        return settings.get(method, settings.get("*", 0))
+
+    def call(self, method, params, auth):
+        if method == "apiinfo.version":
+            return "3.0.0"
+        if method in ("user.login", "user.authenticate"):
+            return self._login(params or {})
+        if auth not in self.sessions:
+            raise invalid_params(SESSION_TERMINATED)
+        if self.random.random() < self._setting(self.error_rate, method):
+            raise ZabbixError(-32500, "Application error.", "Injected failure.")
+        name, _, operation = method.partition(".")
+        if name not in OBJECTS or operation not in ("create", "get", "update", "delete"):
+            raise ZabbixError(-32601, "Method not found.",
+                              "Incorrect method \"{}\".".format(method))
+        with self.lock:
+            return getattr(self, "_" + operation + "_objects")(name, params)
+
+    def _login(self, params):
+        if params.get("user") != self.user or params.get("password") != self.password:
+            raise invalid_params("Login name or password is incorrect.")
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.sessions.add(token)
+        return token
+
+    def _create(self, name, params):
+        id_field, _ = OBJECTS[name]
+        self.last_id += 1
+        obj = dict(params)
+        obj[id_field] = str(self.last_id)
+        self.objects[name][obj[id_field]] = obj
+        return obj[id_field]
+
+    def _create_objects(self, name, params):
+        params = params if isinstance(params, list) else [params]
+        _, result_key = OBJECTS[name]
+        return {result_key: [self._create(name, p) for p in params]}
+
+    def _update_objects(self, name, params):
+        id_field, result_key = OBJECTS[name]
+        params = params if isinstance(params, list) else [params]
+        ids = []
+        for p in params:
+            obj = self._get(name, p.get(id_field))
+            obj.update(p)
+            ids.append(obj[id_field])
+        return {result_key: ids}
+
+    def _delete_objects(self, name, params):
+        _, result_key = OBJECTS[name]
+        ids = [str(i) for i in (params if isinstance(params, list) else [params])]
+        for i in ids:
+            self._get(name, i)
+        for i in ids:
+            del self.objects[name][i]
+        return {result_key: ids}
+
+    def _get(self, name, object_id):
+        obj = self.objects[name].get(str(object_id))
+        if obj is None:
+            raise invalid_params(
+                "No permissions to referred object or it does not exist!")
+        return obj
+
+    def _get_objects(self, name, params):
+        params = params or {}
+        id_field, _ = OBJECTS[name]
+        objects = list(self.objects[name].values())
+        ids = params.get(id_field + "s")
+        if ids is not None:
+            ids = set(str(i) for i in (ids if isinstance(ids, list) else [ids]))
+            objects = [o for o in objects if o[id_field] in ids]
+        for field, values in (params.get("filter") or {}).items():
+            values = values if isinstance(values, list) else [values]
+            objects = [o for o in objects if o.get(field) in values]
+        objects.sort(key=lambda o: int(o[id_field]))
+        output = params.get("output", "extend")
+        if output != "extend":
+            objects = [dict((f, o[f]) for f in output if f in o) for o in objects]
+        return objects
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            payload = json.loads(body.decode("utf-8"))
+        except ValueError:
+            response = {"jsonrpc": "2.0", "id": None, "error": ZabbixError(
+                -32700, "Parse error.", "Invalid JSON.").to_json()}
+        else:
+            zabbix = self.server.zabbix
+            fault = zabbix.fault(payload)
+            if fault == "drop":
+                self.close_connection = True
+                return
+            if fault == "http_error":
+                self.send_text(zabbix.http_status, "Injected failure.")
+                return
+            if fault == "timeout":
+                time.sleep(zabbix.hang)
+            response = zabbix.handle(payload)
+        data = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_text(self, status, text):
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeZabbixServer(object):
+
+    def __init__(self, zabbix=None, host="127.0.0.1", port=0):
+        self.zabbix = zabbix or FakeZabbix()
+        self.httpd = ThreadedHTTPServer((host, port), RequestHandler)
+        self.httpd.zabbix = self.zabbix
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       kwargs={"poll_interval": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def method_setting(value):
+    # "0.5" applies to every method, "host.create=0.5" only to host.create
+    method, _, number = value.rpartition("=")
+    try:
+        return method or "*", float(number)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected [METHOD=]NUMBER, got {!r}".format(value))
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="in memory Zabbix JSON-RPC server. Point ZABBIX_URL at it.",
+        epilog="--latency and the rates take [METHOD=]NUMBER and can be repeated, "
+               "e.g. --latency 0.05 --latency host.create=2")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--password", default="zabbix")
+    parser.add_argument("--latency", type=method_setting, action="append", default=[],
+                        help="seconds slept by every call")
+    parser.add_argument("--error-rate", type=method_setting, action="append", default=[],
+                        help="fraction of calls answered with a JSON-RPC error")
+    parser.add_argument("--http-error-rate", type=method_setting, action="append", default=[],
+                        help="fraction of requests answered with --http-status")
+    parser.add_argument("--http-status", type=int, default=503,
+                        help="status of the injected http errors")
+    parser.add_argument("--drop-rate", type=method_setting, action="append", default=[],
+                        help="fraction of requests closed without an answer")
+    parser.add_argument("--timeout-rate", type=method_setting, action="append", default=[],
+                        help="fraction of requests answered only after --hang seconds")
+    parser.add_argument("--hang", type=float, default=60,
+                        help="seconds a request picked by --timeout-rate hangs")
+    parser.add_argument("--no-batch", action="store_true",
+                        help="reject JSON-RPC batch requests")
+    parser.add_argument("--host-groups", type=int, default=0,
+                        help="number of host groups created on start")
+    options = parser.parse_args(args)
+    zabbix = FakeZabbix(
+        user=options.user,
+        password=options.password,
+        latency=dict(options.latency),
+        error_rate=dict(options.error_rate),
+        http_error_rate=dict(options.http_error_rate),
+        drop_rate=dict(options.drop_rate),
+        timeout_rate=dict(options.timeout_rate),
+        http_status=options.http_status,
+        hang=options.hang,
+        batch=not options.no_batch,
+    )
+    zabbix.add_host_groups("group-{}".format(i) for i in range(options.host_groups))
+    return options, zabbix
+
+
+def main(args=None):
+    options, zabbix = parse_args(args)
+    server = FakeZabbixServer(zabbix, options.host, options.port)
+    print("fake zabbix listening on {}".format(server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
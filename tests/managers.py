@@ -13,6 +13,11 @@ class FakeManager(object):
         item = {"url": url, "expected_string": expected_string, "comment": comment}
         self.healthchecks[name]["urls"].append(item)
 
+    def add_urls(self, name, urls):
+        for url in urls:
+            self.add_url(name, url["url"], url.get("expected_string"), url.get("comment", ""))
+        return [{"url": url["url"]} for url in urls]
+
     def list_urls(self, name):
         return [[item['url'], item['comment']] for item in self.healthchecks[name]['urls']]
 
@@ -2,11 +2,13 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import threading
 import unittest
 
 import mock
 
-from healthcheck.actions import Action, Pipeline
+from healthcheck import deadlines, metrics
+from healthcheck.actions import Action, Pipeline, Saga, Step
 
 
 class ActionTest(unittest.TestCase):
@@ -65,3 +67,129 @@ class PipelineTest(unittest.TestCase):
         action.forward.assert_called_with(param="value")
         action.backward.assert_called_with(param="value")
         action2.forward.assert_called_with(param="value")
+
+
+class SagaTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+
+    def test_step_without_backward(self):
+        step = Step("a", lambda c: 1)
+        self.assertEqual(1, step.forward({}))
+        step.backward({})
+
+    def test_duplicated_step(self):
+        with self.assertRaises(ValueError):
+            Saga([Step("a", mock.Mock()), Step("a", mock.Mock())])
+
+    def test_requires_an_earlier_step(self):
+        with self.assertRaises(ValueError):
+            Saga([Step("a", mock.Mock(), requires=["b"]), Step("b", mock.Mock())])
+
+    def test_execute(self):
+        saga = Saga([
+            Step("a", lambda c: c["value"] + 1),
+            Step("b", lambda c: c["a"] * 2, requires=["a"]),
+        ])
+        context = saga.execute(value=1)
+        self.assertEqual({"value": 1, "a": 2, "b": 4}, context)
+
+    def test_independent_steps_run_concurrently(self):
+        # each step waits for the other, so they only finish together
+        barrier = [threading.Event(), threading.Event()]
+
+        def step(index):
+            def forward(context):
+                barrier[index].set()
+                if not barrier[1 - index].wait(5):
+                    raise RuntimeError("steps did not run concurrently")
+                return index
+            return forward
+
+        saga = Saga([
+            Step("a", step(0)),
+            Step("b", step(1)),
+            Step("c", lambda c: c["a"] + c["b"], requires=["a", "b"]),
+        ])
+        self.assertEqual(1, saga.execute()["c"])
+
+    def test_compensates_in_reverse_order(self):
+        calls = []
+
+        def backward(name):
+            return lambda c: calls.append((name, c[name]))
+
+        error = ValueError("failed")
+        saga = Saga([
+            Step("a", lambda c: 1, backward("a")),
+            Step("b", lambda c: 2, backward("b"), requires=["a"]),
+            Step("c", mock.Mock(side_effect=error), backward("c"), requires=["b"]),
+        ])
+        with self.assertRaises(ValueError) as cm:
+            saga.execute()
+        self.assertIs(error, cm.exception)
+        self.assertEqual([("b", 2), ("a", 1)], calls)
+
+    def test_does_not_start_steps_after_failure(self):
+        never = mock.Mock()
+        saga = Saga([
+            Step("a", mock.Mock(side_effect=ValueError())),
+            Step("b", never, requires=["a"]),
+        ])
+        with self.assertRaises(ValueError):
+            saga.execute()
+        self.assertFalse(never.called)
+
+    def test_failed_compensation_does_not_stop_the_others(self):
+        a_backward = mock.Mock()
+        saga = Saga([
+            Step("a", lambda c: 1, a_backward),
+            Step("b", lambda c: 2, mock.Mock(side_effect=Exception()), requires=["a"]),
+            Step("c", mock.Mock(side_effect=ValueError()), requires=["b"]),
+        ])
+        with self.assertRaises(ValueError):
+            saga.execute()
+        a_backward.assert_called_once_with({"a": 1, "b": 2})
+        statuses = [(t["step"], t["direction"], t["status"]) for t in saga.timings]
+        self.assertEqual([
+            ("a", "forward", "ok"),
+            ("b", "forward", "ok"),
+            ("c", "forward", "error"),
+            ("b", "backward", "error"),
+            ("a", "backward", "ok"),
+        ], statuses)
+
+    def test_deadline_reaches_parallel_steps_and_spares_compensation(self):
+        deadline = deadlines.Deadline(5)
+        seen = []
+
+        def expire(c):
+            seen.append(deadlines.current())
+            deadline.expires_at = 0
+            deadlines.check("zabbix", "host.create")
+
+        def undo(c):
+            deadlines.check("zabbix", "host.delete")
+            seen.append("undone")
+        saga = Saga([
+            Step("a", lambda c: seen.append(deadlines.current()), undo),
+            Step("b", expire),
+        ])
+        with deadlines.override(deadline):
+            with self.assertRaises(deadlines.DeadlineExceededError):
+                saga.execute()
+        self.assertEqual([deadline, deadline, "undone"], seen)
+
+    def test_timings(self):
+        saga = Saga([Step("a", lambda c: 1)], name="test")
+        saga.execute()
+        timing = saga.timings[0]
+        self.assertEqual("a", timing["step"])
+        self.assertGreaterEqual(timing["offset"], 0)
+        self.assertGreaterEqual(timing["duration"], 0)
+        histogram = metrics.registry.snapshot()["histograms"][0]
+        self.assertEqual("hcaas_saga_step_duration_seconds", histogram[0])
+        self.assertEqual([["direction", "forward"], ["saga", "test"], ["status", "ok"], ["step", "a"]],
+                         [list(label) for label in histogram[1]])
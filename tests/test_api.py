@@ -5,10 +5,16 @@
 import unittest
 import json
 import mock
+import requests
 import inspect
 import os
 
 from healthcheck import api, backends
+from healthcheck.backends.breaker import CircuitBreaker, ZabbixUnavailableError
+from healthcheck.deadlines import DeadlineExceededError
+from healthcheck.backends.governor import ZabbixOverloadedError
+from healthcheck.locks import LockLostError, LockTimeoutError
+from healthcheck.storage import HealthCheckNotFoundError, Item, Job, JobNotFoundError
 from . import managers
 
 
@@ -74,6 +80,87 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(400, resp.status_code)
         self.assertEqual(resp.data, 'url is required')
 
+    def test_add_urls(self):
+        resp = self.api.post(
+            "/resources/hc/urls",
+            data=json.dumps({"urls": [
+                {"url": "http://bla.com"},
+                {"url": "http://ble.com", "expected_string": "OK", "comment": "ble"},
+            ]})
+        )
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual([{"url": "http://bla.com"}, {"url": "http://ble.com"}],
+                         json.loads(resp.data))
+        self.assertIn(
+            {"url": "http://bla.com", "expected_string": None, "comment": ""},
+            self.manager.healthchecks["hc"]["urls"]
+        )
+        self.assertIn(
+            {"url": "http://ble.com", "expected_string": "OK", "comment": "ble"},
+            self.manager.healthchecks["hc"]["urls"]
+        )
+
+    def test_add_urls_bad_request(self):
+        resp = self.api.post("/resources/hc/urls")
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual(resp.data, 'urls are required')
+
+        resp = self.api.post("/resources/hc/urls", data=json.dumps({"urls": []}))
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual(resp.data, 'urls are required')
+
+        resp = self.api.post(
+            "/resources/hc/urls",
+            data=json.dumps({"urls": [{"url": "http://bla.com"}, {"comment": "x"}]})
+        )
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual(resp.data, 'url is required')
+        self.assertEqual([], self.manager.healthchecks["hc"]["urls"])
+
+    def test_metrics(self):
+        self.api.get("/resources/hc/url")
+        resp = self.api.get("/metrics")
+        self.assertEqual(200, resp.status_code)
+        self.assertIn("text/plain", resp.headers["Content-Type"])
+        self.assertIn(
+            'hcaas_http_request_duration_seconds_count{method="GET",route="/resources/<name>/url"}',
+            resp.data
+        )
+
+    def test_server_timing(self):
+        def list_watchers(name):
+            from healthcheck import metrics
+            metrics.observe_call("zabbix", "user.login", 0.01)
+            metrics.observe_call("mongo", "find_healthcheck_with_watchers", 0.002)
+            return []
+        with mock.patch.object(self.manager, "list_watchers", side_effect=list_watchers):
+            resp = self.api.get("/resources/hc/watcher", headers={"X-Debug-Timing": "1"})
+        self.assertEqual(200, resp.status_code)
+        header = resp.headers["Server-Timing"]
+        self.assertIn('zabbix-login;dur=10.0;desc="1 call"', header)
+        self.assertIn('mongo;dur=2.0;desc="1 call"', header)
+        self.assertIn("render;dur=", header)
+        self.assertIn("total;dur=", header)
+        debug = json.loads(resp.headers["X-Timing-Debug"])
+        self.assertEqual(1, debug["categories"]["zabbix-login"]["calls"])
+
+    def test_server_timing_only_on_resources(self):
+        resp = self.api.get("/")
+        self.assertNotIn("Server-Timing", resp.headers)
+        resp = self.api.get("/resources/hc/watcher")
+        self.assertIn("Server-Timing", resp.headers)
+        self.assertNotIn("X-Timing-Debug", resp.headers)
+
+    def test_new_has_a_deadline(self):
+        timeouts = []
+        with mock.patch.object(self.manager, "new",
+                               side_effect=lambda name: timeouts.append(api.g.deadline.timeout)):
+            resp = self.api.post("/resources", data={"name": "other"},
+                                 headers={"X-Request-Timeout": "2"})
+        self.assertEqual(201, resp.status_code)
+        self.assertIn("Server-Timing", resp.headers)
+        self.assertEqual([2], timeouts)
+
     def test_list_urls(self):
         self.manager.add_url("hc", "http://bla.com")
         resp = self.api.get(
@@ -201,6 +288,82 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(204, resp.status_code)
         self.assertNotIn("blabla", self.manager.healthchecks)
 
+    @mock.patch("healthcheck.api.get_storage")
+    def test_remove_async(self, get_storage):
+        get_storage.return_value.add_job.side_effect = lambda job: job
+        with mock.patch.dict(os.environ, {"API_ASYNC_ROUTES": "remove"}):
+            resp = self.api.delete("/resources/hc")
+        self.assertEqual(202, resp.status_code)
+        job = get_storage.return_value.add_job.call_args[0][0]
+        self.assertEqual(("remove", {"name": "hc"}), (job.operation, job.args))
+        self.assertIn("hc", self.manager.healthchecks)
+
+    @mock.patch("healthcheck.api.get_storage")
+    def test_add_url_async(self, get_storage):
+        get_storage.return_value.add_job.side_effect = lambda job: job
+        resp = self.api.post(
+            "/resources/hc/url",
+            data=json.dumps({"url": "http://bla.com", "comment": "ble"}),
+            headers={"Prefer": "respond-async"},
+        )
+        self.assertEqual(202, resp.status_code)
+        job = get_storage.return_value.add_job.call_args[0][0]
+        self.assertEqual({"id": job.id, "status": "queued"}, json.loads(resp.data))
+        self.assertTrue(resp.headers["Location"].endswith("/jobs/{}".format(job.id)))
+        self.assertEqual("add_url", job.operation)
+        self.assertEqual({"name": "hc", "url": "http://bla.com", "comment": "ble"}, job.args)
+        self.assertEqual([], self.manager.healthchecks["hc"]["urls"])
+
+    @mock.patch("healthcheck.api.get_storage")
+    def test_add_url_async_bad_request(self, get_storage):
+        resp = self.api.post("/resources/hc/url", data=json.dumps({}),
+                             headers={"Prefer": "respond-async"})
+        self.assertEqual(400, resp.status_code)
+        self.assertFalse(get_storage.return_value.add_job.called)
+
+    @mock.patch("healthcheck.api.get_storage")
+    def test_add_url_async_keeps_known_fields(self, get_storage):
+        get_storage.return_value.add_job.side_effect = lambda job: job
+        resp = self.api.post(
+            "/resources/hc/url",
+            data=json.dumps({"url": "http://bla.com", "expected_string": "ok", "interval": 1}),
+            headers={"Prefer": "respond-async"},
+        )
+        self.assertEqual(202, resp.status_code)
+        job = get_storage.return_value.add_job.call_args[0][0]
+        self.assertEqual({"name": "hc", "url": "http://bla.com", "expected_string": "ok"}, job.args)
+
+    @mock.patch("healthcheck.api.get_storage")
+    def test_add_url_async_healthcheck_not_found(self, get_storage):
+        get_storage.return_value.find_healthcheck_by_name.side_effect = HealthCheckNotFoundError()
+        resp = self.api.post("/resources/hc/url", data=json.dumps({"url": "http://bla.com"}),
+                             headers={"Prefer": "respond-async"})
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("healthcheck not found", resp.data)
+        get_storage.return_value.find_healthcheck_by_name.assert_called_once_with("hc")
+        self.assertFalse(get_storage.return_value.add_job.called)
+
+    @mock.patch("healthcheck.api.get_storage")
+    def test_get_job(self, get_storage):
+        job = Job("remove", {"name": "hc"}, status="done", attempts=1)
+        get_storage.return_value.find_job.return_value = job
+        for path in ("/jobs/{}", "/resources/hc/jobs/{}"):
+            resp = self.api.get(path.format(job.id))
+            self.assertEqual(200, resp.status_code)
+            data = json.loads(resp.data)
+            self.assertEqual("done", data["status"])
+            self.assertEqual("remove", data["operation"])
+            self.assertEqual(1, data["attempts"])
+            self.assertIsNone(data["finished_at"])
+        get_storage.return_value.find_job.assert_called_with(job.id)
+
+    @mock.patch("healthcheck.api.get_storage")
+    def test_get_job_not_found(self, get_storage):
+        get_storage.return_value.find_job.side_effect = JobNotFoundError()
+        resp = self.api.get("/jobs/404")
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("job not found", resp.data)
+
     def test_remove_watcher_compat(self):
         self.manager.add_watcher("hc", "watcher@watcher.com")
         resp = self.api.delete("/resources/hc/XanythingX/watcher/watcher@watcher.com")
@@ -237,6 +400,88 @@ class APITestCase(unittest.TestCase):
             self.manager.healthchecks["hc"]["host_groups"]
         )
 
+    @mock.patch("healthcheck.api.get_storage")
+    def test_add_group_async(self, get_storage):
+        get_storage.return_value.add_job.side_effect = lambda job: job
+        with mock.patch.dict(os.environ, {"API_ASYNC_ROUTES": "add_url, add_group"}):
+            resp = self.api.post("/resources/hc/groups", data=json.dumps({"group": "mygroup"}))
+        self.assertEqual(202, resp.status_code)
+        job = get_storage.return_value.add_job.call_args[0][0]
+        self.assertEqual("add_group", job.operation)
+        self.assertEqual({"name": "hc", "group": "mygroup"}, job.args)
+        self.assertNotIn("mygroup", self.manager.healthchecks["hc"]["host_groups"])
+
+    def test_add_group_instance_busy(self):
+        with mock.patch.object(self.manager, "add_group", side_effect=LockTimeoutError("hc")):
+            resp = self.api.post("/resources/hc/groups", data=json.dumps({"group": "mygroup"}))
+        self.assertEqual(503, resp.status_code)
+        self.assertEqual("instance is busy, try again later", resp.data)
+
+    def test_add_group_lock_lost(self):
+        with mock.patch.object(self.manager, "add_group", side_effect=LockLostError("hc")):
+            resp = self.api.post("/resources/hc/groups", data=json.dumps({"group": "mygroup"}))
+        self.assertEqual(503, resp.status_code)
+        self.assertEqual("instance lock lost, try again later", resp.data)
+
+    def test_add_url_zabbix_overloaded(self):
+        error = ZabbixOverloadedError("httptest.create", "rate", 2.5)
+        with mock.patch.object(self.manager, "add_url", side_effect=error):
+            resp = self.api.post("/resources/hc/url", data=json.dumps({"url": "http://bla.com"}))
+        self.assertEqual(503, resp.status_code)
+        self.assertEqual("3", resp.headers["Retry-After"])
+
+    def test_add_url_zabbix_unavailable(self):
+        error = ZabbixUnavailableError(12.2)
+        with mock.patch.object(self.manager, "add_url", side_effect=error):
+            resp = self.api.post("/resources/hc/url", data=json.dumps({"url": "http://bla.com"}))
+        self.assertEqual(503, resp.status_code)
+        self.assertEqual("zabbix is unavailable, try again later", resp.data)
+        self.assertEqual("13", resp.headers["Retry-After"])
+
+    def test_add_url_deadline_exceeded(self):
+        error = DeadlineExceededError("zabbix", "httptest.create")
+        with mock.patch.object(self.manager, "add_url", side_effect=error):
+            resp = self.api.post("/resources/hc/url", data=json.dumps({"url": "http://bla.com"}))
+        self.assertEqual(504, resp.status_code)
+        self.assertEqual("request deadline exceeded", resp.data)
+
+    def test_request_timeout_header(self):
+        timeouts = []
+
+        def list_watchers(name):
+            timeouts.append(api.g.deadline.timeout)
+            return []
+        with mock.patch.object(self.manager, "list_watchers", side_effect=list_watchers):
+            self.api.get("/resources/hc/watcher", headers={"X-Request-Timeout": "2"})
+        self.assertEqual([2], timeouts)
+
+    @mock.patch("healthcheck.api.get_storage")
+    def test_list_urls_zabbix_down_before_the_breaker_opens(self, get_storage):
+        get_storage.return_value.find_items_by_healthcheck_name.return_value = [Item("http://a.com")]
+        for error in (requests.ConnectionError(), ZabbixOverloadedError("user.login", "rate", 1)):
+            with mock.patch("healthcheck.api.get_manager", side_effect=error):
+                resp = self.api.get("/resources/hc/url", headers={"Accept": "application/json"})
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual([{"url": "http://a.com", "comment": ""}], json.loads(resp.data))
+            self.assertIn("zabbix is unavailable", resp.headers["Warning"])
+
+    @mock.patch("healthcheck.api.get_storage")
+    def test_list_urls_zabbix_unavailable(self, get_storage):
+        zabbix = CircuitBreaker(failure_threshold=1)
+        zabbix.failed()
+        get_storage.return_value.find_items_by_healthcheck_name.return_value = [Item("http://a.com")]
+        with mock.patch("healthcheck.backends.breaker._breaker", zabbix):
+            resp = self.api.get("/resources/hc/url", headers={"Accept": "application/json"})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([{"url": "http://a.com", "comment": ""}], json.loads(resp.data))
+        self.assertIn("zabbix is unavailable", resp.headers["Warning"])
+        get_storage.return_value.find_items_by_healthcheck_name.assert_called_once_with("hc")
+
+    def test_list_urls_zabbix_available(self):
+        resp = self.api.get("/resources/hc/url")
+        self.assertEqual(200, resp.status_code)
+        self.assertNotIn("Warning", resp.headers)
+
     def test_add_group_bad_request(self):
         resp = self.api.post("/resources/hc/groups")
         self.assertEqual(400, resp.status_code)
@@ -298,15 +543,63 @@ class GetManagerTestCase(unittest.TestCase):
     def setUpClass(cls):
         reload(api)
 
-    @mock.patch("pyzabbix.ZabbixAPI")
+    def setUp(self):
+        api.pools.clear()
+        os.environ.pop("API_MANAGER", None)
+
+    @mock.patch("healthcheck.backends.client.ZabbixClient")
     def test_get_manager(self, zabbix_mock):
         os.environ["ZABBIX_URL"] = ""
         os.environ["ZABBIX_USER"] = ""
         os.environ["ZABBIX_PASSWORD"] = ""
         os.environ["ZABBIX_HOST"] = ""
         os.environ["ZABBIX_HOST_GROUP"] = ""
-        manager = api.get_manager()
-        self.assertIsInstance(manager, backends.Zabbix)
+        with api.app.app_context():
+            manager = api.get_manager()
+            self.assertIsInstance(manager, backends.Zabbix)
+
+    @mock.patch("healthcheck.backends.client.ZabbixClient")
+    def test_get_manager_reuses_pooled_manager(self, zabbix_mock):
+        os.environ["ZABBIX_URL"] = ""
+        os.environ["ZABBIX_USER"] = ""
+        os.environ["ZABBIX_PASSWORD"] = ""
+        os.environ["ZABBIX_HOST"] = ""
+        os.environ["ZABBIX_HOST_GROUP"] = ""
+        with api.app.app_context():
+            manager = api.get_manager()
+            self.assertIs(manager, api.get_manager())
+        with api.app.app_context():
+            self.assertIs(manager, api.get_manager())
+        self.assertEqual(1, zabbix_mock.call_count)
+        stats = api.get_manager_pool().stats()
+        self.assertEqual(1, stats["created"])
+        self.assertEqual(0, stats["in_use"])
+
+    @mock.patch("healthcheck.backends.client.ZabbixClient")
+    def test_storage_reads_header(self, zabbix_mock):
+        os.environ["ZABBIX_URL"] = ""
+        os.environ["ZABBIX_USER"] = ""
+        os.environ["ZABBIX_PASSWORD"] = ""
+        os.environ["ZABBIX_HOST"] = ""
+        os.environ["ZABBIX_HOST_GROUP"] = ""
+        with api.app.test_request_context("/"):
+            manager = api.get_manager()
+            manager.storage.storage = mock.Mock()
+            manager.storage.find_healthcheck_by_name("hc")
+            manager.storage.find_healthcheck_by_name("hc")
+            response = api.storage_reads_header(api.app.make_response("ok"))
+        self.assertEqual("reads=1; hits=1", response.headers["X-Storage-Reads"])
+        with api.app.test_request_context("/"):
+            self.assertEqual({"reads": 0, "hits": 0}, api.get_manager().storage.stats())
+
+    def test_get_manager_fails_fast_while_zabbix_unavailable(self):
+        zabbix = CircuitBreaker(failure_threshold=1)
+        zabbix.failed()
+        with mock.patch("healthcheck.backends.breaker._breaker", zabbix):
+            with api.app.app_context():
+                with self.assertRaises(ZabbixUnavailableError):
+                    api.get_manager()
+        self.assertEqual(0, api.get_manager_pool().stats()["created"])
 
     @mock.patch("healthcheck.backends.Zabbix")
     def test_get_manager_that_does_not_exist(self, zabbix_mock):
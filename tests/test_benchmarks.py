@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import unittest
+
+import mock
+
+from benchmarks import api as bench
+from healthcheck import storage
+
+
+class PercentileTest(unittest.TestCase):
+
+    def test_percentile(self):
+        values = [float(i) for i in range(1, 101)]
+        self.assertEqual(50.0, bench.percentile(values, 50))
+        self.assertEqual(99.0, bench.percentile(values, 99))
+        self.assertEqual(1.0, bench.percentile([1.0], 99))
+        self.assertEqual(0.0, bench.percentile([], 50))
+
+
+class APIBenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import mongomock  # noqa
+        except ImportError:
+            self.skipTest("mongomock is not installed")
+
+    @mock.patch.dict(os.environ, {})
+    @mock.patch.object(storage, "mongo_client", storage.mongo_client)
+    def test_run(self):
+        report = bench.main(["--storage", "memory", "--sizes", "2", "--iterations", "2",
+                             "--host-groups", "3", "--output", os.devnull])
+        routes = dict((r["route"], r) for r in report["results"])
+        self.assertEqual(
+            set(["list_urls", "add_url", "remove_url", "add_watcher", "list_watchers",
+                 "remove_watcher", "list_service_groups", "add_group", "list_groups",
+                 "remove_group", "new", "remove", "remove_populated"]),
+            set(routes))
+        for result in report["results"]:
+            self.assertEqual(0, result["errors"], result["route"])
+            self.assertEqual(2, result["size"])
+        self.assertEqual(2, routes["list_urls"]["requests"])
+        self.assertEqual(0, routes["list_urls"]["zabbix_calls_per_request"])
+        self.assertEqual(3, routes["add_url"]["zabbix_calls_per_request"])
+        self.assertEqual(1, routes["remove_populated"]["requests"])
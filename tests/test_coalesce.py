@@ -0,0 +1,204 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import os
+import threading
+import time
+import unittest
+
+import mock
+
+from healthcheck import api, coalesce, metrics
+from . import managers
+
+
+class GroupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.group = coalesce.Group()
+
+    def run_concurrently(self, fn, callers=3):
+        results = []
+        errors = []
+
+        def run():
+            try:
+                results.append(self.group.do("key", fn))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_concurrent_calls_share_one_execution(self):
+        calls = []
+
+        def fn():
+            calls.append(1)
+            time.sleep(0.1)
+            return "result"
+
+        results = self.run_concurrently(fn)[0]
+        self.assertEqual(1, len(calls))
+        self.assertEqual(["result"] * 3, [result for result, _ in results])
+        self.assertEqual([False, True, True], sorted(shared for _, shared in results))
+        self.assertEqual({}, self.group.calls)
+
+    def test_error_is_shared(self):
+        def fn():
+            time.sleep(0.1)
+            raise ValueError("boom")
+
+        results, errors = self.run_concurrently(fn)
+        self.assertEqual([], results)
+        self.assertEqual(3, len(errors))
+        self.assertEqual({}, self.group.calls)
+
+    def test_sequential_calls_run_again(self):
+        fn = mock.Mock(return_value=1)
+        self.assertEqual((1, False), self.group.do("key", fn))
+        self.assertEqual((1, False), self.group.do("key", fn))
+        self.assertEqual(2, fn.call_count)
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = coalesce.ResultCache(max_entries=2)
+
+    def test_get_and_set(self):
+        self.assertIsNone(self.cache.get(("r", "hc")))
+        self.cache.set(("r", "hc"), "value", ttl=10)
+        self.assertEqual("value", self.cache.get(("r", "hc")))
+
+    def test_expired(self):
+        self.cache.set(("r", "hc"), "value", ttl=-1)
+        self.assertIsNone(self.cache.get(("r", "hc")))
+        self.assertEqual(0, len(self.cache.entries))
+
+    def test_max_entries(self):
+        self.cache.set(("r", "a"), 1, ttl=10)
+        self.cache.set(("r", "b"), 2, ttl=10)
+        self.cache.set(("r", "c"), 3, ttl=10)
+        self.assertIsNone(self.cache.get(("r", "a")))
+        self.assertEqual(3, self.cache.get(("r", "c")))
+
+    def test_invalidate(self):
+        self.cache.set(("r", "a"), 1, ttl=10)
+        self.cache.set(("r", "b"), 2, ttl=10)
+        self.cache.invalidate("a")
+        self.assertIsNone(self.cache.get(("r", "a")))
+        self.assertEqual(2, self.cache.get(("r", "b")))
+
+
+class CoalescedRoutesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.api = api.app.test_client()
+
+    def setUp(self):
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+        coalesce.cache.clear()
+        self.addCleanup(coalesce.cache.clear)
+        self.manager = managers.FakeManager()
+        self.manager.new("hc")
+        self.manager.add_url("hc", "http://a.com")
+        patch = mock.patch("healthcheck.api.get_manager", return_value=self.manager)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def outcomes(self):
+        return dict((dict(labels)["outcome"], value)
+                    for name, labels, value in metrics.registry.snapshot()["counters"]
+                    if name == "hcaas_read_requests_total")
+
+    def get_urls(self):
+        return self.api.get("/resources/hc/url", headers={"Accept": "application/json"})
+
+    def test_concurrent_reads_are_coalesced(self):
+        list_urls = self.manager.list_urls
+
+        def slow_list_urls(name):
+            time.sleep(0.1)
+            return list_urls(name)
+
+        responses = []
+        with mock.patch.object(self.manager, "list_urls", side_effect=slow_list_urls) as m:
+            threads = [threading.Thread(target=lambda: responses.append(self.get_urls()))
+                       for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, m.call_count)
+        for resp in responses:
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual([{"url": "http://a.com", "comment": ""}], json.loads(resp.data))
+        self.assertEqual({"computed": 1, "coalesced": 2}, self.outcomes())
+
+    def test_accept_header_is_part_of_the_key(self):
+        self.assertEqual(1, len(json.loads(self.get_urls().data)))
+        resp = self.api.get("/resources/hc/url")
+        self.assertIn("+----", resp.data)
+
+    def test_without_cache(self):
+        self.get_urls()
+        self.get_urls()
+        self.assertEqual({"computed": 2}, self.outcomes())
+
+    @mock.patch.dict(os.environ, {"API_READ_CACHE_TTL": "5"})
+    def test_cache(self):
+        with mock.patch.object(self.manager, "list_groups", return_value=["g1"]) as m:
+            self.api.get("/resources/hc/groups")
+            resp = self.api.get("/resources/hc/groups")
+        self.assertEqual(["g1"], json.loads(resp.data))
+        self.assertEqual(1, m.call_count)
+        self.assertEqual({"computed": 1, "cached": 1}, self.outcomes())
+
+    @mock.patch.dict(os.environ, {"API_READ_CACHE_TTL": "5"})
+    def test_writes_invalidate_the_cache(self):
+        self.get_urls()
+        self.api.post("/resources/hc/url", data=json.dumps({"url": "http://b.com"}))
+        resp = self.get_urls()
+        self.assertEqual(2, len(json.loads(resp.data)))
+
+    @mock.patch.dict(os.environ, {"API_READ_CACHE_TTL": "5"})
+    def test_async_writes_invalidate_the_cache_when_the_job_finishes(self):
+        storage = mock.Mock()
+        storage.add_job.side_effect = lambda job: job
+        self.get_urls()
+        with mock.patch("healthcheck.api.get_storage", return_value=storage):
+            resp = self.api.post("/resources/hc/url", data=json.dumps({"url": "http://b.com"}),
+                                 headers={"Prefer": "respond-async"})
+            self.assertEqual(202, resp.status_code)
+            self.assertEqual(1, len(coalesce.cache.entries))
+            job = storage.add_job.call_args[0][0]
+            storage.find_job.return_value = job
+            self.api.get("/jobs/{}".format(job.id))
+            self.assertEqual(1, len(coalesce.cache.entries))
+            job.status = "done"
+            self.api.get("/jobs/{}".format(job.id))
+        self.assertEqual(0, len(coalesce.cache.entries))
+
+    @mock.patch.dict(os.environ, {"API_READ_CACHE_TTL": "5"})
+    def test_errors_are_not_cached(self):
+        with mock.patch.object(self.manager, "list_groups", side_effect=Exception()):
+            self.assertEqual(500, self.api.get("/resources/hc/groups").status_code)
+        self.assertEqual(200, self.api.get("/resources/hc/groups").status_code)
+
+    @mock.patch.dict(os.environ, {"API_READ_CACHE_TTL": "5"})
+    def test_degraded_reads_are_not_cached(self):
+        def list_groups(name):
+            api.g.degraded = True
+            return ["g1"]
+        with mock.patch.object(self.manager, "list_groups", side_effect=list_groups):
+            resp = self.api.get("/resources/hc/groups")
+        self.assertIn("Warning", resp.headers)
+        self.assertEqual(0, len(coalesce.cache.entries))
@@ -0,0 +1,81 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import threading
+import unittest
+
+import flask
+import mock
+import requests
+
+from healthcheck import deadlines, metrics
+from healthcheck.deadlines import Deadline, DeadlineExceededError
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+
+    def test_check(self):
+        Deadline(10).check("zabbix", "host.get")
+        with self.assertRaises(DeadlineExceededError) as cm:
+            Deadline(-1).check("zabbix", "host.get")
+        self.assertEqual("deadline exceeded before zabbix host.get", str(cm.exception))
+        self.assertEqual([["hcaas_deadline_exceeded_total", [("kind", "zabbix")], 1]],
+                         metrics.registry.snapshot()["counters"])
+
+    def test_from_headers(self):
+        self.assertEqual(30, deadlines.from_headers({}).timeout)
+        self.assertEqual(2.5, deadlines.from_headers({"X-Request-Timeout": "2.5"}).timeout)
+        self.assertEqual(30, deadlines.from_headers({"X-Request-Timeout": "60"}).timeout)
+        self.assertEqual(30, deadlines.from_headers({"X-Request-Timeout": "soon"}).timeout)
+        with mock.patch.dict(os.environ, {"API_REQUEST_TIMEOUT": "5"}):
+            self.assertEqual(5, deadlines.from_headers({}).timeout)
+
+    def test_without_deadline(self):
+        self.assertIsNone(deadlines.current())
+        self.assertIsNone(deadlines.remaining())
+        self.assertEqual(10, deadlines.remaining(10))
+        self.assertFalse(deadlines.expired())
+        deadlines.check("mongo", "find_job")
+
+    def test_remaining(self):
+        with deadlines.override(Deadline(5)):
+            self.assertAlmostEqual(5, deadlines.remaining(), places=1)
+            self.assertEqual(1, deadlines.remaining(1))
+        with deadlines.override(Deadline(-1)):
+            self.assertEqual(0, deadlines.remaining(1))
+            self.assertTrue(deadlines.expired())
+
+    def test_request_deadline(self):
+        app = flask.Flask(__name__)
+        with app.test_request_context("/"):
+            flask.g.deadline = deadline = Deadline(5)
+            self.assertIs(deadline, deadlines.current())
+            with deadlines.override(Deadline(1)):
+                self.assertIsNot(deadline, deadlines.current())
+            self.assertIs(deadline, deadlines.current())
+
+    def test_bind(self):
+        seen = []
+        deadline = Deadline(5)
+        with deadlines.override(deadline):
+            fn = deadlines.bind(lambda: seen.append(deadlines.current()))
+        thread = threading.Thread(target=fn)
+        thread.start()
+        thread.join()
+        self.assertEqual([deadline], seen)
+
+    def test_translate(self):
+        with self.assertRaises(requests.Timeout):
+            with deadlines.override(Deadline(5)):
+                with deadlines.translate("zabbix", "host.get", requests.Timeout):
+                    raise requests.Timeout()
+        with self.assertRaises(DeadlineExceededError):
+            with deadlines.override(Deadline(-1)):
+                with deadlines.translate("zabbix", "host.get", requests.Timeout):
+                    raise requests.Timeout()
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import os
+import time
+import unittest
+
+import mock
+import requests
+from pyzabbix import ZabbixAPIException
+
+from healthcheck.backends import Zabbix
+from healthcheck.backends.client import ZabbixClient
+from healthcheck.backends.hostgroups import HostGroupIndex
+from healthcheck.storage import HealthCheck, Item, User, UserNotFoundError
+
+from .fakezabbix import FakeZabbix, FakeZabbixServer, parse_args
+
+
+class FakeZabbixServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.zabbix = FakeZabbix()
+        self.server = FakeZabbixServer(self.zabbix).start()
+        self.client = ZabbixClient(self.server.url)
+        self.client.login("admin", "zabbix")
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_login(self):
+        self.assertEqual(1, len(self.zabbix.sessions))
+        client = ZabbixClient(self.server.url)
+        with self.assertRaises(ZabbixAPIException) as cm:
+            client.login("admin", "wrong")
+        self.assertIn("Login name or password is incorrect", str(cm.exception))
+
+    def test_requires_session(self):
+        client = ZabbixClient(self.server.url)
+        with self.assertRaises(ZabbixAPIException) as cm:
+            client.host.get()
+        self.assertIn("Session terminated", str(cm.exception))
+
+    def test_relogin_after_session_expires(self):
+        self.zabbix.expire_sessions()
+        self.assertEqual([], self.client.host.get())
+        self.assertEqual(2, self.client.logins)
+
+    def test_create_get_update_delete(self):
+        result = self.client.host.create(host="hc", groups=[{"groupid": "1"}])
+        host_id = result["hostids"][0]
+        self.client.host.update(hostid=host_id, groups=[{"groupid": "2"}])
+        hosts = self.client.host.get(hostids=[host_id], output=["hostid", "groups"])
+        self.assertEqual([{"hostid": host_id, "groups": [{"groupid": "2"}]}], hosts)
+        self.assertEqual({"hostids": [host_id]}, self.client.host.delete(host_id))
+        self.assertEqual([], self.client.host.get())
+
+    def test_array_params(self):
+        result = self.client.trigger.create({"description": "a"}, {"description": "b"})
+        self.assertEqual(2, len(result["triggerids"]))
+        triggers = self.client.trigger.get(filter={"description": ["b"]})
+        self.assertEqual(result["triggerids"][1:], [t["triggerid"] for t in triggers])
+        self.client.trigger.delete(*result["triggerids"])
+        self.assertEqual([], self.client.trigger.get())
+
+    def test_delete_unknown_object(self):
+        with self.assertRaises(ZabbixAPIException) as cm:
+            self.client.action.delete("404")
+        self.assertIn("does not exist", str(cm.exception))
+
+    def test_unknown_method(self):
+        with self.assertRaises(ZabbixAPIException) as cm:
+            self.client.item.get()
+        self.assertIn("Method not found", str(cm.exception))
+
+    def test_batch(self):
+        with self.client.batch() as batch:
+            host = batch.host.create(host="hc")
+            group = batch.usergroup.create(name="hc")
+        self.assertEqual(1, len(host.result["hostids"]))
+        self.assertEqual(1, len(group.result["usrgrpids"]))
+        self.assertEqual(1, self.zabbix.batches)
+
+    def test_batch_disabled(self):
+        self.zabbix.batch = False
+        payload = [{"jsonrpc": "2.0", "method": "host.get", "params": {}, "id": 1}]
+        response = requests.post(self.client.url, data=json.dumps(payload)).json()
+        self.assertEqual(-32600, response["error"]["code"])
+
+    def test_error_rate(self):
+        self.zabbix.error_rate = {"host.create": 1}
+        with self.assertRaises(ZabbixAPIException) as cm:
+            self.client.host.create(host="hc")
+        self.assertIn("Injected failure", str(cm.exception))
+        self.assertEqual([], self.client.host.get())
+
+    def test_latency(self):
+        self.zabbix.latency = {"host.get": 0.05}
+        start = time.time()
+        self.client.host.get()
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        start = time.time()
+        self.client.hostgroup.get()
+        self.assertLess(time.time() - start, 0.05)
+
+    def post(self, method, **kwargs):
+        payload = {"jsonrpc": "2.0", "method": method, "params": {}, "id": 1,
+                   "auth": self.client.auth}
+        return requests.post(self.client.url, data=json.dumps(payload), **kwargs)
+
+    def test_http_error_rate(self):
+        self.zabbix.http_error_rate = {"host.create": 1}
+        self.zabbix.http_status = 502
+        self.assertEqual(502, self.post("host.create").status_code)
+        self.assertEqual(200, self.post("host.get").status_code)
+        self.assertEqual(0, self.zabbix.calls["host.create"])
+        self.assertEqual(1, self.zabbix.faults["http_error"])
+
+    def test_drop_rate(self):
+        self.zabbix.drop_rate = {"*": 1}
+        with self.assertRaises(requests.ConnectionError):
+            self.post("host.get")
+        self.assertEqual(1, self.zabbix.faults["drop"])
+
+    def test_timeout_rate(self):
+        self.zabbix.timeout_rate = {"host.get": 1}
+        self.zabbix.hang = 0.5
+        with self.assertRaises(requests.Timeout):
+            self.post("host.get", timeout=0.05)
+        self.assertEqual(1, self.zabbix.faults["timeout"])
+
+    def test_faults_of_a_batch(self):
+        self.zabbix.http_error_rate = {"usergroup.create": 1}
+        payload = [{"jsonrpc": "2.0", "method": method, "params": {}, "id": i,
+                    "auth": self.client.auth}
+                   for i, method in enumerate(["host.create", "usergroup.create"])]
+        resp = requests.post(self.client.url, data=json.dumps(payload))
+        self.assertEqual(503, resp.status_code)
+        self.assertEqual([], self.client.host.get())
+
+    def test_parse_args(self):
+        options, zabbix = parse_args([
+            "--latency", "0.05", "--latency", "host.create=2",
+            "--drop-rate", "httptest.create=0.1", "--http-status", "500",
+        ])
+        self.assertEqual({"*": 0.05, "host.create": 2}, zabbix.latency)
+        self.assertEqual({"httptest.create": 0.1}, zabbix.drop_rate)
+        self.assertEqual({}, zabbix.error_rate)
+        self.assertEqual(500, zabbix.http_status)
+
+    def test_calls(self):
+        self.client.host.get()
+        self.client.host.get()
+        self.assertEqual(2, self.zabbix.calls["host.get"])
+        self.assertEqual(1, self.zabbix.calls["user.login"])
+
+
+class ZabbixBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.zabbix = FakeZabbix()
+        self.group_id = self.zabbix.add_host_groups(["hcaas", "apps"])[0]
+        self.server = FakeZabbixServer(self.zabbix).start()
+        env = {
+            "ZABBIX_URL": self.server.url,
+            "ZABBIX_USER": "admin",
+            "ZABBIX_PASSWORD": "zabbix",
+            "ZABBIX_HOST_GROUP": self.group_id,
+        }
+        with mock.patch.dict(os.environ, env):
+            self.backend = Zabbix()
+        self.backend.storage = mock.Mock()
+        self.backend.host_groups = HostGroupIndex()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def objects(self, name):
+        return list(self.zabbix.objects[name].values())
+
+    def test_new_and_remove(self):
+        self.backend.new("hc")
+        hc = self.backend.storage.add_healthcheck.call_args[0][0]
+        self.assertEqual(["hc"], [h["host"] for h in self.objects("host")])
+        self.assertEqual(["hc"], [g["name"] for g in self.objects("usergroup")])
+
+        storage = self.backend.storage
+        storage.find_healthcheck_by_name.return_value = hc
+        storage.find_items_by_group.return_value = []
+        storage.find_users_by_group.return_value = []
+        self.backend.remove("hc")
+        self.assertEqual([], self.objects("host"))
+        self.assertEqual([], self.objects("usergroup"))
+
+    def test_remove_resumes_after_a_failure(self):
+        self.backend.new("hc")
+        hc = self.backend.storage.add_healthcheck.call_args[0][0]
+        storage = self.backend.storage
+        storage.find_healthcheck_by_name.return_value = hc
+        self.backend.add_urls("hc", [{"url": "http://a.com"}, {"url": "http://b.com"}])
+        storage.find_items_by_group.return_value = storage.add_items.call_args[0][0]
+        storage.find_users_by_group.return_value = []
+        self.zabbix.error_rate = {"host.delete": 1}
+        with self.assertRaises(ZabbixAPIException):
+            self.backend.remove("hc")
+        self.assertEqual([], self.objects("httptest"))
+        self.assertEqual(1, len(self.objects("host")))
+        self.zabbix.error_rate = {}
+        self.backend.remove("hc")
+        self.assertEqual([], self.objects("host"))
+        self.assertEqual([], self.objects("usergroup"))
+        storage.remove_healthcheck.assert_called_once_with(hc)
+
+    def test_remove_url_resumes_after_a_failure(self):
+        hc = HealthCheck(name="hc", host_id="1", group_id="2")
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.backend.add_url("hc", "http://a.com")
+        item = self.backend.storage.add_item.call_args[0][0]
+        self.backend.storage.find_item_by_url.return_value = item
+        self.zabbix.error_rate = {"httptest.delete": 1}
+        with self.assertRaises(ZabbixAPIException):
+            self.backend.remove_url("hc", "http://a.com")
+        self.zabbix.error_rate = {}
+        self.backend.remove_url("hc", "http://a.com")
+        self.assertEqual([], self.objects("httptest"))
+        self.assertEqual([], self.objects("action"))
+        self.backend.storage.remove_item.assert_called_once_with(item)
+
+    def test_new_removes_host_when_user_group_fails(self):
+        self.zabbix.error_rate = {"usergroup.create": 1}
+        with self.assertRaises(ZabbixAPIException):
+            self.backend.new("hc")
+        self.assertEqual([], self.objects("host"))
+        self.assertEqual([], self.objects("usergroup"))
+        self.assertFalse(self.backend.storage.add_healthcheck.called)
+
+    def test_add_url_rolls_back_zabbix_objects(self):
+        self.zabbix.error_rate = {"action.create": 1}
+        hc = HealthCheck(name="hc", host_id="1", group_id="2")
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        with self.assertRaises(ZabbixAPIException):
+            self.backend.add_url("hc", "http://a.com")
+        self.assertEqual([], self.objects("httptest"))
+        self.assertEqual([], self.objects("trigger"))
+        self.assertFalse(self.backend.storage.add_item.called)
+
+    def test_add_urls(self):
+        hc = HealthCheck(name="hc", host_id="1", group_id="2")
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        result = self.backend.add_urls("hc", [{"url": "http://a.com", "comment": "a"},
+                                              {"url": "http://b.com"}])
+        self.assertEqual(2, len(result))
+        self.assertEqual(2, len(self.objects("httptest")))
+        self.assertEqual(2, len(self.objects("trigger")))
+        self.assertEqual(2, len(self.objects("action")))
+
+    def test_add_urls_rolls_back_items(self):
+        self.zabbix.error_rate = {"action.create": 1}
+        hc = HealthCheck(name="hc", host_id="1", group_id="2")
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        with self.assertRaises(ZabbixAPIException):
+            self.backend.add_urls("hc", [{"url": "http://a.com"}])
+        self.assertEqual([], self.objects("httptest"))
+        self.assertFalse(self.backend.storage.add_items.called)
+
+    def test_list_comments(self):
+        result = self.backend.zapi.trigger.create(description="t", comments="hi")
+        item = Item("http://a.com", trigger_id=result["triggerids"][0])
+        self.backend.storage.find_items_by_healthcheck_name.return_value = [item]
+        self.assertEqual([["http://a.com", "hi"]], self.backend.list_urls("hc"))
+
+    def test_watchers(self):
+        hc = HealthCheck(name="hc", host_id="1", group_id="2")
+        storage = self.backend.storage
+        storage.find_healthcheck_by_name.return_value = hc
+        storage.find_user_by_email.side_effect = UserNotFoundError()
+        self.backend.add_watcher("hc", "w@a.com")
+        user = storage.add_user.call_args[0][0]
+        self.assertEqual(["w@a.com"], [u["alias"] for u in self.objects("user")])
+
+        storage.find_user_by_email.side_effect = None
+        storage.find_user_by_email.return_value = User(user.id, "w@a.com", "2")
+        self.backend.remove_watcher("hc", "w@a.com")
+        self.assertEqual([], self.objects("user"))
+
+    def test_host_groups(self):
+        self.assertEqual(["apps"], self.backend.list_service_groups("ap"))
+        hc = HealthCheck(name="hc", host_id="1", group_id="2",
+                         host_groups=[self.group_id])
+        self.backend.storage.find_healthcheck_by_name.return_value = hc
+        self.assertEqual(["hcaas"], self.backend.list_groups("hc"))
@@ -0,0 +1,165 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import copy
+import datetime
+import json
+import unittest
+
+import mock
+
+from healthcheck import api
+from healthcheck.storage import IdempotencyKey, IdempotencyKeyNotFoundError
+from . import managers
+
+
+class MemoryKeys(object):
+
+    def __init__(self):
+        self.records = {}
+
+    def add_idempotency_key(self, record):
+        if record.key in self.records:
+            return False
+        self.records[record.key] = copy.deepcopy(record)
+        return True
+
+    def find_idempotency_key(self, key):
+        if key not in self.records:
+            raise IdempotencyKeyNotFoundError()
+        return copy.deepcopy(self.records[key])
+
+    def claim_idempotency_key(self, record):
+        current = self.records.get(record.key)
+        if current is None or current.status != "processing" or \
+                current.lease_until > datetime.datetime.utcnow():
+            return False
+        current.lease_until = record.lease_until
+        return True
+
+    def finish_idempotency_key(self, record, response):
+        self.records[record.key].status = "done"
+        self.records[record.key].response = response
+
+    def remove_idempotency_key(self, record):
+        if self.records.get(record.key, record).status == "processing":
+            self.records.pop(record.key, None)
+
+
+class IdempotencyTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.api = api.app.test_client()
+
+    def setUp(self):
+        self.manager = managers.FakeManager()
+        self.manager.new("hc")
+        self.storage = MemoryKeys()
+        patches = [
+            mock.patch("healthcheck.api.get_manager", return_value=self.manager),
+            mock.patch("healthcheck.api.get_storage", return_value=self.storage),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def add_url(self, url, key="key-1"):
+        headers = {"Idempotency-Key": key} if key else {}
+        return self.api.post("/resources/hc/url", data=json.dumps({"url": url}), headers=headers)
+
+    def urls(self):
+        return [u["url"] for u in self.manager.healthchecks["hc"]["urls"]]
+
+    def test_without_key(self):
+        self.add_url("http://a.com", key=None)
+        self.add_url("http://a.com", key=None)
+        self.assertEqual(["http://a.com", "http://a.com"], self.urls())
+        self.assertEqual({}, self.storage.records)
+
+    def test_retry_replays_the_response(self):
+        first = self.add_url("http://a.com")
+        retry = self.add_url("http://a.com")
+        self.assertEqual(201, first.status_code)
+        self.assertEqual(201, retry.status_code)
+        self.assertNotIn("Idempotent-Replayed", first.headers)
+        self.assertEqual("true", retry.headers["Idempotent-Replayed"])
+        self.assertEqual(["http://a.com"], self.urls())
+
+    def test_different_keys_run_again(self):
+        self.add_url("http://a.com", key="key-1")
+        self.add_url("http://a.com", key="key-2")
+        self.assertEqual(["http://a.com", "http://a.com"], self.urls())
+
+    def test_key_reused_by_another_request(self):
+        self.add_url("http://a.com")
+        resp = self.add_url("http://b.com")
+        self.assertEqual(422, resp.status_code)
+        self.assertEqual(["http://a.com"], self.urls())
+
+    def test_request_in_progress(self):
+        self.add_url("http://a.com")
+        self.storage.records["key-1"].status = "processing"
+        resp = self.add_url("http://a.com")
+        self.assertEqual(409, resp.status_code)
+        self.assertEqual(["http://a.com"], self.urls())
+
+    def test_takes_over_an_abandoned_key(self):
+        self.add_url("http://a.com")
+        record = self.storage.records["key-1"]
+        record.status = "processing"
+        record.lease_until = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        resp = self.add_url("http://a.com")
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual(["http://a.com", "http://a.com"], self.urls())
+
+    def test_failed_request_is_not_stored(self):
+        with mock.patch.object(self.manager, "add_url", side_effect=Exception()):
+            resp = self.add_url("http://a.com")
+        self.assertEqual(500, resp.status_code)
+        self.assertEqual({}, self.storage.records)
+        self.assertEqual(201, self.add_url("http://a.com").status_code)
+        self.assertEqual(["http://a.com"], self.urls())
+
+    def test_client_errors_are_stored(self):
+        headers = {"Idempotency-Key": "key-1"}
+        self.api.delete("/resources/hc/url", data=json.dumps({"url": "http://a.com"}),
+                        headers=headers)
+        self.manager.add_url("hc", "http://a.com")
+        resp = self.api.delete("/resources/hc/url", data=json.dumps({"url": "http://a.com"}),
+                               headers=headers)
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual("URL not found.", resp.data)
+        self.assertEqual(["http://a.com"], self.urls())
+
+    def test_form_requests(self):
+        headers = {"Idempotency-Key": "key-1"}
+        self.api.post("/resources", data={"name": "other"}, headers=headers)
+        resp = self.api.post("/resources", data={"name": "another"}, headers=headers)
+        self.assertEqual(422, resp.status_code)
+        self.assertNotIn("another", self.manager.healthchecks)
+
+    def test_replays_async_jobs(self):
+        self.storage.add_job = lambda job: job
+        self.storage.find_healthcheck_by_name = lambda name: None
+        headers = {"Idempotency-Key": "key-1", "Prefer": "respond-async"}
+        first = self.api.delete("/resources/hc", headers=headers)
+        retry = self.api.delete("/resources/hc", headers=headers)
+        self.assertEqual(202, retry.status_code)
+        self.assertEqual(first.data, retry.data)
+        self.assertEqual(first.headers["Location"], retry.headers["Location"])
+
+    def test_key_too_long(self):
+        resp = self.add_url("http://a.com", key="k" * 256)
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual([], self.urls())
+
+
+class IdempotencyKeyTest(unittest.TestCase):
+
+    def test_expiration(self):
+        record = IdempotencyKey("key", "fingerprint", lease=10, ttl=60)
+        self.assertEqual("processing", record.status)
+        self.assertEqual(datetime.timedelta(seconds=10), record.lease_until - record.created_at)
+        self.assertEqual(datetime.timedelta(seconds=60), record.expires_at - record.created_at)
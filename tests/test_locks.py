@@ -0,0 +1,181 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+import time
+import unittest
+
+import mock
+
+from healthcheck import metrics
+from healthcheck.locks import InstanceLock, LockLostError, LockTimeoutError, locked
+
+
+class MemoryLocks(object):
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.locks = {}
+
+    def acquire_lock(self, name, ttl):
+        with self.mutex:
+            token, expires = self.locks.get(name, (0, 0))
+            if expires > time.time():
+                return None
+            self.locks[name] = (token + 1, time.time() + ttl)
+            return token + 1
+
+    def renew_lock(self, name, token, ttl):
+        with self.mutex:
+            current, expires = self.locks.get(name, (0, 0))
+            if current != token or expires <= time.time():
+                return False
+            self.locks[name] = (token, time.time() + ttl)
+            return True
+
+    def release_lock(self, name, token):
+        with self.mutex:
+            if self.locks.get(name, (0, 0))[0] == token:
+                self.locks[name] = (token, 0)
+
+
+class Tracker(object):
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.running = {}
+        self.overlaps = []
+
+
+class Manager(object):
+
+    def __init__(self, storage, tracker=None):
+        self.storage = storage
+        self.tracker = tracker or Tracker()
+        self.lock = None
+        self.lock_options = {"ttl": 10, "timeout": 5}
+
+    @locked
+    def mutate(self, name, delay=0.05):
+        tracker = self.tracker
+        with tracker.mutex:
+            if tracker.running.get(name):
+                tracker.overlaps.append(name)
+            tracker.running[name] = True
+            running = [n for n, r in tracker.running.items() if r]
+        time.sleep(delay)
+        with tracker.mutex:
+            tracker.running[name] = False
+        return running
+
+    @locked
+    def nested(self, name):
+        return self.mutate(name, 0)
+
+    @locked
+    def fail(self, name):
+        raise ValueError()
+
+
+class InstanceLockTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+        self.storage = MemoryLocks()
+
+    def wait_observations(self, outcome):
+        for name, labels, buckets, _ in metrics.registry.snapshot()["histograms"]:
+            if name == "hcaas_lock_wait_seconds" and labels == [("outcome", outcome)]:
+                return sum(buckets)
+        return 0
+
+    def test_acquire_and_release(self):
+        lock = InstanceLock(self.storage, "bla")
+        self.assertEqual(1, lock.acquire())
+        self.assertIsNone(self.storage.acquire_lock("bla", 10))
+        lock.release()
+        self.assertIsNone(lock.token)
+        self.assertEqual(2, self.storage.acquire_lock("bla", 10))
+        self.assertEqual(1, self.wait_observations("acquired"))
+
+    def test_acquire_waits_for_the_holder(self):
+        storage = mock.Mock()
+        storage.acquire_lock.side_effect = [None, None, 3]
+        lock = InstanceLock(storage, "bla", poll_interval=0.001)
+        self.assertEqual(3, lock.acquire())
+        self.assertEqual(3, storage.acquire_lock.call_count)
+
+    def test_acquire_timeout(self):
+        self.storage.acquire_lock("bla", 10)
+        lock = InstanceLock(self.storage, "bla", timeout=0.01, poll_interval=0.001)
+        with self.assertRaises(LockTimeoutError):
+            lock.acquire()
+        self.assertEqual(1, self.wait_observations("timeout"))
+
+    def test_check_renews_the_lease(self):
+        with InstanceLock(self.storage, "bla", ttl=10) as lock:
+            lock.check()
+
+    def test_heartbeat_keeps_the_lease(self):
+        with InstanceLock(self.storage, "bla", ttl=0.15):
+            time.sleep(0.3)
+            self.assertIsNone(self.storage.acquire_lock("bla", 10))
+        self.assertIsNotNone(self.storage.acquire_lock("bla", 10))
+
+    def test_heartbeat_stops_on_release(self):
+        storage = mock.Mock()
+        storage.acquire_lock.return_value = 1
+        with InstanceLock(storage, "bla", ttl=0.03):
+            pass
+        time.sleep(0.05)
+        self.assertFalse(storage.renew_lock.called)
+
+    def test_check_lost_lock(self):
+        lock = InstanceLock(self.storage, "bla", ttl=-1)
+        lock.acquire()
+        self.storage.acquire_lock("bla", 10)
+        with self.assertRaises(LockLostError):
+            lock.check()
+        # releasing a lost lock keeps the new holder
+        lock.release()
+        self.assertIsNone(self.storage.acquire_lock("bla", 10))
+
+
+class LockedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = Manager(MemoryLocks())
+
+    def run_threads(self, names):
+        # every request has its own manager, like the ones in the pool
+        results = {}
+
+        def run(i, name):
+            manager = Manager(self.manager.storage, self.manager.tracker)
+            results[i] = manager.mutate(name)
+        threads = [threading.Thread(target=run, args=(i, name)) for i, name in enumerate(names)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_same_instance_is_serialized(self):
+        self.run_threads(["bla", "bla", "bla"])
+        self.assertEqual([], self.manager.tracker.overlaps)
+
+    def test_different_instances_run_in_parallel(self):
+        results = self.run_threads(["bla", "ble"])
+        self.assertIn(["bla", "ble"], [sorted(r) for r in results.values()])
+
+    def test_nested_calls_reuse_the_lock(self):
+        self.assertEqual(["bla"], self.manager.nested("bla"))
+        self.assertIsNone(self.manager.lock)
+
+    def test_release_on_error(self):
+        with self.assertRaises(ValueError):
+            self.manager.fail("bla")
+        self.assertIsNone(self.manager.lock)
+        self.assertIsNotNone(self.manager.storage.acquire_lock("bla", 10))
@@ -0,0 +1,70 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from healthcheck.manage import (backfill_comments, check_indexes, command,
+                                ensure_indexes, main, show_help)
+
+
+class ManageTest(unittest.TestCase):
+
+    @mock.patch("sys.stdout")
+    @mock.patch("healthcheck.manage.get_manager")
+    def test_backfill_comments(self, get_manager, stdout):
+        get_manager.return_value.backfill_comments.return_value = 3
+        backfill_comments("50")
+        get_manager.return_value.backfill_comments.assert_called_with(50)
+        stdout.write.assert_called_with("3 items updated\n")
+
+    @mock.patch("sys.stdout")
+    @mock.patch("healthcheck.storage.MongoStorage")
+    def test_ensure_indexes(self, storage, stdout):
+        storage.return_value.ensure_indexes.return_value = ["items.url_1"]
+        ensure_indexes()
+        stdout.write.assert_called_with("items.url_1\n")
+
+    @mock.patch("sys.stdout")
+    @mock.patch("healthcheck.storage.MongoStorage")
+    def test_check_indexes(self, storage, stdout):
+        storage.return_value.check_indexes.return_value = {
+            "missing": [],
+            "uncovered": [("items", ("comment",), "find_items_without_comment")],
+        }
+        check_indexes()
+        stdout.write.assert_called_with(
+            "query find_items_without_comment on items (comment) is not covered by an index\n")
+
+    @mock.patch("sys.stdout")
+    @mock.patch("healthcheck.storage.MongoStorage")
+    def test_check_indexes_missing(self, storage, stdout):
+        storage.return_value.check_indexes.return_value = {
+            "missing": [("items", [("group_id", 1), ("url", 1)])],
+            "uncovered": [],
+        }
+        with self.assertRaises(SystemExit) as cm:
+            check_indexes()
+        self.assertEqual(1, cm.exception.code)
+        stdout.write.assert_called_with("missing index items (group_id, url)\n")
+
+    @mock.patch("sys.stderr")
+    def test_help(self, stderr):
+        with self.assertRaises(SystemExit) as cm:
+            show_help("backfill-comments")
+        self.assertEqual(0, cm.exception.code)
+        doc = backfill_comments.__doc__.lstrip("\n").rstrip() + "\n"
+        stderr.write.assert_called_with(doc)
+
+    @mock.patch("sys.stderr")
+    def test_command_not_found(self, stderr):
+        with self.assertRaises(SystemExit) as cm:
+            command("waaaat")
+        self.assertEqual(2, cm.exception.code)
+
+    @mock.patch("healthcheck.manage.backfill_comments")
+    def test_main(self, backfill_mock):
+        main("backfill-comments", "10")
+        backfill_mock.assert_called_with("10")
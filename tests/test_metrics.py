@@ -0,0 +1,170 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from healthcheck import metrics
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_observe(self):
+        self.registry.observe("latency", (("method", "host.get"),), 0.003)
+        self.registry.observe("latency", (("method", "host.get"),), 0.2)
+        self.registry.observe("latency", (("method", "host.get"),), 60)
+        buckets, total = self.registry.histograms[("latency", (("method", "host.get"),))]
+        self.assertEqual(1, buckets[0])
+        self.assertEqual(1, buckets[metrics.BUCKETS.index(0.25)])
+        self.assertEqual(1, buckets[-1])
+        self.assertEqual(3, sum(buckets))
+        self.assertAlmostEqual(60.203, total)
+
+    def test_observe_on_bucket_bound(self):
+        self.registry.observe("latency", (), 0.5)
+        buckets, _ = self.registry.histograms[("latency", ())]
+        self.assertEqual(1, buckets[metrics.BUCKETS.index(0.5)])
+
+    def test_inc(self):
+        self.registry.inc("errors", (("method", "a"),))
+        self.registry.inc("errors", (("method", "a"),), 2)
+        self.assertEqual(3, self.registry.counters[("errors", (("method", "a"),))])
+
+    def test_snapshot_includes_gauges(self):
+        self.registry.register_gauges(lambda: [("in_use", (("manager", "zabbix"),), 2)])
+        snapshot = self.registry.snapshot()
+        self.assertEqual(os.getpid(), snapshot["pid"])
+        self.assertEqual([["in_use", [("manager", "zabbix")], 2]], snapshot["gauges"])
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        patcher = mock.patch.object(metrics, "registry", self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.addCleanup(metrics.stop_flusher)
+
+    def own_file(self):
+        return os.path.join(self.dir, "{}-{}.json".format(os.getpid(), metrics.token()))
+
+    def test_observe_call(self):
+        listener = mock.Mock()
+        metrics.listeners.append(listener)
+        self.addCleanup(metrics.listeners.remove, listener)
+        metrics.observe_call("zabbix", "host.get", 0.1)
+        metrics.observe_call("zabbix", "host.get", 0.2, error=True)
+        metrics.observe_call("mongo", "find_item_by_url", 0.01)
+        key = ("hcaas_zabbix_call_duration_seconds", (("method", "host.get"),))
+        self.assertEqual(2, sum(self.registry.histograms[key][0]))
+        self.assertEqual(1, self.registry.counters[
+            ("hcaas_zabbix_call_errors_total", (("method", "host.get"),))])
+        self.assertIn(("hcaas_storage_call_duration_seconds", (("method", "find_item_by_url"),)),
+                      self.registry.histograms)
+        listener.assert_called_with("mongo", "find_item_by_url", 0.01, False)
+
+    def test_observe_request(self):
+        metrics.observe_request("/resources/<name>/url", "GET", 200, 0.1)
+        metrics.observe_request("/resources/<name>/url", "GET", 500, 0.1)
+        route = metrics.labels(route="/resources/<name>/url", method="GET")
+        self.assertEqual(2, sum(self.registry.histograms[
+            ("hcaas_http_request_duration_seconds", route)][0]))
+        self.assertEqual(1, self.registry.counters[("hcaas_http_request_errors_total", route)])
+
+    def test_render(self):
+        self.registry.observe("latency", (("method", 'a"b'),), 0.003)
+        self.registry.inc("errors_total", (("method", "a"),))
+        output = metrics.render()
+        self.assertIn("# TYPE errors_total counter\nerrors_total{method=\"a\"} 1\n", output)
+        self.assertIn("# TYPE latency histogram\n", output)
+        self.assertIn('latency_bucket{method="a\\"b",le="0.005"} 1\n', output)
+        self.assertIn('latency_bucket{method="a\\"b",le="+Inf"} 1\n', output)
+        self.assertIn('latency_sum{method="a\\"b"} 0.003\n', output)
+        self.assertIn('latency_count{method="a\\"b"} 1\n', output)
+
+    def test_flush_without_dir(self):
+        with mock.patch.dict(os.environ, {}, clear=False):
+            os.environ.pop("METRICS_DIR", None)
+            metrics.flush(force=True)
+        self.assertEqual([], os.listdir(self.dir))
+
+    def test_collect_merges_workers(self):
+        self.registry.inc("errors_total", (("method", "a"),))
+        self.registry.observe("latency", (), 0.003)
+        self.registry.register_gauges(lambda: [("in_use", (), 1)])
+        other = {
+            "pid": 1,
+            "histograms": [["latency", [], [0] * len(metrics.BUCKETS) + [1], 20.0]],
+            "counters": [["errors_total", [["method", "a"]], 2]],
+            "gauges": [["in_use", [], 3]],
+        }
+        dead = dict(other, pid=2)
+        for snapshot in (other, dead):
+            with open(os.path.join(self.dir, "{}.json".format(snapshot["pid"])), "w") as f:
+                json.dump(snapshot, f)
+        with mock.patch.dict(os.environ, {"METRICS_DIR": self.dir}):
+            metrics.flush(force=True)
+            with mock.patch.object(metrics, "pid_alive", side_effect=lambda pid: pid == 1):
+                histograms, counters, gauges = metrics.collect()
+        self.assertTrue(os.path.exists(self.own_file()))
+        self.assertEqual(5, counters[("errors_total", (("method", "a"),))])
+        buckets, total = histograms[("latency", ())]
+        self.assertEqual(3, sum(buckets))
+        self.assertAlmostEqual(40.003, total)
+        self.assertEqual(4, gauges[("in_use", ())])
+
+    def test_collect_archives_dead_workers(self):
+        dead = {
+            "pid": 2,
+            "histograms": [["latency", [], [0] * len(metrics.BUCKETS) + [1], 20.0]],
+            "counters": [["errors_total", [["method", "a"]], 2]],
+            "gauges": [["in_use", [], 3]],
+        }
+        # an older process had this pid
+        reused = dict(dead, pid=os.getpid(), token="old")
+        for name, snapshot in (("2-x.json", dead), ("{}-old.json".format(os.getpid()), reused)):
+            with open(os.path.join(self.dir, name), "w") as f:
+                json.dump(snapshot, f)
+        self.registry.inc("errors_total", (("method", "a"),))
+        with mock.patch.dict(os.environ, {"METRICS_DIR": self.dir}):
+            metrics.flush(force=True)
+            with mock.patch.object(metrics, "pid_alive", return_value=False):
+                for _ in range(2):
+                    histograms, counters, gauges = metrics.collect()
+        self.assertEqual(sorted([metrics.ARCHIVE, os.path.basename(self.own_file())]),
+                         sorted(f for f in os.listdir(self.dir) if f.endswith(".json")))
+        self.assertEqual(5, counters[("errors_total", (("method", "a"),))])
+        self.assertEqual(2, sum(histograms[("latency", ())][0]))
+        self.assertEqual({}, gauges)
+
+    def test_background_flush(self):
+        with mock.patch.dict(os.environ, {"METRICS_DIR": self.dir,
+                                          "METRICS_FLUSH_INTERVAL": "0.01"}):
+            metrics.flush(force=True)
+            self.registry.inc("errors_total", ())
+            snapshot = None
+            for _ in range(100):
+                snapshot = metrics.load(self.own_file())
+                if snapshot["counters"]:
+                    break
+                time.sleep(0.01)
+        self.assertEqual([["errors_total", [], 1]], snapshot["counters"])
+
+    def test_flush_at_exit(self):
+        with mock.patch.dict(os.environ, {"METRICS_DIR": self.dir}):
+            self.registry.inc("errors_total", ())
+            metrics.flush_at_exit(os.getpid())
+        self.assertEqual([["errors_total", [], 1]], metrics.load(self.own_file())["counters"])
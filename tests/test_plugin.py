@@ -390,6 +390,61 @@ class PluginTest(unittest.TestCase):
         self.assertEqual(calls, request.add_header.call_args_list)
         urlopen.assert_called_with(request, timeout=30)
 
+    def job_response(self, status, error=None, code=None):
+        result = mock.Mock()
+        result.getcode.return_value = code or (202 if status == "queued" else 200)
+        body = {"id": "abc", "status": status, "error": error}
+        result.read.return_value = json.dumps(body).encode("utf-8")
+        return result
+
+    @mock.patch("time.sleep")
+    @mock.patch("sys.stdout")
+    @mock.patch("healthcheck.plugin.urlopen")
+    @mock.patch("healthcheck.plugin.Request")
+    def test_add_url_async(self, Request, urlopen, stdout, sleep):
+        urlopen.side_effect = [
+            self.job_response("queued"),
+            self.job_response("running"),
+            self.job_response("done"),
+        ]
+        add_url("service_name", "name", "http://example.com/hc")
+        Request.assert_called_with(
+            self.target + 'services/service_name/proxy/name?callback=/resources/name/jobs/abc',
+        )
+        self.assertEqual(3, urlopen.call_count)
+        self.assertEqual(2, sleep.call_count)
+        stdout.write.assert_called_with("url http://example.com/hc successfully added!\n")
+
+    @mock.patch("time.sleep")
+    @mock.patch("sys.stderr")
+    @mock.patch("healthcheck.plugin.urlopen")
+    @mock.patch("healthcheck.plugin.Request")
+    def test_add_group_async_failed(self, Request, urlopen, stderr, sleep):
+        urlopen.side_effect = [
+            self.job_response("queued"),
+            self.job_response("failed", "group not exists"),
+        ]
+        with self.assertRaises(SystemExit) as cm:
+            add_group("service_name", "name", "group")
+        self.assertEqual(1, cm.exception.code)
+        stderr.write.assert_called_with("ERROR: group not exists\n")
+
+    @mock.patch("time.time")
+    @mock.patch("time.sleep")
+    @mock.patch("sys.stderr")
+    @mock.patch("healthcheck.plugin.urlopen")
+    @mock.patch("healthcheck.plugin.Request")
+    def test_add_url_async_timeout(self, Request, urlopen, stderr, sleep, time):
+        time.side_effect = [0, 100, 301]
+        urlopen.side_effect = [
+            self.job_response("queued"),
+            self.job_response("running"),
+        ]
+        with self.assertRaises(SystemExit) as cm:
+            add_url("service_name", "name", "http://example.com/hc")
+        self.assertEqual(1, cm.exception.code)
+        stderr.write.assert_called_with("ERROR: job abc is still running, check it later\n")
+
     @mock.patch("sys.stderr")
     def test_help(self, stderr):
         with self.assertRaises(SystemExit) as cm:
@@ -0,0 +1,69 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from healthcheck.pool import ManagerPool, PoolTimeoutError
+
+
+class ManagerPoolTest(unittest.TestCase):
+
+    def test_acquire_creates_manager_lazily(self):
+        factory = mock.Mock()
+        pool = ManagerPool(factory, size=2)
+        self.assertFalse(factory.called)
+        manager = pool.acquire()
+        self.assertEqual(factory.return_value, manager)
+        self.assertEqual(1, factory.call_count)
+
+    def test_release_reuses_manager(self):
+        factory = mock.Mock(side_effect=[object(), object()])
+        pool = ManagerPool(factory, size=2)
+        manager = pool.acquire()
+        pool.release(manager)
+        self.assertIs(manager, pool.acquire())
+        self.assertEqual(1, factory.call_count)
+
+    def test_acquire_creates_up_to_size(self):
+        factory = mock.Mock(side_effect=[object(), object()])
+        pool = ManagerPool(factory, size=2, timeout=0.01)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertIsNot(first, second)
+        with self.assertRaises(PoolTimeoutError):
+            pool.acquire()
+
+    def test_factory_failure_frees_slot(self):
+        factory = mock.Mock(side_effect=[ValueError(), "manager"])
+        pool = ManagerPool(factory, size=1, timeout=0.01)
+        with self.assertRaises(ValueError):
+            pool.acquire()
+        self.assertEqual("manager", pool.acquire())
+
+    def test_manager_context(self):
+        pool = ManagerPool(mock.Mock(), size=1)
+        with pool.manager() as manager:
+            self.assertEqual(1, pool.stats()["in_use"])
+        self.assertEqual(0, pool.stats()["in_use"])
+        self.assertIs(manager, pool.acquire())
+
+    def test_stats(self):
+        pool = ManagerPool(mock.Mock(), size=1, timeout=0.01)
+        manager = pool.acquire()
+        with self.assertRaises(PoolTimeoutError):
+            pool.acquire()
+        stats = pool.stats()
+        self.assertEqual(1, stats["size"])
+        self.assertEqual(1, stats["created"])
+        self.assertEqual(1, stats["in_use"])
+        self.assertEqual(0, stats["idle"])
+        self.assertEqual(0, stats["waiting"])
+        self.assertEqual(1, stats["acquired"])
+        self.assertEqual(1, stats["waits"])
+        self.assertTrue(stats["wait_time"] > 0)
+        self.assertEqual(stats["wait_time"], stats["max_wait_time"])
+        pool.release(manager)
+        self.assertEqual(1, pool.stats()["idle"])
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import threading
+import unittest
+
+import mock
+from werkzeug.serving import make_server
+
+from benchmarks.replay import Replayer, read_trace
+from benchmarks.trace import TraceGenerator
+from healthcheck import api
+
+from .managers import FakeManager
+
+
+class ReadTraceTest(unittest.TestCase):
+
+    def test_sorted_by_timestamp(self):
+        lines = [
+            '{"method": "GET", "path": "/b", "timestamp": 2}',
+            '',
+            '{"method": "GET", "path": "/a", "timestamp": 1}',
+        ]
+        self.assertEqual(["/a", "/b"], [e["path"] for e in read_trace(lines)])
+
+    def test_required_fields(self):
+        with self.assertRaises(ValueError) as cm:
+            read_trace(['{"method": "GET", "timestamp": 1}'])
+        self.assertEqual("line 1: path is required", str(cm.exception))
+        with self.assertRaises(ValueError):
+            read_trace(['{"method":'])
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def entries(self, *timestamps):
+        return [{"method": "GET", "path": "/", "timestamp": t} for t in timestamps]
+
+    def test_original_pacing(self):
+        replayer = Replayer("http://localhost", match=lambda m, p: p)
+        self.assertEqual([0, 1, 3], replayer.schedule(self.entries(10, 11, 13)))
+
+    def test_compressed(self):
+        replayer = Replayer("http://localhost", speed=2, match=lambda m, p: p)
+        self.assertEqual([0, 0.5, 1.5], replayer.schedule(self.entries(10, 11, 13)))
+        replayer = Replayer("http://localhost", speed=0, match=lambda m, p: p)
+        self.assertEqual([0, 0, 0], replayer.schedule(self.entries(10, 11, 13)))
+
+    def test_rate(self):
+        replayer = Replayer("http://localhost", speed=0, rate=4, match=lambda m, p: p)
+        self.assertEqual([0, 0.25, 0.5], replayer.schedule(self.entries(10, 10, 10)))
+
+
+class ReplayerTest(unittest.TestCase):
+
+    def setUp(self):
+        manager = FakeManager()
+        patcher = mock.patch.object(api, "get_manager", return_value=manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = make_server("127.0.0.1", 0, api.app)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.shutdown)
+        self.target = "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def test_replay(self):
+        generator = TraceGenerator(instances=2, groups=3, urls_per_instance=2, seed=1)
+        entries = list(generator.generate(duration=5, rate=10))
+        replayer = Replayer(self.target, concurrency=1, speed=0)
+        report = replayer.replay(entries)
+        self.assertEqual(len(entries) - 6, report["requests"])
+        self.assertEqual(0, report["errors"])
+        routes = dict((r["route"], r) for r in report["routes"])
+        self.assertIn("GET /resources/<name>/url", routes)
+        for route in routes.values():
+            for status in route["statuses"]:
+                self.assertIn(status[0], "2", route["route"])
+
+    def test_errors(self):
+        entries = [
+            {"method": "GET", "path": "/resources/missing/url", "timestamp": 0},
+            {"method": "GET", "path": "/", "timestamp": 0},
+        ]
+        report = Replayer(self.target, concurrency=2, speed=0).replay(entries)
+        routes = dict((r["route"], r) for r in report["routes"])
+        self.assertEqual(1, routes["GET /resources/<name>/url"]["errors"])
+        self.assertEqual({"500": 1}, routes["GET /resources/<name>/url"]["statuses"])
+        self.assertEqual({"200": 1}, routes["GET /"]["statuses"])
+
+    def test_connection_error(self):
+        entries = [{"method": "GET", "path": "/", "timestamp": 0}]
+        report = Replayer("http://127.0.0.1:1", speed=0).replay(entries)
+        self.assertEqual(1, report["errors"])
+        self.assertEqual({"error": 1}, report["routes"][0]["statuses"])
@@ -2,13 +2,18 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import threading
 import unittest
 import mock
 import os
 
-from healthcheck.storage import (HealthCheck, HealthCheckNotFoundError, Item,
-                                 Jsonable, MongoStorage, User,
-                                 UserNotFoundError, ItemNotFoundError)
+from healthcheck import deadlines
+from healthcheck import storage as hstorage
+from healthcheck.storage import (CachedStorage, HealthCheck,
+                                 HealthCheckNotFoundError, IdempotencyKey,
+                                 IdempotencyKeyNotFoundError, Item, Job,
+                                 JobNotFoundError, Jsonable, MongoStorage,
+                                 User, UserNotFoundError, ItemNotFoundError)
 
 
 class JsonableTest(unittest.TestCase):
@@ -63,24 +68,22 @@ class ItemTest(unittest.TestCase):
             item.to_json(), {"url": "http://teste.com", "id": 1})
 
 
-class MongoStorageTest(unittest.TestCase):
+class MongoClientTest(unittest.TestCase):
 
     def remove_env(self, env):
         if env in os.environ:
             del os.environ[env]
 
     def setUp(self):
-        self.storage = MongoStorage()
-        self.url = "http://myurl.com"
-        self.item = Item(self.url)
-        self.user = User("id", "w@w.com", ["group_id"])
-        self.healthcheck = HealthCheck("bla")
+        hstorage.disconnect()
+        self.addCleanup(hstorage.disconnect)
 
     @mock.patch("pymongo.MongoClient")
     def test_mongodb_host_environ(self, mongo_mock):
-        self.storage.conn()
+        MongoStorage().conn()
         mongo_mock.assert_called_with('mongodb://localhost:27017/')
 
+        hstorage.disconnect()
         os.environ["MONGODB_URI"] = "mongodb://myhost:2222/"
         self.addCleanup(self.remove_env, "MONGODB_URI")
         storage = MongoStorage()
@@ -88,15 +91,320 @@ class MongoStorageTest(unittest.TestCase):
         mongo_mock.assert_called_with('mongodb://myhost:2222/')
 
     @mock.patch("pymongo.MongoClient")
-    def test_mongodb_port_environ(self, mongo_mock):
-        self.storage.conn()
-        mongo_mock.assert_called_with('mongodb://localhost:27017/')
+    def test_mongodb_client_options_environ(self, mongo_mock):
+        os.environ["MONGODB_MAX_POOL_SIZE"] = "20"
+        os.environ["MONGODB_SOCKET_TIMEOUT_MS"] = "5000"
+        self.addCleanup(self.remove_env, "MONGODB_MAX_POOL_SIZE")
+        self.addCleanup(self.remove_env, "MONGODB_SOCKET_TIMEOUT_MS")
+        MongoStorage()
+        mongo_mock.assert_called_with('mongodb://localhost:27017/',
+                                      maxPoolSize=20, socketTimeoutMS=5000)
+
+    @mock.patch("pymongo.MongoClient")
+    def test_storages_share_client(self, mongo_mock):
+        before = hstorage.connection_stats()["clients_created"]
+        first = MongoStorage()
+        second = MongoStorage()
+        self.assertIs(first.conn(), second.conn())
+        self.assertEqual(1, mongo_mock.call_count)
+        stats = hstorage.connection_stats()
+        self.assertEqual(before + 1, stats["clients_created"])
+        self.assertTrue(stats["connected"])
+
+    @mock.patch("os.getpid")
+    @mock.patch("pymongo.MongoClient")
+    def test_new_client_after_fork(self, mongo_mock, getpid_mock):
+        getpid_mock.return_value = 1
+        parent = MongoStorage().conn()
+        getpid_mock.return_value = 2
+        mongo_mock.return_value = mock.MagicMock()
+        child = MongoStorage().conn()
+        self.assertIsNot(parent, child)
+        self.assertEqual(2, mongo_mock.call_count)
+        self.assertFalse(parent.close.called)
+
+    @mock.patch("pymongo.MongoClient")
+    def test_disconnect(self, mongo_mock):
+        client = MongoStorage().conn()
+        hstorage.disconnect()
+        client.close.assert_called_with()
+        self.assertFalse(hstorage.connection_stats()["connected"])
 
-        os.environ["MONGODB_URI"] = "mongodb://myhost:2222/"
-        self.addCleanup(self.remove_env, "MONGODB_URI")
-        storage = MongoStorage()
-        storage.conn()
-        mongo_mock.assert_called_with('mongodb://myhost:2222/')
+
+class CachedStorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = mock.Mock()
+        self.storage = CachedStorage(self.backend)
+
+    def test_repeated_reads_hit_memory(self):
+        hc = self.storage.find_healthcheck_by_name("hc")
+        self.assertIs(hc, self.storage.find_healthcheck_by_name("hc"))
+        self.backend.find_healthcheck_by_name.assert_called_once_with("hc")
+        self.storage.find_healthcheck_by_name("other")
+        self.assertEqual(2, self.backend.find_healthcheck_by_name.call_count)
+        self.assertEqual({"reads": 2, "hits": 1}, self.storage.stats())
+
+    def test_not_found_is_not_cached(self):
+        self.backend.find_user_by_email.side_effect = UserNotFoundError()
+        for _ in range(2):
+            with self.assertRaises(UserNotFoundError):
+                self.storage.find_user_by_email("w@w.com")
+        self.assertEqual(2, self.backend.find_user_by_email.call_count)
+
+    def test_write_invalidates_entity(self):
+        self.storage.find_user_by_email("w@w.com")
+        self.storage.find_users_by_group("g1")
+        self.storage.find_healthcheck_by_name("hc")
+        user = User("id", "w@w.com", "g1")
+        self.storage.add_user_to_group(user, "g2")
+        self.backend.add_user_to_group.assert_called_once_with(user, "g2")
+        self.storage.find_user_by_email("w@w.com")
+        self.storage.find_users_by_group("g1")
+        self.storage.find_healthcheck_by_name("hc")
+        self.assertEqual(2, self.backend.find_user_by_email.call_count)
+        self.assertEqual(2, self.backend.find_users_by_group.call_count)
+        self.assertEqual(1, self.backend.find_healthcheck_by_name.call_count)
+
+    def test_uncached_reads_are_counted(self):
+        self.storage.find_healthcheck_with_items("hc")
+        self.storage.find_healthcheck_with_items("hc")
+        self.assertEqual(2, self.backend.find_healthcheck_with_items.call_count)
+        self.assertEqual({"reads": 2, "hits": 0}, self.storage.stats())
+
+    def test_begin_resets(self):
+        self.storage.find_item_by_url("http://a.com")
+        self.storage.begin()
+        self.assertEqual({"reads": 0, "hits": 0}, self.storage.stats())
+        self.storage.find_item_by_url("http://a.com")
+        self.assertEqual(2, self.backend.find_item_by_url.call_count)
+
+    @mock.patch("healthcheck.metrics.observe_call")
+    def test_calls_are_observed(self, observe_call):
+        self.storage.find_healthcheck_by_name("hc")
+        self.storage.find_healthcheck_by_name("hc")
+        self.backend.add_item.side_effect = ValueError()
+        with self.assertRaises(ValueError):
+            self.storage.add_item(Item("http://a.com"))
+        self.backend.find_user_by_email.side_effect = UserNotFoundError()
+        with self.assertRaises(UserNotFoundError):
+            self.storage.find_user_by_email("w@w.com")
+        calls = [c[0][:2] + (c[0][3],) for c in observe_call.call_args_list]
+        self.assertEqual([
+            ("mongo", "find_healthcheck_by_name", False),
+            ("mongo", "add_item", True),
+            ("mongo", "find_user_by_email", False),
+        ], calls)
+
+    def test_concurrent_reads_and_writes(self):
+        def read():
+            for i in range(200):
+                self.storage.find_healthcheck_by_name("hc{}".format(i))
+
+        def write():
+            for _ in range(200):
+                self.storage.add_healthcheck(HealthCheck("hc"))
+        threads = [threading.Thread(target=fn) for fn in (read, write, read)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(400, self.storage.stats()["reads"] + self.storage.stats()["hits"])
+
+    def test_other_attributes_pass_through(self):
+        self.assertIs(self.backend.db, self.storage.db)
+
+    def test_calls_past_the_deadline(self):
+        with deadlines.override(deadlines.Deadline(-1)):
+            with self.assertRaises(deadlines.DeadlineExceededError):
+                self.storage.find_healthcheck_by_name("hc")
+            with self.assertRaises(deadlines.DeadlineExceededError):
+                self.storage.add_item(Item("http://a.com"))
+            self.storage.release_lock("hc", 1)
+        self.assertFalse(self.backend.find_healthcheck_by_name.called)
+        self.assertFalse(self.backend.add_item.called)
+        self.backend.release_lock.assert_called_once_with("hc", 1)
+
+    def test_writes_recording_zabbix_changes_past_the_deadline(self):
+        user = User("1", "w@w.com", "g")
+        with deadlines.override(deadlines.Deadline(-1)):
+            self.storage.add_user(user)
+            self.storage.add_user_to_group(user, "g2")
+            self.storage.remove_items_by_group("g")
+        self.backend.add_user.assert_called_once_with(user)
+        self.backend.add_user_to_group.assert_called_once_with(user, "g2")
+        self.backend.remove_items_by_group.assert_called_once_with("g")
+
+    def test_execution_timeout_past_the_deadline(self):
+        from pymongo.errors import ExecutionTimeout
+        deadline = deadlines.Deadline(5)
+
+        def find_job(job_id):
+            deadline.expires_at = 0
+            raise ExecutionTimeout("operation exceeded time limit")
+        self.backend.find_job.side_effect = find_job
+        with deadlines.override(deadline):
+            with self.assertRaises(deadlines.DeadlineExceededError):
+                self.storage.find_job("1")
+
+
+class MaxTimeTest(unittest.TestCase):
+
+    def setUp(self):
+        hstorage.disconnect()
+        self.addCleanup(hstorage.disconnect)
+        patcher = mock.patch("pymongo.MongoClient")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage = MongoStorage()
+
+    def test_find_sets_the_max_time_on_the_cursor(self):
+        items = self.storage.db.items
+        items.find.return_value.max_time_ms.return_value = [{"url": "http://a.com"}]
+        users = self.storage.db.users
+        users.find.return_value.max_time_ms.return_value = [
+            {"id": "1", "email": "w@w.com", "groups_id": ["g"]}]
+        with deadlines.override(deadlines.Deadline(2)):
+            self.assertEqual(["http://a.com"],
+                             [i.url for i in self.storage.find_items_by_group("g")])
+            self.assertEqual(["w@w.com"],
+                             [u.email for u in self.storage.find_users_by_group("g")])
+        items.find.assert_called_once_with({"group_id": "g"})
+        users.find.assert_called_once_with({"groups_id": "g"})
+        for collection in (items, users):
+            max_time, = collection.find.return_value.max_time_ms.call_args[0]
+            self.assertAlmostEqual(2000, max_time, delta=100)
+
+    def test_find_without_deadline(self):
+        self.storage.db.items.find.return_value = mock.MagicMock()
+        self.assertEqual([], self.storage.find_items_by_group("g"))
+        self.assertFalse(self.storage.db.items.find.return_value.max_time_ms.called)
+
+
+class IndexesTest(unittest.TestCase):
+
+    def setUp(self):
+        hstorage.disconnect()
+        self.addCleanup(hstorage.disconnect)
+        patcher = mock.patch("pymongo.MongoClient")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage = MongoStorage()
+        self.collections = {}
+        self.storage.db = mock.MagicMock()
+        self.storage.db.__getitem__.side_effect = self.collection
+
+    def collection(self, name):
+        return self.collections.setdefault(name, mock.Mock())
+
+    def index_information(self, collection, *indexes):
+        info = {"_id_": {"key": [("_id", 1)]}}
+        for i, (keys, unique) in enumerate(indexes):
+            info["idx{}".format(i)] = {"key": keys, "unique": unique}
+        self.collection(collection).index_information.return_value = info
+
+    def test_ensure_indexes(self):
+        for name in ("healthchecks", "items", "users", "jobs", "locks", "idempotency_keys"):
+            self.collection(name).create_index.return_value = "idx"
+        created = self.storage.ensure_indexes()
+        self.assertEqual(13, len(created))
+        self.collection("healthchecks").create_index.assert_called_once_with(
+            [("name", 1)], background=True, unique=True)
+        self.collection("items").create_index.assert_any_call(
+            [("group_id", 1), ("url", 1)], background=True)
+        self.collection("users").create_index.assert_any_call([("groups_id", 1)], background=True)
+        self.collection("jobs").create_index.assert_any_call(
+            [("finished_at", 1)], background=True, expireAfterSeconds=604800)
+        self.collection("locks").create_index.assert_any_call(
+            [("name", 1)], background=True, unique=True)
+        self.collection("idempotency_keys").create_index.assert_any_call(
+            [("expires_at", 1)], background=True, expireAfterSeconds=0)
+
+    def test_ensure_indexes_of_some_collections(self):
+        self.collection("locks").create_index.return_value = "idx"
+        self.assertEqual(["locks.idx", "locks.idx"], self.storage.ensure_indexes(["locks"]))
+        self.assertNotIn("items", self.collections)
+
+    def test_ensure_indexes_failure(self):
+        from pymongo.errors import DuplicateKeyError
+        self.collection("healthchecks").create_index.side_effect = DuplicateKeyError("dup")
+        self.collection("items").create_index.return_value = "idx"
+        with self.assertRaises(DuplicateKeyError):
+            self.storage.ensure_indexes()
+        created = self.storage.ensure_indexes(strict=False)
+        self.assertIn("items.idx", created)
+        self.assertNotIn("healthchecks.idx", created)
+
+    @mock.patch.dict(os.environ, {"MONGODB_ENSURE_INDEXES": "true"})
+    def test_ensure_indexes_on_startup(self):
+        with mock.patch.object(MongoStorage, "ensure_indexes") as ensure:
+            with mock.patch.object(hstorage, "_indexes_ensured", False):
+                MongoStorage()
+                MongoStorage()
+        ensure.assert_called_once_with(strict=False)
+
+    @mock.patch.dict(os.environ, {"MONGODB_ENSURE_INDEXES": "true"})
+    def test_ensure_indexes_on_startup_does_not_fail(self):
+        from pymongo.errors import DuplicateKeyError
+        with mock.patch("pymongo.collection.Collection.create_index",
+                        side_effect=DuplicateKeyError("dup")):
+            with mock.patch.object(hstorage, "_indexes_ensured", False):
+                MongoStorage()
+
+    def test_require_indexes(self):
+        self.collection("locks").create_index.return_value = "idx"
+        with mock.patch.object(hstorage, "_required_indexes", set()):
+            self.storage.require_indexes("locks")
+            self.storage.require_indexes("locks")
+        self.assertEqual(2, self.collection("locks").create_index.call_count)
+
+    def test_check_indexes_all_present(self):
+        self.index_information("healthchecks", ([("name", 1.0)], True))
+        self.index_information("items", ([("group_id", 1), ("url", 1)], False),
+                               ([("url", 1)], False), ([("comment", 1)], False))
+        self.index_information("users", ([("email", 1)], False),
+                               ([("groups_id", 1)], False), ([("id", 1)], False))
+        self.index_information("jobs", ([("id", 1)], True),
+                               ([("status", 1), ("created_at", 1)], False),
+                               ([("finished_at", 1)], False))
+        self.index_information("locks", ([("name", 1)], True), ([("expires_at", 1)], False))
+        self.index_information("idempotency_keys", ([("key", 1)], True), ([("expires_at", 1)], False))
+        self.assertEqual({"missing": [], "uncovered": []}, self.storage.check_indexes())
+
+    def test_check_indexes_missing(self):
+        self.index_information("healthchecks", ([("name", 1)], False))
+        self.index_information("items", ([("group_id", 1), ("url", 1)], False))
+        self.index_information("users")
+        self.index_information("jobs")
+        self.index_information("locks")
+        self.index_information("idempotency_keys")
+        report = self.storage.check_indexes()
+        self.assertIn(("healthchecks", [("name", 1)]), report["missing"])
+        self.assertIn(("items", [("url", 1)]), report["missing"])
+        self.assertNotIn(("items", [("group_id", 1), ("url", 1)]), report["missing"])
+        self.assertIn(("items", ("url",), "find_item_by_url"), report["uncovered"])
+        self.assertIn(("items", ("comment",), "find_items_without_comment"), report["uncovered"])
+        self.assertIn(("users", ("email",), "find_user_by_email"), report["uncovered"])
+        self.assertNotIn(("items", ("group_id",), "find_items_by_group"), report["uncovered"])
+        self.assertNotIn(("healthchecks", ("name",), "find_healthcheck_by_name"), report["uncovered"])
+
+
+class MongoStorageTest(unittest.TestCase):
+
+    def remove_env(self, env):
+        if env in os.environ:
+            del os.environ[env]
+
+    def setUp(self):
+        # each test creates the indexes it relies on
+        patcher = mock.patch.object(hstorage, "_required_indexes", set())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage = MongoStorage()
+        self.url = "http://myurl.com"
+        self.item = Item(self.url)
+        self.user = User("id", "w@w.com", ["group_id"])
+        self.healthcheck = HealthCheck("bla")
 
     def test_add_item(self):
         self.storage.add_item(self.item)
@@ -104,6 +412,14 @@ class MongoStorageTest(unittest.TestCase):
         self.assertEqual(result.url, self.url)
         self.storage.remove_item(self.item)
 
+    def test_add_items(self):
+        other = Item("http://other.com")
+        self.storage.add_items([self.item, other])
+        self.addCleanup(self.storage.remove_item, self.item)
+        self.addCleanup(self.storage.remove_item, other)
+        self.assertEqual(self.url, self.storage.find_item_by_url(self.url).url)
+        self.assertEqual(other.url, self.storage.find_item_by_url(other.url).url)
+
     def test_find_item_by_url(self):
         self.storage.add_item(self.item)
         result = self.storage.find_item_by_url(self.item.url)
@@ -126,6 +442,107 @@ class MongoStorageTest(unittest.TestCase):
         self.storage.remove_item(self.item)
         self.storage.remove_healthcheck(self.healthcheck)
 
+    def test_find_items_by_healthcheck_name(self):
+        self.healthcheck.group_id = 1
+        self.storage.add_healthcheck(self.healthcheck)
+        self.addCleanup(self.storage.remove_healthcheck, self.healthcheck)
+        self.item.group_id = self.healthcheck.group_id
+        self.item.trigger_id = "10"
+        self.storage.add_item(self.item)
+        self.addCleanup(self.storage.remove_item, self.item)
+        items = self.storage.find_items_by_healthcheck_name(
+            self.healthcheck.name)
+        self.assertEqual(1, len(items))
+        self.assertEqual(self.item.url, items[0].url)
+        self.assertEqual("10", items[0].trigger_id)
+
+    def test_find_items_without_comment(self):
+        self.storage.add_item(self.item)
+        self.addCleanup(self.storage.remove_item, self.item)
+        commented = Item("http://commented.com", comment="ok")
+        self.storage.add_item(commented)
+        self.addCleanup(self.storage.remove_item, commented)
+        urls = [item.url for item in self.storage.find_items_without_comment()]
+        self.assertIn(self.item.url, urls)
+        self.assertNotIn(commented.url, urls)
+
+    def test_update_items_comment(self):
+        self.storage.add_item(self.item)
+        self.addCleanup(self.storage.remove_item, self.item)
+        self.item.comment = "restart it"
+        self.storage.update_items_comment([self.item])
+        result = self.storage.find_item_by_url(self.item.url)
+        self.assertEqual("restart it", result.comment)
+
+    def test_update_items_comment_of_one_instance(self):
+        mine = Item(self.url, group_id="g1")
+        other = Item(self.url, group_id="g2")
+        self.storage.add_items([mine, other])
+        self.addCleanup(self.storage.remove_item, mine)
+        mine.comment = "restart it"
+        self.storage.update_items_comment([mine])
+        self.assertEqual("restart it", self.storage.find_items_by_group("g1")[0].comment)
+        self.assertFalse(hasattr(self.storage.find_items_by_group("g2")[0], "comment"))
+
+    def test_remove_items_by_group(self):
+        self.item.group_id = "g1"
+        other = Item("http://other.com", group_id="g2")
+        self.storage.add_items([self.item, other])
+        self.addCleanup(self.storage.remove_item, other)
+        self.storage.remove_items_by_group("g1")
+        self.assertEqual([], self.storage.find_items_by_group("g1"))
+        self.assertEqual(1, len(self.storage.find_items_by_group("g2")))
+
+    def test_remove_users_and_group_from_users(self):
+        only = User("u1", "only@w.com", "g1")
+        shared = User("u2", "shared@w.com", "g1", "g2")
+        self.storage.add_user(only)
+        self.storage.add_user(shared)
+        self.addCleanup(self.storage.remove_user, shared)
+        self.storage.remove_users([only])
+        self.storage.remove_group_from_users("g1")
+        with self.assertRaises(UserNotFoundError):
+            self.storage.find_user_by_email(only.email)
+        self.assertEqual(("g2",), self.storage.find_user_by_email(shared.email).groups_id)
+
+    def test_find_healthcheck_with_items(self):
+        self.healthcheck.group_id = "g1"
+        self.storage.add_healthcheck(self.healthcheck)
+        self.addCleanup(self.storage.remove_healthcheck, self.healthcheck)
+        self.item.group_id = "g1"
+        self.item.comment = "restart"
+        self.item.action_id = "1"
+        other = Item("http://other.com", group_id="g2")
+        self.storage.add_items([self.item, other])
+        self.addCleanup(self.storage.remove_item, self.item)
+        self.addCleanup(self.storage.remove_item, other)
+        healthcheck, items = self.storage.find_healthcheck_with_items(
+            self.healthcheck.name)
+        self.assertEqual("g1", healthcheck.group_id)
+        self.assertEqual([self.url], [item.url for item in items])
+        self.assertEqual("g1", items[0].group_id)
+        self.assertEqual("restart", items[0].comment)
+        self.assertFalse(hasattr(items[0], "action_id"))
+
+    def test_find_healthcheck_with_items_not_found(self):
+        with self.assertRaises(HealthCheckNotFoundError):
+            self.storage.find_healthcheck_with_items("unknown")
+
+    def test_find_healthcheck_with_watchers(self):
+        self.healthcheck.group_id = "g1"
+        self.storage.add_healthcheck(self.healthcheck)
+        self.addCleanup(self.storage.remove_healthcheck, self.healthcheck)
+        watcher = User("u1", "watcher@w.com", "g2", "g1")
+        other = User("u2", "other@w.com", "g2")
+        self.storage.add_user(watcher)
+        self.storage.add_user(other)
+        self.addCleanup(self.storage.remove_user, watcher)
+        self.addCleanup(self.storage.remove_user, other)
+        healthcheck, watchers = self.storage.find_healthcheck_with_watchers(
+            self.healthcheck.name)
+        self.assertEqual("g1", healthcheck.group_id)
+        self.assertEqual(["watcher@w.com"], watchers)
+
     def test_find_watcher_by_healthcheck_name(self):
         self.healthcheck.group_id = 1
         self.storage.add_healthcheck(self.healthcheck)
@@ -173,6 +590,19 @@ class MongoStorageTest(unittest.TestCase):
         self.assertEqual(result.name, self.healthcheck.name)
         self.storage.remove_healthcheck(self.healthcheck)
 
+    def test_reads_stop_at_the_deadline(self):
+        self.assertEqual({}, self.storage.max_time())
+        with deadlines.override(deadlines.Deadline(2)):
+            self.assertAlmostEqual(2000, self.storage.max_time()["max_time_ms"], delta=100)
+            self.storage.add_healthcheck(self.healthcheck)
+            result = self.storage.find_healthcheck_by_name(self.healthcheck.name)
+            self.assertEqual(result.name, self.healthcheck.name)
+            hc, items = self.storage.find_healthcheck_with_items(self.healthcheck.name)
+            self.assertEqual(hc.name, self.healthcheck.name)
+            self.assertEqual([], self.storage.find_items_by_group("no-group"))
+            self.assertEqual([], self.storage.find_users_by_group("no-group"))
+        self.storage.remove_healthcheck(self.healthcheck)
+
     def test_find_healthcheck_by_name_not_found(self):
         with self.assertRaises(HealthCheckNotFoundError):
             self.storage.find_healthcheck_by_name("doesn't exist")
@@ -257,3 +687,105 @@ class MongoStorageTest(unittest.TestCase):
         result = self.storage.find_healthcheck_by_name(self.healthcheck.name)
         self.assertEqual(["group3"], result.host_groups)
         self.storage.remove_healthcheck(self.healthcheck)
+
+    def test_jobs(self):
+        self.storage.db.jobs.delete_many({})
+        self.addCleanup(self.storage.db.jobs.delete_many, {})
+        first = self.storage.add_job(Job("remove", {"name": "bla"}))
+        second = self.storage.add_job(Job("remove", {"name": "ble"}))
+        self.assertEqual("queued", self.storage.find_job(first.id).status)
+
+        job = self.storage.claim_job(lease=60)
+        self.assertEqual(first.id, job.id)
+        self.assertEqual("running", job.status)
+        self.assertEqual(1, job.attempts)
+        self.assertEqual(second.id, self.storage.claim_job(lease=60).id)
+        self.assertIsNone(self.storage.claim_job(lease=60))
+
+        self.assertTrue(self.storage.finish_job(job, "boom"))
+        job = self.storage.find_job(first.id)
+        self.assertEqual("failed", job.status)
+        self.assertEqual("boom", job.error)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_claim_expired_job(self):
+        self.storage.db.jobs.delete_many({})
+        self.addCleanup(self.storage.db.jobs.delete_many, {})
+        self.storage.add_job(Job("remove", {"name": "bla"}))
+        expired = self.storage.claim_job(lease=-1)
+        job = self.storage.claim_job(lease=60)
+        self.assertEqual(expired.id, job.id)
+        self.assertEqual(2, job.attempts)
+        self.assertFalse(self.storage.finish_job(expired))
+        self.assertTrue(self.storage.finish_job(job))
+        self.assertEqual("done", self.storage.find_job(job.id).status)
+
+    def test_retry_job(self):
+        self.storage.db.jobs.delete_many({})
+        self.addCleanup(self.storage.db.jobs.delete_many, {})
+        self.storage.add_job(Job("remove", {"name": "bla"}))
+        job = self.storage.claim_job(lease=60)
+        self.assertTrue(self.storage.retry_job(job, "zabbix is overloaded, try again later", 60))
+        found = self.storage.find_job(job.id)
+        self.assertEqual("queued", found.status)
+        self.assertEqual("zabbix is overloaded, try again later", found.error)
+        self.assertIsNone(self.storage.claim_job(lease=60))
+        job = self.storage.find_job(job.id)
+        self.assertTrue(self.storage.retry_job(job, "again", -1))
+        job = self.storage.claim_job(lease=60)
+        self.assertEqual(2, job.attempts)
+
+    def test_find_job_not_found(self):
+        with self.assertRaises(JobNotFoundError):
+            self.storage.find_job("404")
+
+    def test_locks(self):
+        # without MONGODB_ENSURE_INDEXES the lock still creates its index
+        self.storage.db.locks.drop()
+        self.addCleanup(self.storage.db.locks.delete_many, {})
+        token = self.storage.acquire_lock("bla", ttl=60)
+        self.assertEqual(1, token)
+        self.assertIsNone(self.storage.acquire_lock("bla", ttl=60))
+        self.assertEqual(1, self.storage.acquire_lock("ble", ttl=60))
+        self.assertTrue(self.storage.renew_lock("bla", token, ttl=60))
+        self.storage.release_lock("bla", token)
+        self.assertFalse(self.storage.renew_lock("bla", token, ttl=60))
+        self.assertEqual(2, self.storage.acquire_lock("bla", ttl=60))
+
+    def test_idempotency_keys(self):
+        self.storage.db.idempotency_keys.drop()
+        self.addCleanup(self.storage.db.idempotency_keys.delete_many, {})
+        record = IdempotencyKey("key", "abc")
+        self.assertTrue(self.storage.add_idempotency_key(record))
+        self.assertFalse(self.storage.add_idempotency_key(IdempotencyKey("key", "abc")))
+        self.assertFalse(self.storage.claim_idempotency_key(IdempotencyKey("key", "abc")))
+        indexes = self.storage.db.idempotency_keys.index_information()
+        self.assertIn([("expires_at", 1)], [list(index["key"]) for index in indexes.values()])
+        response = {"status": 201, "body": "", "headers": []}
+        self.storage.finish_idempotency_key(record, response)
+        found = self.storage.find_idempotency_key("key")
+        self.assertEqual("done", found.status)
+        self.assertEqual(response, found.response)
+        self.storage.remove_idempotency_key(record)
+        self.assertEqual("done", self.storage.find_idempotency_key("key").status)
+
+    def test_claim_abandoned_idempotency_key(self):
+        self.addCleanup(self.storage.db.idempotency_keys.delete_many, {})
+        self.storage.add_idempotency_key(IdempotencyKey("key", "abc", lease=-1))
+        self.assertFalse(self.storage.claim_idempotency_key(IdempotencyKey("key", "other")))
+        record = IdempotencyKey("key", "abc")
+        self.assertTrue(self.storage.claim_idempotency_key(record))
+        self.assertFalse(self.storage.claim_idempotency_key(IdempotencyKey("key", "abc")))
+        self.storage.remove_idempotency_key(record)
+        with self.assertRaises(IdempotencyKeyNotFoundError):
+            self.storage.find_idempotency_key("key")
+
+    def test_acquire_expired_lock(self):
+        self.addCleanup(self.storage.db.locks.delete_many, {})
+        expired = self.storage.acquire_lock("bla", ttl=-1)
+        token = self.storage.acquire_lock("bla", ttl=60)
+        self.assertEqual(expired + 1, token)
+        self.assertFalse(self.storage.renew_lock("bla", expired, ttl=60))
+        # a holder whose lease expired must not release the new one
+        self.storage.release_lock("bla", expired)
+        self.assertIsNone(self.storage.acquire_lock("bla", ttl=60))
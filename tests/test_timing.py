@@ -0,0 +1,81 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import json
+import threading
+import unittest
+
+import flask
+import mock
+
+from healthcheck import timing
+
+
+class RequestTimingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.timings = timing.RequestTimings()
+
+    def test_header(self):
+        self.timings.add("zabbix-login", "user.login", 0.012)
+        self.timings.add("zabbix", "host.get", 0.02)
+        self.timings.add("zabbix", "host.create", 0.0301)
+        self.timings.add("render", "render", 0.0004)
+        with mock.patch.object(self.timings, "total", return_value=0.1):
+            header = self.timings.header()
+        self.assertEqual(
+            'zabbix-login;dur=12.0;desc="1 call", zabbix;dur=50.1;desc="2 calls", '
+            'render;dur=0.4;desc="1 call", total;dur=100.0',
+            header)
+
+    def test_header_without_calls(self):
+        with mock.patch.object(self.timings, "total", return_value=0.002):
+            self.assertEqual("total;dur=2.0", self.timings.header())
+
+    def test_debug(self):
+        self.timings.add("mongo", "find_item_by_url", 0.003, error=True)
+        debug = json.loads(self.timings.debug())
+        self.assertEqual({"calls": 1, "ms": 3.0}, debug["categories"]["mongo"])
+        self.assertEqual({"calls": 0, "ms": 0.0}, debug["categories"]["zabbix"])
+        self.assertEqual([{"category": "mongo", "method": "find_item_by_url",
+                           "ms": 3.0, "error": True}], debug["calls"])
+
+
+class RecordTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app = flask.Flask(__name__)
+
+    def test_category(self):
+        self.assertEqual("zabbix-login", timing.category("zabbix", "user.login"))
+        self.assertEqual("zabbix", timing.category("zabbix", "host.get"))
+        self.assertEqual("mongo", timing.category("mongo", "find_user_by_email"))
+
+    def test_record_in_request(self):
+        with self.app.test_request_context("/"):
+            flask.g.timings = timing.RequestTimings()
+            timing.record("zabbix", "user.login", 0.01)
+            timing.record("mongo", "add_item", 0.02)
+            with timing.timed("render"):
+                pass
+            categories = flask.g.timings.categories
+        self.assertEqual(1, categories["zabbix-login"][0])
+        self.assertEqual(1, categories["mongo"][0])
+        self.assertEqual(1, categories["render"][0])
+
+    def test_bind(self):
+        with self.app.test_request_context("/"):
+            flask.g.timings = timing.RequestTimings()
+            thread = threading.Thread(target=timing.bind(
+                lambda: timing.record("zabbix", "host.create", 0.01)))
+            thread.start()
+            thread.join()
+            categories = flask.g.timings.categories
+        self.assertEqual(1, categories["zabbix"][0])
+        self.assertIsNone(timing.current())
+
+    def test_record_outside_request(self):
+        timing.record("zabbix", "host.get", 0.01)
+        with self.app.test_request_context("/"):
+            timing.record("zabbix", "host.get", 0.01)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+from benchmarks.trace import TraceGenerator
+
+
+class TraceGeneratorTest(unittest.TestCase):
+
+    def generate(self, seed=1):
+        generator = TraceGenerator(instances=3, groups=5, urls_per_instance=2, seed=seed)
+        return list(generator.generate(duration=60, rate=10))
+
+    def test_setup(self):
+        entries = self.generate()
+        setup = [e for e in entries if e.get("setup")]
+        self.assertEqual(9, len(setup))
+        self.assertEqual({"name": "trace-1"}, setup[0]["form"])
+        self.assertEqual("/resources/trace-1/url", setup[1]["path"])
+        self.assertFalse(any(e.get("setup") for e in entries[9:]))
+
+    def test_timestamps(self):
+        entries = self.generate()
+        timestamps = [e["timestamp"] for e in entries]
+        self.assertEqual(sorted(timestamps), timestamps)
+        self.assertLessEqual(timestamps[-1], 60)
+        self.assertGreater(len(entries), 300)
+
+    def test_deterministic(self):
+        self.assertEqual(self.generate(seed=2), self.generate(seed=2))
+        self.assertNotEqual(self.generate(seed=2), self.generate(seed=3))
+
+    def test_removes_only_existing(self):
+        urls = set()
+        watchers = set()
+        instances = set()
+        for entry in self.generate():
+            path, method = entry["path"], entry["method"]
+            if path == "/resources":
+                instances.add(entry["form"]["name"])
+                continue
+            name = path.split("/")[2]
+            self.assertIn(name, instances)
+            if method == "DELETE" and path == "/resources/" + name:
+                instances.remove(name)
+            elif path.endswith("/url") and method == "POST":
+                urls.add(entry["body"]["url"])
+            elif path.endswith("/url") and method == "DELETE":
+                urls.remove(entry["body"]["url"])
+            elif path.endswith("/watcher") and method == "POST":
+                watchers.add(entry["body"]["watcher"])
+            elif "/watcher/" in path and method == "DELETE":
+                watchers.remove(path.split("/")[-1])
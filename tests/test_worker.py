@@ -0,0 +1,153 @@
+# Copyright 2015 healthcheck-as-a-service authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import unittest
+
+import mock
+
+from healthcheck import deadlines
+from healthcheck.backends import GroupNotExists
+from healthcheck.backends.breaker import CircuitBreaker, ZabbixUnavailableError
+from healthcheck.backends.governor import ZabbixOverloadedError
+from healthcheck.locks import LockTimeoutError
+from healthcheck.pool import ManagerPool
+from healthcheck.storage import CachedStorage, Job
+from healthcheck.worker import Worker, error_message
+
+
+class WorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = mock.Mock()
+        self.storage = mock.Mock()
+        self.storage.finish_job.return_value = True
+        self.worker = Worker(self.storage, ManagerPool(lambda: self.manager, size=1),
+                             concurrency=1, poll_interval=0.01)
+
+    def job(self, operation="add_url", attempts=1, **args):
+        return Job(operation, args, status="running", attempts=attempts)
+
+    def test_run_once_without_jobs(self):
+        self.storage.claim_job.return_value = None
+        self.assertFalse(self.worker.run_once())
+        self.storage.claim_job.assert_called_once_with(300)
+
+    def test_run_once(self):
+        job = self.job(name="hc", url="http://a.com")
+        self.storage.claim_job.return_value = job
+        self.assertTrue(self.worker.run_once())
+        self.manager.add_url.assert_called_once_with(name="hc", url="http://a.com")
+        self.storage.finish_job.assert_called_once_with(job, None)
+
+    def test_execute_failure(self):
+        job = self.job("add_group", name="hc", group="g")
+        self.manager.add_group.side_effect = GroupNotExists()
+        self.worker.execute(job)
+        self.storage.finish_job.assert_called_once_with(job, "group not exists")
+
+    def test_execute_unexpected_failure(self):
+        job = self.job("remove", name="hc")
+        self.manager.remove.side_effect = ValueError("boom")
+        self.worker.execute(job)
+        self.storage.finish_job.assert_called_once_with(job, "ValueError: boom")
+
+    def test_execute_begins_cached_storage(self):
+        self.manager.storage = CachedStorage(mock.Mock())
+        self.manager.storage.hits = 3
+        self.worker.execute(self.job("remove", name="hc"))
+        self.assertEqual(0, self.manager.storage.hits)
+
+    def test_execute_with_the_lease_as_deadline(self):
+        remaining = []
+        self.manager.remove.side_effect = lambda name: remaining.append(deadlines.remaining())
+        self.worker.execute(self.job("remove", name="hc"))
+        self.assertAlmostEqual(300, remaining[0], delta=1)
+        self.assertIsNone(deadlines.current())
+
+    def test_execute_unknown_operation(self):
+        job = self.job("remove_watcher", name="hc")
+        self.worker.execute(job)
+        self.assertFalse(self.manager.remove_watcher.called)
+        self.storage.finish_job.assert_called_once_with(job, "unknown operation remove_watcher")
+
+    def test_execute_too_many_attempts(self):
+        job = self.job("remove", attempts=4, name="hc")
+        self.worker.execute(job)
+        self.assertFalse(self.manager.remove.called)
+        self.storage.finish_job.assert_called_once_with(job, "gave up after 3 attempts")
+
+    def test_execute_requeues_overloaded_job(self):
+        job = self.job("remove", name="hc")
+        self.manager.remove.side_effect = ZabbixOverloadedError("host.delete", "rate", 30)
+        self.worker.execute(job)
+        self.assertFalse(self.storage.finish_job.called)
+        args = self.storage.retry_job.call_args[0]
+        self.assertEqual((job, "zabbix is overloaded, try again later"), args[:2])
+        self.assertGreaterEqual(args[2], 30)
+
+    def test_execute_requeue_backoff(self):
+        job = self.job("remove", attempts=2, name="hc")
+        self.manager.remove.side_effect = ZabbixOverloadedError("host.delete", "rate", 0.1)
+        self.worker.execute(job)
+        delay = self.storage.retry_job.call_args[0][2]
+        self.assertTrue(5 <= delay <= 10, delay)
+
+    def test_execute_overloaded_on_last_attempt(self):
+        job = self.job("remove", attempts=3, name="hc")
+        self.manager.remove.side_effect = ZabbixOverloadedError("host.delete", "rate", 30)
+        self.worker.execute(job)
+        self.assertFalse(self.storage.retry_job.called)
+        self.storage.finish_job.assert_called_once_with(job, "zabbix is overloaded, try again later")
+
+    def test_execute_requeues_unavailable_job(self):
+        job = self.job("remove", name="hc")
+        self.manager.remove.side_effect = ZabbixUnavailableError(60)
+        self.worker.execute(job)
+        self.assertFalse(self.storage.finish_job.called)
+        args = self.storage.retry_job.call_args[0]
+        self.assertEqual((job, "zabbix is unavailable, try again later"), args[:2])
+        self.assertGreaterEqual(args[2], 60)
+
+    def test_execute_requeues_while_breaker_is_open(self):
+        zabbix = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        zabbix.failed()
+        factory = mock.Mock()
+        self.worker.pool = ManagerPool(factory, size=1)
+        job = self.job("remove", name="hc")
+        with mock.patch("healthcheck.backends.breaker._breaker", zabbix):
+            self.worker.execute(job)
+        self.assertFalse(factory.called)
+        args = self.storage.retry_job.call_args[0]
+        self.assertEqual("zabbix is unavailable, try again later", args[1])
+        self.assertGreater(args[2], 50)
+
+    def test_execute_requeues_busy_instance(self):
+        job = self.job("remove", name="hc")
+        self.manager.remove.side_effect = LockTimeoutError("hc")
+        self.worker.execute(job)
+        self.assertFalse(self.storage.finish_job.called)
+        args = self.storage.retry_job.call_args[0]
+        self.assertEqual((job, "instance is busy, try again later"), args[:2])
+        self.assertTrue(2.5 <= args[2] <= 5, args[2])
+
+    def test_execute_releases_manager(self):
+        self.manager.remove.side_effect = ValueError()
+        self.worker.execute(self.job("remove", name="hc"))
+        self.assertEqual(0, self.worker.pool.stats()["in_use"])
+
+    def test_run_until_stopped(self):
+        jobs = [self.job("remove", name="hc"), None]
+
+        def claim_job(lease):
+            if jobs:
+                return jobs.pop(0)
+            self.worker.stop()
+
+        self.storage.claim_job.side_effect = claim_job
+        self.worker.run()
+        self.manager.remove.assert_called_once_with(name="hc")
+
+    def test_error_message(self):
+        self.assertEqual("group not exists", error_message(GroupNotExists()))
+        self.assertEqual("KeyError: 'x'", error_message(KeyError("x")))